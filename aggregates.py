@@ -0,0 +1,182 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+import numpy
+import pandas
+import dataQuality
+
+logger = logging.getLogger(__name__)
+
+#where the running totals are kept between runs
+PATH = os.environ.get("AGGREGATES_PATH", "data/aggregates.json")
+
+#the store is read once per process and written after every merge
+STORE = {}
+LOCK = threading.Lock()
+LOADED = [False]
+
+def emptyStore():
+    """
+    Returns a store without any run in it.
+    """
+
+    return {"runs":0, "rows":0, "updated":None, "quality":{}, "columns":{}, "categories":{}}
+
+def load():
+    """
+    Reads the store saved by previous runs, once per process. A
+    missing or unreadable file just means an empty store. Must be
+    called holding LOCK.
+    """
+
+    if LOADED[0]:
+        return
+    LOADED[0] = True
+
+    STORE.update(emptyStore())
+    if os.path.exists(PATH)==False:
+        return
+
+    try:
+        with open(PATH, "r") as fp:
+            STORE.update(json.load(fp))
+    except Exception:
+        logger.exception("The aggregates could not be read")
+
+def save():
+    """
+    Writes the store to disk, replacing the file at once so it is
+    never left half written. Must be called holding LOCK.
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(PATH)), exist_ok=True)
+    with open(PATH + ".tmp", "w") as fp:
+        json.dump(STORE, fp)
+    os.replace(PATH + ".tmp", PATH)
+
+def describe(df):
+    """
+    Sums up a batch column by column, in a form that adds up across
+    batches: numeric and boolean columns get their count of values,
+    of missing values, their sum, sum of squares, min and max, and
+    categorical columns the frequency of each category. Free text
+    columns are left out.
+
+    Input:
+
+    df: a batch after data quality or feature mining -> pandas.DataFrame
+
+    Output:
+
+    batch: the totals of the batch -> dict
+    """
+
+    batch = {"rows":len(df), "columns":{}, "categories":{}}
+
+    for column in df.columns:
+        values = df[column]
+
+        if isinstance(values.dtype, pandas.CategoricalDtype):
+            counts = values.value_counts()
+            batch["categories"][column] = {str(k): int(v) for k, v in counts[counts>0].items()}
+            continue
+
+        if pandas.api.types.is_bool_dtype(values.dtype) or pandas.api.types.is_numeric_dtype(values.dtype):
+            numbers = values.dropna().to_numpy(dtype=numpy.float64)
+            batch["columns"][column] = {"count":len(numbers),
+                                        "missing":int(values.isna().sum()),
+                                        "sum":float(numbers.sum()),
+                                        "sum_squares":float((numbers**2).sum()),
+                                        "min":float(numbers.min()) if len(numbers)>0 else None,
+                                        "max":float(numbers.max()) if len(numbers)>0 else None}
+
+    return batch
+
+def combine(totals, batch):
+    """
+    Adds the totals of a batch, made by describe, to running totals
+    of the same form.
+
+    Input:
+
+    totals: running totals -> dict
+    batch: the totals of a batch -> dict
+    """
+
+    totals["rows"] = totals.get("rows", 0) + batch["rows"]
+
+    columns = totals.setdefault("columns", {})
+    for column, moments in batch["columns"].items():
+        if column not in columns:
+            columns[column] = dict(moments)
+            continue
+        current = columns[column]
+        for key in ["count", "missing", "sum", "sum_squares"]:
+            current[key] += moments[key]
+        current["min"] = min([x for x in [current["min"], moments["min"]] if x is not None], default=None)
+        current["max"] = max([x for x in [current["max"], moments["max"]] if x is not None], default=None)
+
+    categories = totals.setdefault("categories", {})
+    for column, counts in batch["categories"].items():
+        frequencies = categories.setdefault(column, {})
+        for value, count in counts.items():
+            frequencies[value] = frequencies.get(value, 0) + count
+
+def mergeQuality(stats):
+    """
+    Adds the data quality counts of a run to the store. Counts are
+    summed, per field counts too, and the invalid fields seen in any
+    run are kept.
+
+    Input:
+
+    stats: the counts of every data quality stage -> dict
+    """
+
+    with LOCK:
+        load()
+        dataQuality.mergeStats(STORE["quality"], stats)
+        STORE["runs"] += 1
+        STORE["updated"] = str(datetime.now())
+        save()
+
+def mergeColumns(batch):
+    """
+    Adds the column totals of a run, made by describe and possibly
+    combined over several chunks, to the store. Only the batch is
+    read; the runs before it are never looked at again.
+
+    Input:
+
+    batch: the totals of the run -> dict
+    """
+
+    with LOCK:
+        load()
+        combine(STORE, batch)
+        STORE["updated"] = str(datetime.now())
+        save()
+
+def summary():
+    """
+    Returns the store with the mean and standard deviation of every
+    numeric column worked out from its totals.
+
+    Output:
+
+    store: the running totals of every run so far -> dict
+    """
+
+    with LOCK:
+        load()
+        store = json.loads(json.dumps(STORE))
+
+    for moments in store["columns"].values():
+        if moments["count"]>0:
+            mean = moments["sum"] / moments["count"]
+            moments["mean"] = mean
+            moments["std"] = max(moments["sum_squares"] / moments["count"] - mean**2, 0.0) ** 0.5
+
+    return store
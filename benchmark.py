@@ -0,0 +1,369 @@
+import os
+import re
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy
+import pandas
+from sqlalchemy import create_engine
+import dataQuality
+import featureMining
+import dbTransactions
+import ruleCache
+
+#vocabulary of the synthetic listings, close to what the scrapers return
+STREETS = ["Keizersgracht", "Herengracht", "Prinsengracht", "Coolsingel", "Witte de Withstraat", "Nieuwe Binnenweg",
+           "Kralingse Plaslaan", "Oudegracht", "Lange Voorhout", "Vondelstraat", "Javastraat", "Laan van Meerdervoort",
+           "Beukelsweg", "Stationsweg", "Kerkstraat", "Dorpsstraat", "Molenweg", "Schiekade", "Boompjes", "Maaskade"]
+CITIES = ["Amsterdam", "Rotterdam", "Den Haag", "Utrecht", "Haarlem", "Leiden", "Delft", "Schiedam"]
+POSTCODE_LETTERS = list("ABCEGHJKLMNPRSTVWXZ")
+SUFFIXES = ["", "", "", "", "-A", "-B", " bis", "-1", "-2", "-H"]
+HOUSING_TYPES = ["Bovenwoning, appartement", "Benedenwoning, appartement", "Eengezinswoning, tussenwoning",
+                 "Eengezinswoning, hoekwoning", "Herenhuis, vrijstaande woning", "Penthouse", "Maisonnette",
+                 "Tussenverdieping", "Portiekflat", "Grachtenpand"]
+ENERGY_LABELS = ["A+++", "A++", "A+", "A", "B", "C", "D", "E", "F", "G", "Niet verplicht", "Niet beschikbaar"]
+STATUSES = ["Beschikbaar", "Onder bod", "Verkocht onder voorbehoud", "Onder optie"]
+CONSTRUCTION = ["Bestaande bouw", "Nieuwbouw"]
+GARAGES = ["Inpandig", "Garagebox", "Parkeerplaats", "Garage en carport", "Souterrain", "Parkeerkelder, Inpandig"]
+GARDENS = ["Achtertuin", "Achtertuin en voortuin", "Zonneterras", "Patio", "Plaats", "Tuin rondom", "Voortuin, Zijtuin"]
+OWNERSHIP = ["Volle eigendom", "Gemeentelijke erfpacht", "Gemeentelijke eigendom belast met erfpacht",
+             "Eigendom belast met opstal", "Lidmaatschapsrecht", "Gebruik en bewoning", "Mandelig"]
+SENTENCES = ["Dit sfeervolle appartement ligt op een toplocatie in de stad.",
+             "De woning beschikt over een ruime woonkamer met veel lichtinval.",
+             "De woonoppervlakte bedraagt circa {area} m2 en het volume {volume} m3.",
+             "Via de hal bereikt u de badkamer met inloopdouche en het toilet.",
+             "Er zijn {rooms} kamers, waarvan {bedrooms} slaapkamers.",
+             "De tuin op het zuiden biedt veel privacy.",
+             "Parkeren kan in de eigen garage of op straat.",
+             "Energielabel {label}, voorzien van dubbel glas en een HR-ketel.",
+             "Vraagprijs {price} euro kosten koper.",
+             "Gelegen op eigen grond, dus geen erfpacht.",
+             "De keuken is voorzien van diverse inbouwapparatuur.",
+             "Op loopafstand van winkels, scholen en het openbaar vervoer.",
+             "Bouwjaar 1932, de woning verkeert in goede staat van onderhoud.",
+             "Kortom, een unieke kans in deze geliefde buurt!"]
+
+#the stages measured, in pipeline order
+STAGES = ["uniqueness", "validity", "completeness", "extractFeaturesNumerics", "extractFeaturesCategorical", "bulk_insert"]
+
+def pick(rng, values, rows):
+    """
+    Draws rows values out of a list.
+
+    Input:
+
+    rng: a random generator -> numpy.random.Generator
+    values: the values to draw from -> list
+    rows: the number of values to draw -> int
+
+    Output:
+
+    drawn: the values drawn -> pandas.Series
+    """
+
+    drawn = pandas.Series(numpy.asarray(values, dtype=object)[rng.integers(0, len(values), rows)], dtype=object)
+
+    return drawn
+
+def generateListings(rows, duplicates=0.02, invalid=0.05, seed=0):
+    """
+    Generates a CSV-like dataset of Dutch housing listings with the
+    columns the scrapers return. A share of the rows are exact copies
+    or repeat an address, and a share carry an invalid value in one
+    of their fields, so that every data quality rule has work to do.
+
+    Input:
+
+    rows: the number of rows -> int
+    duplicates: the share of duplicated rows and addresses -> float
+    invalid: the share of rows with an invalid field -> float
+    seed: the random seed -> int
+
+    Output:
+
+    listings: the synthetic listings -> pandas.DataFrame
+    """
+
+    rng = numpy.random.default_rng(seed)
+    s = lambda values: pandas.Series(values).astype(str)
+
+    rooms = rng.integers(1, 9, rows)
+    bedrooms = numpy.maximum(rooms - rng.integers(1, 3, rows), 0)
+    floors = rng.integers(1, 5, rows)
+    area = rng.integers(25, 350, rows)
+    volume = area * rng.integers(3, 5, rows)
+    price = rng.integers(150, 2500, rows) * 1000
+    label = pick(rng, ENERGY_LABELS, rows)
+
+    housing = pick(rng, HOUSING_TYPES, rows)
+    apartment = housing.str.contains("appartement|Penthouse|Maisonnette|Tussenverdieping").to_numpy()
+
+    #every placeholder of a sentence is filled in with the values of its row
+    placeholders = {"area":s(area), "volume":s(volume), "rooms":s(rooms), "bedrooms":s(bedrooms), "price":s(price), "label":label.astype(str)}
+
+    description = pandas.Series("", index=range(rows), dtype=object)
+    for sentence in SENTENCES:
+        keep = rng.random(rows) < 0.6
+        text = pandas.Series("", index=range(rows), dtype=object)
+        for i, part in enumerate(re.split(r"\{(\w+)\}", sentence)):
+            text = text + (placeholders[part] if i % 2==1 else part)
+        description = description.where(keep==False, description + " " + text)
+
+    assert description.str.contains("{", regex=False).any()==False
+
+    listings = pandas.DataFrame({
+        "address": pick(rng, STREETS, rows) + " " + s(rng.integers(1, 400, rows)) + pick(rng, SUFFIXES, rows) + ", "
+                   + s(rng.integers(1000, 9999, rows)) + " " + pick(rng, POSTCODE_LETTERS, rows) + pick(rng, POSTCODE_LETTERS, rows)
+                   + " " + pick(rng, CITIES, rows),
+        "price": price.astype(float),
+        "description": description.str.strip(),
+        "living_area_m2": area.astype(float),
+        "plot_area_m2": numpy.where(apartment, numpy.nan, area * rng.uniform(1, 4, rows)).round(),
+        "volume_m3": volume.astype(float),
+        "number_of_rooms": s(rooms) + " kamers (" + s(bedrooms) + " slaapkamers)",
+        "number_of_floors": s(floors) + " woonlagen" + pick(rng, ["", " en een zolder", ", een kelder en een vliering", " en een kelder"], rows),
+        "backyard": s(rng.integers(10, 200, rows)) + " m² (" + s(rng.integers(5, 20, rows)) + "m diep en " + s(rng.integers(4, 10, rows)) + "m breed)",
+        "floor_level": numpy.where(apartment, s(rng.integers(1, 12, rows)) + "e woonlaag", "Begane grond"),
+        "number_of_bathrooms": s(rng.integers(1, 4, rows)) + " badkamers en " + s(rng.integers(1, 3, rows)) + " aparte toiletten",
+        "construction_type": pick(rng, CONSTRUCTION, rows),
+        "housing_type": housing,
+        "energy_label": label,
+        "housing_status": pick(rng, STATUSES, rows),
+        "garage": pick(rng, GARAGES, rows),
+        "garden": pick(rng, GARDENS, rows),
+        "ownership": pick(rng, OWNERSHIP, rows)
+    })
+
+    #sparse columns, as most listings leave them empty
+    for column, share in [("backyard", 0.5), ("garage", 0.6), ("garden", 0.3), ("plot_area_m2", 0.1), ("description", 0.05)]:
+        listings.loc[rng.random(rows) < share, column] = numpy.nan
+
+    #invalid values, one field per affected row
+    broken = numpy.flatnonzero(rng.random(rows) < invalid)
+    fields = rng.choice(["price", "living_area_m2", "number_of_rooms", "energy_label", "housing_status", "ownership"], len(broken))
+    for field in numpy.unique(fields):
+        where = broken[fields==field]
+        listings.loc[where, field] = 10.0 if listings[field].dtype.kind=="f" else "onbekend"
+
+    #duplicates: half are exact copies, half only repeat an address
+    copies = rng.integers(0, rows, int(rows * duplicates / 2))
+    readdressed = listings.iloc[rng.integers(0, rows, int(rows * duplicates / 2))].copy()
+    readdressed["address"] = listings["address"].iloc[rng.integers(0, rows, len(readdressed))].to_numpy()
+    listings = pandas.concat([listings, listings.iloc[copies], readdressed], ignore_index=True)
+
+    return listings
+
+def resetCache():
+    """
+    Empties the rule cache and marks it as loaded, so that the file
+    saved by the pipeline is never read during a measurement.
+    """
+
+    with ruleCache.LOCK:
+        ruleCache.CACHE.clear()
+        ruleCache.LOADED[0] = True
+
+def measure(function, *args):
+    """
+    Runs a stage twice: once to time it and once under tracemalloc
+    to find its peak memory, as tracing slows the stage down. The
+    arguments are copied for each run, since stages change them, and
+    the rule cache is emptied, so that neither run reuses the results
+    of the other or those saved by earlier runs.
+
+    Input:
+
+    function: the stage -> callable
+    args: the arguments of the stage
+
+    Output:
+
+    seconds: the wall time of the stage -> float
+    peak: the peak memory allocated by the stage, in MB -> float
+    result: what the stage returned -> object
+    """
+
+    resetCache()
+    copies = [x.copy() if isinstance(x, pandas.DataFrame) else x for x in args]
+    start = time.perf_counter()
+    result = function(*copies)
+    seconds = time.perf_counter() - start
+
+    resetCache()
+    copies = [x.copy() if isinstance(x, pandas.DataFrame) else x for x in args]
+    tracemalloc.start()
+    function(*copies)
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+
+    return seconds, peak, result
+
+def insertStage(clean, dbpath):
+    """
+    Creates a fresh table in a local SQLite database and inserts the
+    clean data into it, like the database step of /start.
+
+    Input:
+
+    clean: the clean data -> pandas.DataFrame
+    dbpath: a path-like object for the SQLite file -> str
+
+    Output:
+
+    rows: the number of rows inserted -> int
+    """
+
+    if os.path.exists(dbpath):
+        os.remove(dbpath)
+    engine = create_engine("sqlite:///" + dbpath)
+    table = dbTransactions.generate_sql_table(clean, "openred_clean_0", engine)
+    with engine.connect() as conn:
+        rows = dbTransactions.bulk_insert(clean, table, conn)
+    engine.dispose()
+
+    return rows
+
+def currentCommit():
+    """
+    Returns the short hash of the checked out commit, if any, so that
+    results can be compared across commits.
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+def runBenchmark(rows, duplicates=0.02, invalid=0.05, seed=0):
+    """
+    Generates synthetic listings and measures every pipeline stage on
+    them separately, in pipeline order, each stage taking the output
+    of the previous one.
+
+    Input:
+
+    rows: the number of rows to generate -> int
+    duplicates: the share of duplicated rows and addresses -> float
+    invalid: the share of rows with an invalid field -> float
+    seed: the random seed -> int
+
+    Output:
+
+    results: one record per stage -> list
+    """
+
+    listings = generateListings(rows, duplicates, invalid, seed)
+    commit = currentCommit()
+    run = str(datetime.now())
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        datapath = os.path.join(folder, "raw.csv")
+        dqpath = os.path.join(folder, "dq.txt")
+        fmpath = os.path.join(folder, "fm.txt")
+        listings.to_csv(datapath, index=False)
+
+        data = datapath
+        for stage in STAGES:
+            rowsIn = len(listings) if stage=="uniqueness" else len(data)
+
+            if stage=="uniqueness":
+                seconds, peak, data = measure(dataQuality.uniqueness, data, dqpath)
+            elif stage in ["validity", "completeness"]:
+                seconds, peak, data = measure(getattr(dataQuality, stage), data, dqpath)
+            elif stage=="extractFeaturesNumerics":
+                seconds, peak, data = measure(featureMining.extractFeaturesNumerics, data, fmpath)
+            elif stage=="extractFeaturesCategorical":
+                seconds, peak, data = measure(featureMining.extractFeaturesCategorical, data, fmpath)
+                data = data.drop([x for x in listings.columns if x not in featureMining.KEEP_COLUMNS], axis=1)
+            else:
+                seconds, peak, inserted = measure(insertStage, data, os.path.join(folder, "bench.db"))
+
+            results.append({"commit":commit, "run":run, "rows":rows, "duplicates":duplicates, "invalid":invalid,
+                            "stage":stage, "rows_in":rowsIn, "rows_out":len(data), "seconds":round(seconds, 4),
+                            "rows_per_second":round(rowsIn / seconds) if seconds>0 else None, "peak_mb":round(peak, 1)})
+
+    return results
+
+def saveResults(results, path):
+    """
+    Appends benchmark results to a JSON lines file.
+
+    Input:
+
+    results: the output of runBenchmark -> list
+    path: a path-like object -> str
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as fp:
+        for record in results:
+            fp.write(json.dumps(record) + "\n")
+
+def previousResults(path, rows, commit):
+    """
+    Finds the latest results saved for the same number of rows by a
+    different commit, to compare against.
+
+    Input:
+
+    path: a path-like object -> str
+    rows: the number of rows -> int
+    commit: the current commit -> str
+
+    Output:
+
+    previous: the time of each stage, keyed by stage -> dict
+    """
+
+    if os.path.exists(path)==False:
+        return {}
+
+    with open(path, "r") as fp:
+        records = [json.loads(line) for line in fp if line.strip()]
+
+    previous = {}
+    for record in records:
+        if record["rows"]==rows and record["commit"]!=commit:
+            previous[record["stage"]] = record
+
+    return previous
+
+def printResults(results, previous):
+    """
+    Prints benchmark results as a table, with the change against a
+    previous run when there is one.
+
+    Input:
+
+    results: the output of runBenchmark -> list
+    previous: the output of previousResults -> dict
+    """
+
+    print("{:<28}{:>10}{:>10}{:>12}{:>14}{:>10}{:>12}".format("stage", "rows in", "rows out", "seconds", "rows/s", "peak MB", "vs " + str(previous[STAGES[0]]["commit"]) if previous else ""))
+    for record in results:
+        change = ""
+        if record["stage"] in previous and previous[record["stage"]]["seconds"]>0:
+            change = "{:+.0%}".format(record["seconds"] / previous[record["stage"]]["seconds"] - 1)
+        print("{:<28}{:>10}{:>10}{:>12.3f}{:>14}{:>10.1f}{:>12}".format(record["stage"], record["rows_in"], record["rows_out"],
+              record["seconds"], record["rows_per_second"] or "", record["peak_mb"], change))
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks every pipeline stage on synthetic listings.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000], help="sizes to benchmark")
+    parser.add_argument("--duplicates", type=float, default=0.02, help="share of duplicated rows and addresses")
+    parser.add_argument("--invalid", type=float, default=0.05, help="share of rows with an invalid field")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="data/benchmarks/results.jsonl", help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        results = runBenchmark(rows, args.duplicates, args.invalid, args.seed)
+        printResults(results, previousResults(args.output, rows, results[0]["commit"]))
+        saveResults(results, args.output)
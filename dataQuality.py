@@ -1,59 +1,365 @@
 import pandas
 from datetime import datetime
+from difflib import SequenceMatcher
 import logic
 import numpy
 import utils
 
-def uniqueness(datapath, dqpath):
+#lines written to the data quality log by each stage
+REPORT = {
+          "header":"Data quality report for the run at {}.\n\n",
+          "uniqueness":"There were {duplicate_rows} duplicate rows. They have been dropped\nThere were {duplicate_keys} duplicate keys. These have been dropped.\nThere were {address_variants} addresses written differently for a listing already seen. These have been dropped.\nThere were {near_duplicates} near-duplicate addresses. They have been kept and flagged in FLAG_NEAR_DUPLICATE, with the address they resemble in NEAR_DUPLICATE_OF.\n",
+          "validity":"There were {invalid_rows} rows with invalid entries.\nThe invalid fields are: {invalid_fields}.\nInvalid entries per field: {invalid_counts}.\n",
+          "completeness":"There were {missing} missing values.\nOf these, {explained} could be explained by flags.\n"
+         }
+
+def writeHeader(dqpath, current_time):
+    """
+    Starts a new data quality log.
+
+    Input:
+
+    dqpath: a path-like object, or None to skip the log -> str
+    current_time: the timestamp of the run -> str
+    """
+
+    if dqpath is not None:
+        with open(dqpath, "w") as report:
+            report.write(REPORT["header"].format(current_time))
+
+def mergeStats(stats, counts):
+    """
+    Adds the counts of a stage to running stats, so that several
+    chunks of the same run can be reported as one. Numbers are 
+    summed, lists keep each element once and dicts of counts are
+    summed key by key.
+
+    Input:
+
+    stats: running counts -> dict
+    counts: counts of a single stage -> dict
+    """
+
+    for key, value in counts.items():
+        if isinstance(value, list):
+            stats[key] = stats.get(key, []) + [x for x in value if x not in stats.get(key, [])]
+        elif isinstance(value, dict):
+            merged = stats.setdefault(key, {})
+            for k, v in value.items():
+                merged[k] = merged.get(k, 0) + v
+        else:
+            stats[key] = stats.get(key, 0) + value
+
+def logStage(stage, counts, dqpath, stats=None):
+    """
+    Adds the counts of a stage to the running stats, if any, and
+    writes them to the data quality log, if any.
+
+    Input:
+
+    stage: the name of the stage, a key of REPORT -> str
+    counts: counts of the stage -> dict
+    dqpath: a path-like object, or None to skip the log -> str
+    stats: running counts, optional -> dict
+    """
+
+    if stats is not None:
+        mergeStats(stats, counts)
+
+    if dqpath is not None:
+        with open(dqpath, "a") as report:
+            report.write(REPORT[stage].format(**counts))
+
+def writeReport(stats, dqpath, current_time):
+    """
+    Writes a full data quality log out of running stats, in the
+    same format the stages use when they log themselves.
+
+    Input:
+
+    stats: running counts of every stage -> dict
+    dqpath: a path-like object -> str
+    current_time: the timestamp of the run -> str
+    """
+
+    writeHeader(dqpath, current_time)
+    with open(dqpath, "a") as report:
+        for stage in ["uniqueness", "validity", "completeness"]:
+            report.write(REPORT[stage].format(**stats))
+
+def uniqueness(raw, dqpath, stats=None):
     """
     Checks raw data for duplicated rows and keys and immediately
     drops them if they exist. It also logs the results to
-    a text file.
+    a text file. The raw data can be given as a path or as a
+    dataset that was already parsed, which is left untouched.
 
     Input:
 
-    datapath: a path-like object -> str
-    dqpath: a path-like object -> str
+    raw: a path-like object or the parsed raw data -> str | pandas.DataFrame
+    dqpath: a path-like object, or None to skip the log -> str
+    stats: running counts to add the results to, optional -> dict
 
     Output:
 
     unique: data without duplicates -> pandas.DataFrame
     """
 
-    #reading the raw data
-    df = pandas.read_csv(datapath)
+    #reading the raw data, unless it was parsed already
+    df = raw if isinstance(raw, pandas.DataFrame) else pandas.read_csv(raw)
 
     #collecting timestap for current run
     current_time = str(datetime.now())
 
     #we first check for entire rows that are repeated (double entry etc.)
-    df["duplicate"] = df.duplicated(keep=False)
-    count_duplicates = df["duplicate"].sum()
-    with open(dqpath, "w") as report:
-        report.write("Data quality report for the run at {}.\n\nThere were {} duplicate rows. They have been dropped\n".format(current_time, count_duplicates)) 
+    duplicate = df.duplicated(keep=False)
+    count_duplicates = duplicate.sum()
 
     #the main ID is address, so as a second step we check that it is unique too
-    df["duplicate_address"] = df.duplicated("address", keep=False)
-    duplicate_address = df["duplicate_address"].sum()
-    with open(dqpath, "a") as report:
-        report.write("There were {} duplicate keys. These have been dropped.\n".format(duplicate_address))
+    duplicate_address = df.duplicated("address", keep=False)
+    count_address = duplicate_address.sum()
 
-    unique = df[(df["duplicate"]==False) & (df["duplicate_address"]==False)].drop(["duplicate", "duplicate_address"], axis=1).reset_index(drop=True)
+    unique = df[(duplicate==False) & (duplicate_address==False)].reset_index(drop=True)
+
+    #the same listing is often scraped with its address written
+    #slightly differently; only the first of those with the same
+    #normalized address is kept. As two listings may also just have
+    #close addresses, those are flagged rather than dropped
+    variants, canonical = nearDuplicates(unique["address"])
+    near = canonical>=0
+
+    writeHeader(dqpath, current_time)
+    logStage("uniqueness", {"duplicate_rows":int(count_duplicates), "duplicate_keys":int(count_address), "address_variants":int(variants.sum()),
+                            "near_duplicates":int(near.sum())}, dqpath, stats)
+
+    unique["FLAG_NEAR_DUPLICATE"] = near
+    unique["NEAR_DUPLICATE_OF"] = pandas.Series(unique["address"].to_numpy(dtype=object)[canonical], dtype=object).where(near)
+    unique = unique[variants==False].reset_index(drop=True)
 
     return unique
 
-def validity(data, dqpath):
+def nearDuplicates(addresses):
+    """
+    Finds the addresses that are variants or near-duplicates of an
+    earlier one. Addresses with the same normalized key are variants
+    of the first one. The others are sorted by block and key, and 
+    each is only compared with the next few in the same block (sorted
+    neighbourhood), so the cost grows with the number of addresses 
+    rather than with the number of pairs. Near-duplicates are grouped
+    through every match, and each points to the first address of its
+    group.
+
+    Input:
+
+    addresses: the address column, without exact duplicates -> pandas.Series
+
+    Output:
+
+    variants: True for each variant of an earlier key -> numpy.ndarray
+    canonical: the position of the first address of each
+    near-duplicate's group, -1 for the others -> numpy.ndarray
+    """
+
+    keys = logic.addressKey(addresses)
+    variants = (keys.duplicated(keep="first") & keys.notna()).to_numpy()
+    group = numpy.arange(len(keys))
+
+    candidates = pandas.DataFrame({"block":logic.addressBlock(keys).to_numpy(), "key":keys.to_numpy(), "position":group})
+    candidates = candidates[(variants==False) & keys.notna().to_numpy()].sort_values(["block", "key"], kind="stable")
+    blocks = candidates["block"].to_numpy()
+    keys = candidates["key"].to_numpy()
+    positions = candidates["position"].to_numpy()
+
+    for offset in range(1, logic.ADDRESS_WINDOW):
+        for i in numpy.flatnonzero(blocks[offset:]==blocks[:-offset]):
+            j = i + offset
+            matcher = SequenceMatcher(None, keys[i], keys[j])
+            if matcher.quick_ratio()>=logic.ADDRESS_SIMILARITY and matcher.ratio()>=logic.ADDRESS_SIMILARITY:
+                first, second = positions[i], positions[j]
+                while group[first]!=first:
+                    first = group[first]
+                while group[second]!=second:
+                    second = group[second]
+                group[max(first, second)] = min(first, second)
+
+    #each address points to an earlier one, so going up in order
+    #leaves every address pointing to the first of its group
+    for position in numpy.flatnonzero(group!=numpy.arange(len(group))):
+        group[position] = group[group[position]]
+    canonical = numpy.where(group!=numpy.arange(len(group)), group, -1)
+
+    return variants, canonical
+
+def hashRows(chunk):
+    """
+    Hashes every row of a chunk, and its address, to 64 bits. The
+    chunk is expected to be read as strings so that the same row
+    always hashes the same, whichever chunk it comes from.
+
+    Input:
+
+    chunk: a chunk of the raw data read as strings -> pandas.DataFrame
+
+    Output:
+
+    rows: a hash per row -> numpy.ndarray
+    keys: a hash per address -> numpy.ndarray
+    """
+
+    rows = pandas.util.hash_pandas_object(chunk, index=False).to_numpy()
+    keys = pandas.util.hash_pandas_object(chunk["address"], index=False).to_numpy()
+
+    return rows, keys
+
+def scanDuplicates(datapath, chunksize):
+    """
+    First pass of the streaming mode. Reads the raw data chunk by
+    chunk and keeps only 64-bit hashes of each row, address and 
+    address block, from which the hashes seen more than once are 
+    found. The few rows that may be near-duplicates are then looked
+    at by scanNearDuplicates. It also
+    infers which columns are numeric and collects the distinct 
+    values of the categorical columns, so that every chunk of the 
+    second pass gets the same types and dummies.
+
+    Input:
+
+    datapath: a path-like object -> str
+    chunksize: the number of rows per chunk -> int
+
+    Output:
+
+    scan: duplicated hashes, near-duplicate rows, counts, column types
+    and categories -> dict
+    """
+
+    rowHashes = []
+    keyHashes = []
+    blockHashes = []
+    types = {}
+    categories = {c: set() for c in ["housing_type", "housing_status", "construction_type", "energy_label", "garden", "garage"]}
+
+    for chunk in pandas.read_csv(datapath, dtype=str, chunksize=chunksize):
+        rows, keys = hashRows(chunk)
+        rowHashes.append(rows)
+        keyHashes.append(keys)
+        blockHashes.append(pandas.util.hash_pandas_object(logic.addressBlock(logic.addressKey(chunk["address"])), index=False).to_numpy())
+
+        #a column stays numeric only if every chunk parses as numbers,
+        #and integer only if every chunk is whole and complete
+        for column in chunk.columns:
+            values = pandas.to_numeric(chunk[column], errors="coerce")
+            if values.notna().sum()!=chunk[column].notna().sum():
+                types[column] = "str"
+            elif types.get(column)!="str":
+                integer = values.notna().all() and (values%1==0).all()
+                types[column] = "int64" if integer and types.get(column, "int64")=="int64" else "float64"
+
+        for column in categories.keys():
+            categories[column].update(chunk[column].dropna().unique())
+
+    scan = {"types": {c: t for c, t in types.items() if t!="str"}, "categories": categories}
+
+    hashes = {}
+    for name, chunks in [("rows", rowHashes), ("keys", keyHashes), ("blocks", blockHashes)]:
+        hashes[name] = numpy.concatenate(chunks) if len(chunks)>0 else numpy.array([], dtype=numpy.uint64)
+        values, counts = numpy.unique(hashes[name], return_counts=True)
+        scan[name] = values[counts>1]
+
+    for name in ["rows", "keys"]:
+        scan["duplicate_" + name] = int(numpy.isin(hashes[name], scan[name]).sum())
+
+    #near-duplicates can only be found among the rows left, in a
+    #block holding more than one of them
+    left = (numpy.isin(hashes["rows"], scan["rows"])==False) & (numpy.isin(hashes["keys"], scan["keys"])==False)
+    values, counts = numpy.unique(hashes["blocks"][left], return_counts=True)
+    candidates = numpy.flatnonzero(left & numpy.isin(hashes["blocks"], values[counts>1]))
+
+    scan["variants"], scan["near"] = scanNearDuplicates(datapath, chunksize, candidates)
+    scan["address_variants"] = len(scan["variants"])
+    scan["near_duplicates"] = len(scan["near"])
+
+    return scan
+
+def scanNearDuplicates(datapath, chunksize, candidates):
+    """
+    Reads the addresses of the rows that may be variants or 
+    near-duplicates, and only those, from the raw data and finds them.
+    As each candidate comes with every other row of its block, the 
+    result matches nearDuplicates run on the entire file.
+
+    Input:
+
+    datapath: a path-like object -> str
+    chunksize: the number of rows per chunk -> int
+    candidates: the positions of the candidate rows in the file -> numpy.ndarray
+
+    Output:
+
+    variants: the positions of the variants in the file -> numpy.ndarray
+    near: the address each near-duplicate resembles, by position in 
+    the file -> pandas.Series
+    """
+
+    if len(candidates)==0:
+        return candidates, pandas.Series(dtype=object)
+
+    addresses = []
+    for chunk in pandas.read_csv(datapath, dtype=str, usecols=["address"], chunksize=chunksize):
+        addresses.append(chunk["address"][numpy.isin(chunk.index.to_numpy(), candidates)])
+    addresses = pandas.concat(addresses)
+
+    variants, canonical = nearDuplicates(addresses)
+    positions = addresses.index.to_numpy()
+    near = pandas.Series(addresses.to_numpy(dtype=object)[canonical[canonical>=0]], index=positions[canonical>=0], dtype=object)
+
+    return positions[variants], near
+
+def dropDuplicates(chunk, scan):
+    """
+    Second pass of the streaming mode. Drops the rows of a chunk
+    whose row or address hash was seen more than once in the whole 
+    file and the address variants found by scanDuplicates, and flags
+    its near-duplicates, then
+    gives each column the type found by scanDuplicates.
+    The result matches uniqueness run on the entire file.
+
+    Input:
+
+    chunk: a chunk of the raw data read as strings -> pandas.DataFrame
+    scan: the output of scanDuplicates -> dict
+
+    Output:
+
+    unique: the chunk without duplicates -> pandas.DataFrame
+    """
+
+    rows, keys = hashRows(chunk)
+    keep = (numpy.isin(rows, scan["rows"])==False) & (numpy.isin(keys, scan["keys"])==False) & (numpy.isin(chunk.index.to_numpy(), scan["variants"])==False)
+    near = scan["near"].reindex(chunk.index).to_numpy(dtype=object)
+
+    unique = chunk[keep].reset_index(drop=True)
+    for column, dtype in scan["types"].items():
+        unique[column] = pandas.to_numeric(unique[column]).astype(dtype)
+    unique["FLAG_NEAR_DUPLICATE"] = pandas.notna(near[keep])
+    unique["NEAR_DUPLICATE_OF"] = pandas.Series(near[keep], dtype=object)
+
+    return unique
+
+def validity(data, dqpath, stats=None):
     """
     Checks unique data rows for invalid entries. These entries are
-    flagged and the invalid field is marked for analytics purposes.
-    Then the invalid value is replaced by NaN so that it may be 
+    flagged and every invalid field of the row is marked in a bitmask
+    for analytics purposes, one bit per rule (see logic.VALIDITY_BITS).
+    Then the invalid values are replaced by NaN so that they may be 
     treated as missing in following steps. The results are logged
     to a text file.
 
     Input:
 
     data: a dataset previously checked for uniqueness -> pandas.DataFrame
-    dqpath: a path-like object -> str
+    dqpath: a path-like object, or None to skip the log -> str
+    stats: running counts to add the results to, optional -> dict
 
     Output:
 
@@ -63,33 +369,42 @@ def validity(data, dqpath):
     #we set conditions for validity of each column
     conditions = logic.conditionsValidity(data)
 
-    #we create two flag columns to identify invalid entries
-    #and which field is invalid
-    data["FLAG_WAS_INVALID"] = 0
-    data["FLAG_INVALID_FIELD"] = ""
+    #each rule is evaluated once into a column of a boolean matrix,
+    #a value only being invalid if it is there at all
+    fields = logic.VALIDITY_FIELDS
+    failed = numpy.column_stack([(conditions[column]==False).to_numpy() & data[column].notna().to_numpy() for column in fields])
 
-    #we use the conditions to fill in the flags
-    for column in list(conditions.keys()):
+    #we create two flag columns to identify invalid entries
+    #and which fields are invalid
+    weights = numpy.array([logic.VALIDITY_BITS[column] for column in fields], dtype=logic.VALIDITY_MASK_DTYPE)
+    data["FLAG_INVALID_FIELDS"] = failed.astype(logic.VALIDITY_MASK_DTYPE) @ weights
+    data["FLAG_WAS_INVALID"] = data["FLAG_INVALID_FIELDS"]!=0
 
-        data.loc[(conditions[column]==False)&(data[column].isna()==False), "FLAG_WAS_INVALID"] = 1
-        data.loc[(conditions[column]==False)&(data[column].isna()==False), "FLAG_INVALID_FIELD"] = column
-        data.loc[(conditions[column]==False)&(data[column].isna()==False), column] = numpy.nan
+    #the invalid values of every column are blanked in one go
+    perField = failed.sum(axis=0)
+    touched = [column for column, count in zip(fields, perField) if count>0]
+    if len(touched)>0:
+        data[touched] = data[touched].mask(pandas.DataFrame(failed[:, perField>0], columns=touched, index=data.index))
 
     #we calculate the number of invalid observations and 
     #isolate invalid fields
     totalInvalid = data["FLAG_WAS_INVALID"].sum()
-    invalidFields = data["FLAG_INVALID_FIELD"][data["FLAG_WAS_INVALID"]==1].unique()
+    invalidCounts = {column: int(count) for column, count in zip(fields, perField) if count>0}
 
     #we write all this info down
-    with open(dqpath, "a") as report:
-        report.write("There were {} rows with invalid entries.\nThe invalid fields are: {}.\n".format(totalInvalid, invalidFields))
+    logStage("validity", {"invalid_rows":int(totalInvalid), "invalid_fields":list(invalidCounts.keys()), "invalid_counts":invalidCounts}, dqpath, stats)
+
+    #the enumerated columns only hold valid values now, so each one
+    #is stored once as a category
+    for column in logic.ENUMERATED:
+        data[column] = data[column].astype("category")
 
     valid = data.copy()
 
     return valid
 
 
-def completeness(data, dqpath):
+def completeness(data, dqpath, stats=None):
     """
     Checks unique and valid data rows for missing values, dropping rows
     where these render the row useless or otherwise using flags to 
@@ -99,7 +414,8 @@ def completeness(data, dqpath):
     Input:
 
     data: a dataset previously checked for uniqueness and validity -> pandas.DataFrame
-    dqpath: a path-like object -> str
+    dqpath: a path-like object, or None to skip the log -> str
+    stats: running counts to add the results to, optional -> dict
 
     Output:
 
@@ -111,22 +427,50 @@ def completeness(data, dqpath):
 
     #we use the conditions to fill in the flags
     for column in list(conditions.keys()):
-        data[conditions[column][1]] = 0
-        data.loc[(data[column].isna())&(conditions[column][0]), conditions[column][1]] = 1
+        data[conditions[column][1]] = False
+        data.loc[(data[column].isna())&(conditions[column][0]), conditions[column][1]] = True
     
     #we calculate the total number of missing values and those explained by flags
     totalMissing = sum([data[column].isna().sum() for column in list(conditions.keys())])
     totalExplained = sum([data[conditions[column][1]][data[column].isna()].sum() for column in list(conditions.keys())])
 
     #we write all this info down
-    with open(dqpath, "a") as report:
-        report.write("There were {} missing values.\nOf these, {} could be explained by flags.\n".format(totalMissing, totalExplained))
+    logStage("completeness", {"missing":int(totalMissing), "explained":int(totalExplained)}, dqpath, stats)
 
     flagged = data[data["price"].isna()==False].reset_index(drop=True)
 
     return flagged
 
-def runDataQuality(datapath, dqpath):
+def checkQuality(raw):
+    """
+    Dry run of the data quality pipeline. The three steps run as in
+    runDataQuality, but nothing is written or sent: their counts are
+    returned instead, with the number of rows checked and of rows
+    that would be kept.
+
+    Input:
+
+    raw: the parsed raw data -> pandas.DataFrame
+
+    Output:
+
+    report: the counts of every step -> dict
+    """
+
+    missing = [column for column in logic.VALIDITY_FIELDS if column not in raw.columns]
+    if len(missing)>0:
+        raise KeyError("The data lacks the columns {}.".format(", ".join(missing)))
+
+    stats = {}
+    unique = uniqueness(raw, None, stats)
+    valid = validity(unique, None, stats)
+    complete = completeness(valid, None, stats)
+
+    report = dict(stats, rows=len(raw), rows_kept=len(complete))
+
+    return report
+
+def runDataQuality(raw, dqpath):
     """
     Wrapper function for the data quality pipeline. It consists of
     three steps:
@@ -136,25 +480,29 @@ def runDataQuality(datapath, dqpath):
     3) Completeness: checks for missing values and flags them if possible
 
     These steps are used to fill in a log which can be found in the
-    data quality folder and are also sent via webhook.
+    data quality folder and are also sent via webhook. Their counts
+    are returned so that they are only added to the running totals of
+    every run once the rows are stored.
 
     Input:
 
-    datapath: a path-like object -> str
+    raw: a path-like object or the parsed raw data -> str | pandas.DataFrame
     dqpath: a path-like object -> str
 
     Output:
 
     complete: a pandas.DataFrame object -> pandas.DataFrame
+    stats: the counts of every step -> dict
     """
 
-    unique = uniqueness(datapath, dqpath)
-    valid = validity(unique, dqpath)
-    complete = completeness(valid, dqpath)
+    stats = {}
+    unique = uniqueness(raw, dqpath, stats)
+    valid = validity(unique, dqpath, stats)
+    complete = completeness(valid, dqpath, stats)
 
     utils.sendWebhook(dqpath)
 
-    return complete
+    return complete, stats
 
 
 
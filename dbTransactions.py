@@ -1,40 +1,534 @@
-from sqlalchemy import create_engine
-from sqlalchemy import Table, Column,  MetaData, Integer, String, Float, Boolean, insert
+from sqlalchemy import create_engine, inspect, text, true
+from sqlalchemy import Table, Column,  MetaData, Integer, SmallInteger, String, Float, Boolean, Index, insert, select, delete, update, func
+from datetime import datetime
+import os
+import io
+import threading
 import pandas
 import numpy
 import utils
 
+#rows per insert batch, each batch is committed on its own
+BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", "10000"))
+
+#the clean listings of every run are appended to one fact table, tagged
+#with the run that loaded them, and the runs are listed in a catalog
+FACT_TABLE = os.environ.get("FACT_TABLE", "openred_listings")
+CATALOG_TABLE = os.environ.get("CATALOG_TABLE", "openred_runs")
+
+#SQL type of each pandas dtype; the compact dtypes of flags, dummies
+#and counts keep their size in the table
+TYPES = {'object': String(), 
+         'str': String(),
+         'category': String(),
+         'float64': Float(),
+         'float32': Float(),
+         'int64': Integer(),
+         'int32': Integer(),
+         'int16': SmallInteger(),
+         'Int16': SmallInteger(),
+         'int8': SmallInteger(),
+         'uint8': SmallInteger(),
+         'bool': Boolean()}
+
+#one engine, and its connection pool, is shared by the whole process
+ENGINE = None
+
+#tables already known to the process, so each is reflected at most once
+TABLES = {}
+LOCK = threading.Lock()
+
+#DDL on the fact table is made by one job at a time
+DDL_LOCK = threading.Lock()
+
+#hashes of the addresses stored in each table, or in each snapshot of
+#the fact table, loaded once per process and kept up to date by bulk_insert
+ADDRESSES = {}
+INDEXED = set()
+ADDRESS_LOCK = threading.Lock()
+
+def get_engine():
+    """
+    Returns the engine shared by the whole process, creating it on
+    first use.
+    """
+
+    global ENGINE
+
+    with LOCK:
+        if ENGINE is None:
+            ENGINE = create_engine(os.environ["SQL_ACCESSKEY"], pool_pre_ping=True)
+
+    return ENGINE
+
+def dispose_engine():
+    """
+    Closes the pooled connections and forgets the cached tables.
+    """
+
+    global ENGINE
+
+    with LOCK:
+        if ENGINE is not None:
+            ENGINE.dispose()
+        ENGINE = None
+        TABLES.clear()
+    with ADDRESS_LOCK:
+        ADDRESSES.clear()
+        INDEXED.clear()
+
+def get_table(name, engine):
+    """
+    Returns a table of the database, reflecting only that table the
+    first time it is asked for.
+    """
+
+    with LOCK:
+        if name not in TABLES:
+            TABLES[name] = Table(name, MetaData(), autoload_with=engine)
+
+        return TABLES[name]
+
+def latest_table(engine):
+    """
+    Returns the name of the clean table with the highest number, as
+    tables were picked before the schema registry. Names are sorted 
+    as text by the database, so openred_clean_10 comes before
+    openred_clean_9 and the number has to be compared instead.
+    """
+
+    names = [x for x in inspect(engine).get_table_names() if x.startswith("openred_clean_") and x[len("openred_clean_"):].isdigit()]
+    if len(names)==0:
+        raise KeyError("No schema is registered yet, /start has to run first!")
+
+    return max(names, key=lambda x: int(x[len("openred_clean_"):]))
+
 def generate_sql_table(df, name, engine):
     """
     Generates a SQL table out of a pandas DataFrame.
     """
 
     metadata = MetaData()
-
-    type_dict = {'object': String(), 
-                 'float64': Float(),
-                 'int64': Integer()}
     
     type_list = [str(x) for x in df.dtypes]
-    column_types = [type_dict[x] for x in type_list]
+    column_types = [TYPES[x] for x in type_list]
 
     #creating the sensor data table with strings to account for missing values
     #but saving the type for each column
 
     string_dict = {c : Column(c, t) for (c, t) in zip(list(df), column_types)}
+    indexes = []
+
+    #rows of a table holding several runs get a key of their own, which
+    #query pages are resumed by, as the address of a listing may be missing
+    if "run_id" in string_dict and "listing_id" not in string_dict:
+        string_dict = {"listing_id": Column("listing_id", Integer, primary_key=True, autoincrement=True), **string_dict}
 
-    struct = Table(name, metadata, *list(string_dict.values()))
+    #address is the key of a listing, so it is indexed for deduplication,
+    #within each run when the table holds several
+    if "run_id" in string_dict and "address" in string_dict:
+        indexes.append(Index("ix_{}_run_address".format(name), "run_id", "address"))
+    elif "address" in string_dict:
+        string_dict["address"] = Column("address", string_dict["address"].type, index=True)
+
+    struct = Table(name, metadata, *list(string_dict.values()), *indexes)
 
     metadata.create_all(engine)
+
+    #the new table replaces any cached definition, and as it is empty 
+    #no address has to be loaded for it
+    with LOCK:
+        TABLES[name] = struct
+    with ADDRESS_LOCK:
+        ADDRESSES[name] = set()
+        INDEXED.add(name)
     
     return struct
 
-def bulk_insert(df, table, connection):
+def fact_table(df, engine):
     """
-    Inserts a pandas DataFrame to an existing SQL table.
+    Returns the fact table holding the clean listings of every run.
+    It is created from the first run; later runs bringing columns it
+    lacks, such as new dummies, add them, and the rows of earlier
+    runs hold NULL there. Nothing is scanned or listed on the way.
+    Concurrent jobs wait for each other, so a column is added once.
+    """
+
+    with DDL_LOCK:
+        with LOCK:
+            table = TABLES.get(FACT_TABLE)
+
+        if table is None and inspect(engine).has_table(FACT_TABLE)==False:
+            return generate_sql_table(df, FACT_TABLE, engine)
+
+        table = get_table(FACT_TABLE, engine)
+        missing = [c for c in df.columns if c not in table.c]
+        if len(missing)==0:
+            return table
+
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.begin() as conn:
+            for c in missing:
+                conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(quote(FACT_TABLE), quote(c), TYPES[str(df[c].dtype)].compile(dialect=engine.dialect))))
+
+        #the table is reflected again to pick up the new columns
+        with LOCK:
+            TABLES.pop(FACT_TABLE, None)
+
+        return get_table(FACT_TABLE, engine)
+
+def run_catalog(engine):
+    """
+    Returns the run catalog, creating it on first use. Each run of
+    /start or /insert gets a row; a /start opens a snapshot, which 
+    the /insert runs after it extend.
+    """
+
+    with LOCK:
+        if CATALOG_TABLE in TABLES:
+            return TABLES[CATALOG_TABLE]
+
+    metadata = MetaData()
+    struct = Table(CATALOG_TABLE, metadata,
+                   Column("run_id", Integer, primary_key=True, autoincrement=True),
+                   Column("kind", String),
+                   Column("snapshot", Integer, index=True),
+                   Column("started", String),
+                   Column("finished", String),
+                   Column("rows_received", Integer),
+                   Column("rows_stored", Integer),
+                   Column("schema_version", String))
+    metadata.create_all(engine)
+
+    with LOCK:
+        TABLES[CATALOG_TABLE] = struct
+
+    return struct
+
+def open_run(engine, kind, snapshot=None, schema_version=None):
+    """
+    Adds a run to the catalog and returns its run_id. A /start run is
+    its own snapshot. The id comes from the catalog's key, so opening
+    a run never reads the runs before it.
+    """
+
+    catalog = run_catalog(engine)
+
+    with engine.begin() as conn:
+        run_id = conn.execute(insert(catalog).values(kind=kind, snapshot=snapshot, started=str(datetime.now()),
+                                                     schema_version=schema_version)).inserted_primary_key[0]
+        if snapshot is None:
+            conn.execute(update(catalog).where(catalog.c.run_id==run_id).values(snapshot=run_id))
+
+    #a new snapshot holds no address yet
+    if snapshot is None:
+        with ADDRESS_LOCK:
+            ADDRESSES[address_scope(FACT_TABLE, run_id)] = set()
+
+    return run_id
+
+def close_run(engine, run_id, **fields):
+    """
+    Records the outcome of a run in the catalog, e.g. its row counts.
+    """
+
+    catalog = run_catalog(engine)
+
+    with engine.begin() as conn:
+        conn.execute(update(catalog).where(catalog.c.run_id==run_id).values(finished=str(datetime.now()), **fields))
+
+def snapshot_runs(engine, snapshot):
+    """
+    Returns the run_ids of the runs making up a snapshot, read from
+    the catalog through its snapshot index.
+    """
+
+    catalog = run_catalog(engine)
+
+    with engine.connect() as conn:
+        runs = list(conn.execute(select(catalog.c.run_id).where(catalog.c.snapshot==snapshot)).scalars())
+
+    return runs
+
+def address_scope(name, snapshot=None):
+    """
+    Names the set of addresses deduplication works within: a whole
+    table, or a single snapshot of the fact table.
+    """
+
+    return name if snapshot is None else "{}:{}".format(name, snapshot)
+
+def conform_batch(df, table, start, stop):
+    """
+    Returns rows start to stop of a pandas DataFrame with the types of
+    the table's columns. A batch with a missing value holds an integer
+    column as float, which would be written out as 902000.0; such 
+    columns go back to nullable integers.
+    """
+
+    batch = df.iloc[start:stop]
+
+    integers = [c for c in batch.columns if isinstance(table.c[c].type, Integer) and pandas.api.types.is_float_dtype(batch[c].dtype)]
+    if len(integers)>0:
+        batch = batch.assign(**{c: batch[c].round().astype("Int64") for c in integers})
+
+    return batch
+
+#placeholders of each DBAPI paramstyle, by position
+PLACEHOLDERS = {"qmark": lambda i: "?",
+                "format": lambda i: "%s",
+                "pyformat": lambda i: "%s",
+                "numeric": lambda i: ":{}".format(i + 1),
+                "named": lambda i: ":p{}".format(i)}
+
+def batch_rows(batch):
+    """
+    Turns a batch into one tuple per row, reading the column arrays
+    directly. Missing values become None and numpy scalars become
+    Python ones, as every driver expects.
+    """
+
+    columns = []
+    for c in batch.columns:
+        values = batch[c]
+        if values.hasnans:
+            values = values.astype(object).where(values.notna(), None)
+        columns.append(values.tolist())
+
+    rows = list(zip(*columns))
+
+    return rows
+
+def executemany_batch(batch, table, connection):
+    """
+    Loads a batch with the driver's own executemany, skipping
+    SQLAlchemy's per-row parameter handling; drivers such as MySQL's
+    rewrite it into multi-row VALUES. The statement runs in the
+    connection's transaction.
+    """
+
+    quote = connection.dialect.identifier_preparer.quote
+    placeholder = PLACEHOLDERS[connection.dialect.paramstyle]
+    columns = ", ".join(quote(c) for c in batch.columns)
+    values = ", ".join(placeholder(i) for i in range(len(batch.columns)))
+    query = "INSERT INTO {} ({}) VALUES ({})".format(quote(table.name), columns, values)
+
+    rows = batch_rows(batch)
+    if connection.dialect.paramstyle=="named":
+        rows = [{"p{}".format(i): v for i, v in enumerate(row)} for row in rows]
+
+    connection.exec_driver_sql(query, rows)
+
+def copy_batch(batch, table, connection):
+    """
+    Loads a batch into a PostgreSQL table with COPY FROM STDIN, the
+    fastest path PostgreSQL offers. Works with both psycopg2 and 
+    psycopg 3. The cursor belongs to the connection's transaction, 
+    which is committed by the caller.
+    """
+
+    quote = connection.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(c) for c in batch.columns)
+    query = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(quote(table.name), columns)
+
+    data = batch.to_csv(header=False, index=False, na_rep="\\N")
+
+    cursor = connection.connection.cursor()
+    try:
+        if connection.dialect.driver=="psycopg2":
+            cursor.copy_expert(query, io.StringIO(data))
+        else:
+            with cursor.copy(query) as copy:
+                copy.write(data)
+    finally:
+        cursor.close()
+
+def bulk_insert(df, table, connection, batch_size=BATCH_SIZE, start=0, progress=None, scope=None, run_id=None):
+    """
+    Inserts a pandas DataFrame to an existing SQL table, in batches
+    of batch_size rows. PostgreSQL gets COPY FROM STDIN; the other 
+    dialects the driver's executemany. Each batch gets the column
+    types of the table first.
+
+    If the caller opened a transaction on the connection, every batch
+    runs in it and nothing is committed here. Otherwise each batch is
+    committed on its own, together with the rows_stored of run_id in
+    the run catalog, so a load that stopped can be resumed by passing
+    that count as start. After each batch progress is called with
+    the number of rows loaded so far. The addresses inserted are
+    added to the deduplication set of scope, by default the table.
+
+    Returns the number of rows inserted, start included.
     """
     
-    dummy_records = df.to_dict("records")
-    query = insert(table)
-    Result = connection.execute(query, dummy_records)
-    connection.commit()
\ No newline at end of file
+    #an empty list of records would insert a single row of NULLs
+    if len(df)<=start:
+        return start
+
+    copy = connection.dialect.name=="postgresql" and connection.dialect.driver in ["psycopg2", "psycopg"]
+    owned = connection.in_transaction()==False
+    catalog = run_catalog(connection.engine) if owned and run_id is not None else None
+
+    done = start
+    while done < len(df):
+        stop = min(done + batch_size, len(df))
+        batch = conform_batch(df, table, done, stop)
+
+        if owned:
+            connection.begin()
+
+        if copy:
+            copy_batch(batch, table, connection)
+        else:
+            executemany_batch(batch, table, connection)
+
+        if catalog is not None:
+            connection.execute(update(catalog).where(catalog.c.run_id==run_id).values(rows_stored=func.coalesce(catalog.c.rows_stored, 0) + len(batch)))
+
+        if owned:
+            connection.commit()
+
+        remember_addresses(scope or table.name, batch["address"] if "address" in batch.columns else [])
+
+        done = stop
+        if progress is not None:
+            progress(done)
+
+    return done
+
+def address_hashes(values):
+    """
+    Hashes addresses to 64 bits, skipping missing ones.
+    """
+
+    values = pandas.Series(values, dtype=object).dropna()
+
+    return pandas.util.hash_array(values.to_numpy(dtype=object))
+
+def ensure_address_index(table, engine):
+    """
+    Creates the index on the address column of a table, if it does
+    not exist yet. Tables created before the index was introduced
+    get it the first time they are deduplicated against; the fact
+    table has its (run_id, address) index from the start.
+    """
+
+    with ADDRESS_LOCK:
+        if table.name in INDEXED or "run_id" in table.c:
+            return
+        Index("ix_{}_address".format(table.name), table.c.address).create(engine, checkfirst=True)
+        INDEXED.add(table.name)
+
+def in_scope(table, runs):
+    """
+    Restricts a query on a table to the rows of some runs, or to no
+    restriction at all if runs is None.
+    """
+
+    return true() if runs is None else table.c.run_id.in_(runs)
+
+def known_addresses(table, engine, runs=None, scope=None):
+    """
+    Returns the set of address hashes stored in a table, or only in
+    the rows of some runs. The first call reads the address column
+    once; after that the set lives in the process and bulk_insert 
+    adds to it.
+    """
+
+    scope = scope or table.name
+
+    with ADDRESS_LOCK:
+        if scope not in ADDRESSES:
+            hashes = set()
+            with engine.connect() as conn:
+                result = conn.execution_options(stream_results=True).execute(select(table.c.address).where(in_scope(table, runs)))
+                for batch in result.partitions(BATCH_SIZE):
+                    hashes.update(address_hashes([row[0] for row in batch]).tolist())
+            ADDRESSES[scope] = hashes
+
+        return ADDRESSES[scope]
+
+def remember_addresses(scope, values):
+    """
+    Adds addresses that were just inserted to the set of a scope,
+    if that set was loaded.
+    """
+
+    with ADDRESS_LOCK:
+        if scope in ADDRESSES:
+            ADDRESSES[scope].update(address_hashes(values).tolist())
+
+def deduplicate(df, table, engine, mode="skip", snapshot=None):
+    """
+    Checks the addresses of a batch against those already stored in
+    a table, or in a snapshot of the fact table. The in-process hash
+    set narrows the batch down to likely matches, which are then 
+    confirmed with an indexed lookup, so the cost follows the batch 
+    size rather than the table size.
+
+    With mode "skip" the listings already stored are dropped from the
+    batch; with mode "upsert" the batch is kept whole, to replace 
+    them through replace_rows.
+
+    Returns the batch to insert and the addresses that were already
+    stored.
+    """
+
+    if mode not in ["skip", "upsert"]:
+        raise ValueError("Unknown deduplication mode {}.".format(mode))
+
+    ensure_address_index(table, engine)
+    runs = None if snapshot is None else snapshot_runs(engine, snapshot)
+    scope = address_scope(table.name, snapshot)
+    known = known_addresses(table, engine, runs, scope)
+
+    addresses = df["address"]
+    hashes = pandas.util.hash_array(addresses.to_numpy(dtype=object)).tolist()
+    with ADDRESS_LOCK:
+        likely = numpy.array([h in known for h in hashes], dtype=bool)
+    candidates = addresses[addresses.notna().to_numpy() & likely]
+
+    stored = set()
+    with engine.connect() as conn:
+        for start in range(0, len(candidates), 1000):
+            batch = candidates.iloc[start:start + 1000].tolist()
+            where = table.c.address.in_(batch) & in_scope(table, runs)
+            stored.update(conn.execute(select(table.c.address).where(where)).scalars())
+
+    if mode=="upsert":
+        return df, sorted(stored)
+
+    existing = addresses.isin(stored)
+
+    return df[existing==False].reset_index(drop=True), sorted(stored)
+
+def replace_rows(df, stored, table, engine, snapshot=None, progress=None, scope=None):
+    """
+    Replaces the stored rows of some addresses with a batch in one
+    transaction: the stored rows are deleted and the batch inserted, 
+    or, if anything fails, neither. The runs losing rows have their
+    rows_stored lowered in the catalog in the same transaction.
+
+    Returns the number of rows inserted.
+    """
+
+    runs = None if snapshot is None else snapshot_runs(engine, snapshot)
+    catalog = None if snapshot is None else run_catalog(engine)
+
+    with engine.connect() as conn:
+        conn.begin()
+
+        for start in range(0, len(stored), 1000):
+            where = table.c.address.in_(stored[start:start + 1000]) & in_scope(table, runs)
+            if catalog is not None:
+                counts = conn.execute(select(table.c.run_id, func.count()).where(where).group_by(table.c.run_id)).all()
+                for run_id, n in counts:
+                    conn.execute(update(catalog).where(catalog.c.run_id==run_id).values(rows_stored=catalog.c.rows_stored - n))
+            conn.execute(delete(table).where(where))
+
+        #the addresses deleted are inserted again, so the deduplication
+        #set stays as it is
+        rows = bulk_insert(df, table, conn, progress=progress, scope=scope)
+        conn.commit()
+
+    return rows
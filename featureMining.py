@@ -1,7 +1,9 @@
+import re
 import pandas
 import numpy
 import utils
 import logic
+import aggregates
 from datetime import datetime
 
 def extractFeaturesNumerics(df, fmpath):
@@ -15,7 +17,7 @@ def extractFeaturesNumerics(df, fmpath):
     Input:
 
     df: a dataset which has already passed Data Quality -> pandas.DataFrame
-    fmpath: a path-like object -> str
+    fmpath: a path-like object, or None to skip the log -> str
 
     Output: 
 
@@ -30,28 +32,152 @@ def extractFeaturesNumerics(df, fmpath):
     conditions = logic.conditionsFeatureMining(df)
 
     #we use the conditions to generate the new columns
-    for column in list(conditions.keys()):
-        df[conditions[column][1]] = conditions[column][0]
+    for feature in list(conditions.keys()):
+        df[feature] = conditions[feature]
 
     #we write a log
-    with open(fmpath, "w") as report:
-        report.write("Feature Engineering for the run on {}.\n\nThe numerical part finished without errors.\n".format(current_time))
+    if fmpath is not None:
+        with open(fmpath, "w") as report:
+            report.write("Feature Engineering for the run on {}.\n\nThe numerical part finished without errors.\n".format(current_time))
 
     numerics = df.copy()
 
     return numerics
 
 
-def extractFeaturesCategorical(df, fmpath):
+#original columns kept in the clean data, the rest are replaced by features
+KEEP_COLUMNS = ["address", "price", "description", "living_area_m2", "plot_area_m2", "volume_m3"]
+
+#categories with a single value per row, one-hot encoded as they are
+CATEGORIES = ["new_housing_type", "housing_status", "construction_type", "energy_label"]
+
+#columns that contain multiple values in a single row
+MULTI_VALUES = ["garden", "garage"]
+
+#as far as ownership is concerned, because it's just one column
+#perhaps it's not worth the pain to develop a whole logic
+OWNERSHIP = {
+             "volle_eigendom":"olle eigendom",
+             "gemeentelijke_erfpacht":"emeentelijke erfpacht",
+             "gemeentelijke_eigendom":"emeentelijke eigendom",
+             "gebruik_en_bewoning":"ebruik en bewoning",
+             "particulier_eigendom_belast":"articulier eigendom belast",
+             "belast_met_opstal":"elast met opstal",
+             "mandelig":"andelig",
+             "lidmaatschapsrecht":"idmaatschapsrecht"
+            }
+
+def groupHousingType(column):
+    """
+    Groups housing types to reduce dimensions, keeping only the
+    first word of each type. Each distinct type is split once.
+
+    Input:
+
+    column: the housing_type column -> pandas.Series
+
+    Output:
+
+    grouped: the grouped housing types -> pandas.Series
+    """
+
+    codes, uniques = pandas.factorize(column)
+    names = pandas.Series(uniques, dtype=object).str.split(" ").str[0].str.replace(",", "")
+    names = names.replace({"Beneden":"Benedenwoning", "Dubbel":"Dubbel benedenhuis"})
+
+    #missing types have code -1, which picks the NaN appended last
+    grouped = pandas.Series(numpy.append(names.to_numpy(dtype=object), numpy.nan)[codes], index=column.index)
+
+    return grouped
+
+def buildVocabulary(df):
+    """
+    Collects the categories found in a dataset, which define the
+    dummy columns. The vocabulary is built once for the master 
+    table and reused for every later batch, so they all end up 
+    with the same columns.
+
+    Input:
+
+    df: a dataset which has already passed Data Quality -> pandas.DataFrame
+
+    Output:
+
+    vocabulary: the sorted categories of each column -> dict
+    """
+
+    vocabulary = {}
+
+    for c in CATEGORIES:
+        values = groupHousingType(df["housing_type"]) if c=="new_housing_type" else df[c]
+        vocabulary[c] = sorted(str(x) for x in values.dropna().unique())
+
+    for column in MULTI_VALUES:
+        colNames = utils.separateDummies(df[column].dropna().unique())
+        colNames.discard('')
+        vocabulary[column] = sorted(colNames)
+
+    vocabulary["ownership"] = list(OWNERSHIP.keys())
+
+    return vocabulary
+
+def encodeCategoricals(df, vocabulary, dtype=logic.DUMMY_DTYPE, sparse=False):
+    """
+    Builds every dummy column described by a vocabulary. The dense
+    output is a single block allocated once; the sparse output 
+    stores only the ones.
+
+    Input:
+
+    df: a dataset with a new_housing_type column -> pandas.DataFrame
+    vocabulary: the output of buildVocabulary -> dict
+    dtype: the type of the dummies, e.g. numpy.uint8 -> numpy.dtype
+    sparse: whether to return sparse columns -> bool
+
+    Output:
+
+    dummies: the dummy columns, aligned to df -> pandas.DataFrame
+    """
+
+    masks = {}
+
+    for c in CATEGORIES:
+        codes = pandas.Categorical(df[c], categories=vocabulary[c]).codes
+        for i, value in enumerate(vocabulary[c]):
+            masks["{}_{}".format(c, value)] = codes==i
+
+    for column in MULTI_VALUES:
+        for name in vocabulary[column]:
+            masks[name] = logic.matchRule(df[column], re.compile(re.escape(name))).to_numpy()
+
+    for name in vocabulary["ownership"]:
+        masks[name] = logic.matchRule(df["ownership"], re.compile(re.escape(OWNERSHIP[name]))).to_numpy()
+
+    if sparse:
+        return pandas.DataFrame({name: pandas.arrays.SparseArray(mask.astype(dtype), fill_value=0) for name, mask in masks.items()}, index=df.index)
+
+    block = numpy.zeros((len(df), len(masks)), dtype=dtype)
+    for j, mask in enumerate(masks.values()):
+        block[:, j] = mask
+
+    dummies = pandas.DataFrame(block, columns=list(masks.keys()), index=df.index)
+
+    return dummies
+
+def extractFeaturesCategorical(df, fmpath, vocabulary=None, dtype=logic.DUMMY_DTYPE, sparse=False):
     """
     Applies binary dummies to all categorical data. This allows
     us to use each dummy as a variable in a model. The results
-    are logged in a text file.
+    are logged in a text file. When a vocabulary is given, the
+    dummies follow it instead of the categories in df.
 
     Input:
 
     df: a dataset which has already passed Data Quality -> pandas.DataFrame
-    fmpath: a path-like object -> str
+    fmpath: a path-like object, or None to skip the log -> str
+    vocabulary: the output of buildVocabulary, optional -> dict
+    dtype: the type of the dummies -> numpy.dtype
+    sparse: whether to return sparse dummies -> bool
 
     Output: 
 
@@ -59,74 +185,57 @@ def extractFeaturesCategorical(df, fmpath):
     """
 
     #grouping housing types to reduce dimensions
-    df["new_housing_type"] = [x.split(" ")[0].replace(",", "") for x in df["housing_type"]]
-    df.loc[df["new_housing_type"]=="Beneden", "new_housing_type"] = "Benedenwoning"
-    df.loc[df["new_housing_type"]=="Dubbel", "new_housing_type"] = "Dubbel benedenhuis"
-
-    #we can easily use pandas to create dummies for all columns
-    #that have a single value
-    categories = ["new_housing_type", "housing_status", "construction_type", "energy_label"]
-
-    for c in categories:
-        dummies = pandas.get_dummies(df[c], prefix=c, dtype=int)
-        df = pandas.concat([df, dummies], axis=1)
-
-    #there are other columns that contain multiple values; we 
-    #have to approach them differently
-    multiValues = ["garden", "garage"]
-
-    for column in multiValues:
-        colNames = utils.separateDummies(column)
-        colNames.remove('')
-        for name in colNames:
-            df[name] = [1 if name in x else 0 for x in df[column].fillna("no info")]
-
-    #as far as ownership is concerned, because it's just one column
-    #perhaps it's not worth the pain to develop a whole logic
-    df["volle_eigendom"] = [1 if "olle eigendom" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["gemeentelijke_erfpacht"] = [1 if "emeentelijke erfpacht" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["gemeentelijke_eigendom"] = [1 if "emeentelijke eigendom" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["gebruik_en_bewoning"] = [1 if "ebruik en bewoning" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["particulier_eigendom_belast"] = [1 if "articulier eigendom belast" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["belast_met_opstal"] = [1 if "elast met opstal" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["mandelig"] = [1 if "andelig" in x else 0 for x in df["ownership"].fillna("no info")]
-    df["lidmaatschapsrecht"] = [1 if "idmaatschapsrecht" in x else 0 for x in df["ownership"].fillna("no info")]
+    df["new_housing_type"] = groupHousingType(df["housing_type"]).astype("category")
+
+    if vocabulary is None:
+        vocabulary = buildVocabulary(df)
+
+    #all the dummy blocks are built at once and joined a single time
+    dummies = encodeCategoricals(df, vocabulary, dtype, sparse)
+    df = pandas.concat([df.drop(columns=[x for x in dummies.columns if x in df.columns]), dummies], axis=1)
 
     #we write a log
-    with open(fmpath, "a") as report:
-        report.write("The categorical part finished without errors.\n")
+    if fmpath is not None:
+        with open(fmpath, "a") as report:
+            report.write("The categorical part finished without errors.\n")
 
     categorics = df.copy()
 
     return categorics
 
-def runFeatureMining(df, fmpath):
+def runFeatureMining(df, fmpath, vocabulary=None):
     """
     Wrapper function for the feature mining pipeline. It consists of
-    three steps:
+    two steps:
     
-    1) Uniqueness: checks for duplicate entries and drops them
-    2) Validity: checks for invalid entries and replaces them with NaN
+    1) Numerics: extracts numerical features from the text columns
+    2) Categoricals: turns categorical columns into dummies
 
     These steps are used to fill in a log which can be found in the
-    feature mining folder and are also sent via webhook.
+    feature mining folder and are also sent via webhook. The totals
+    of every column are returned so that they are only added to those
+    of every run once the rows are stored.
 
     Input:
 
-    datapath: a path-like object -> str
-    dqpath: a path-like object -> str
+    df: a dataset which has already passed Data Quality -> pandas.DataFrame
+    fmpath: a path-like object -> str
+    vocabulary: the output of buildVocabulary, optional -> dict
 
     Output:
 
-    complete: a pandas.DataFrame object -> pandas.DataFrame
+    categorics: a pandas.DataFrame object -> pandas.DataFrame
+    totals: the totals of every column, made by aggregates.describe -> dict
     """
 
     numerics = extractFeaturesNumerics(df, fmpath)
-    categorics = extractFeaturesCategorical(numerics, fmpath)
+    categorics = extractFeaturesCategorical(numerics, fmpath, vocabulary)
+
+    totals = aggregates.describe(categorics)
 
     utils.sendWebhook(fmpath)
 
-    return categorics
+    return categorics, totals
     
 
     
\ No newline at end of file
@@ -0,0 +1,157 @@
+import os
+import uuid
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import utils
+
+logger = logging.getLogger(__name__)
+
+#how many pipelines may run at the same time; the rest wait in the queue.
+#One by default, as the old handlers ran; the writes jobs share (schema
+#registry, fact table DDL) are locked for deployments raising it
+MAX_WORKERS = int(os.environ.get("MAX_JOBS", "1"))
+
+#how many finished jobs are remembered for the status endpoint
+MAX_HISTORY = 1000
+
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+JOBS = {}
+LOCK = threading.Lock()
+CURRENT = threading.local()
+
+def submit(kind, function, *args):
+    """
+    Queues a pipeline run on the job executor and returns at once.
+    The run can then be followed through status.
+
+    Input:
+
+    kind: a short name for the job, e.g. "start" -> str
+    function: the function running the pipeline -> callable
+    args: the arguments of the function
+
+    Output:
+
+    job_id: the ID of the new job -> str
+    """
+
+    job_id = uuid.uuid4().hex
+    with LOCK:
+        JOBS[job_id] = {"id":job_id, "kind":kind, "status":"queued", "stage":None, "stages":[],
+                        "submitted":str(datetime.now()), "started":None, "finished":None, "error":None}
+        prune()
+
+    EXECUTOR.submit(run, job_id, function, *args)
+
+    return job_id
+
+def run(job_id, function, *args):
+    """
+    Runs a queued job on a worker thread, recording when it starts,
+    finishes or fails. The webhooks sent during the job are posted
+    together once it is over.
+
+    Input:
+
+    job_id: the ID given by submit -> str
+    function: the function running the pipeline -> callable
+    args: the arguments of the function
+    """
+
+    CURRENT.job_id = job_id
+    update(job_id, status="running", started=str(datetime.now()))
+
+    #the webhooks of a run are coalesced into a single message
+    utils.startBatch()
+
+    try:
+        function(*args)
+        update(job_id, status="finished", finished=str(datetime.now()))
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        update(job_id, status="failed", finished=str(datetime.now()), error="{}: {}".format(type(e).__name__, e))
+    finally:
+        CURRENT.job_id = None
+        utils.flushBatch()
+
+def update(job_id, **fields):
+    """
+    Changes the fields of a job record.
+
+    Input:
+
+    job_id: the ID given by submit -> str
+    fields: the fields to change
+    """
+
+    with LOCK:
+        if job_id in JOBS:
+            JOBS[job_id].update(fields)
+
+def progress(stage):
+    """
+    Records the stage reached by the job running on this thread.
+    Outside of a job it does nothing, so the pipeline functions can
+    call it unconditionally.
+
+    Input:
+
+    stage: the name of the stage -> str
+    """
+
+    job_id = getattr(CURRENT, "job_id", None)
+    if job_id is None:
+        return
+
+    with LOCK:
+        if job_id in JOBS:
+            JOBS[job_id]["stage"] = stage
+            JOBS[job_id]["stages"].append({"name":stage, "started":str(datetime.now())})
+
+def record(**fields):
+    """
+    Sets fields on the record of the job running on this thread,
+    e.g. how many rows it has inserted. Outside of a job it does
+    nothing.
+
+    Input:
+
+    fields: the fields to set
+    """
+
+    job_id = getattr(CURRENT, "job_id", None)
+    if job_id is not None:
+        update(job_id, **fields)
+
+def status(job_id):
+    """
+    Returns a copy of a job record.
+
+    Input:
+
+    job_id: the ID given by submit -> str
+
+    Output:
+
+    job: the job record, or None if the ID is unknown -> dict
+    """
+
+    with LOCK:
+        if job_id not in JOBS:
+            return None
+        job = dict(JOBS[job_id])
+        job["stages"] = list(job["stages"])
+
+    return job
+
+def prune():
+    """
+    Forgets the oldest finished jobs beyond MAX_HISTORY. Must be
+    called holding LOCK.
+    """
+
+    done = [k for k, v in JOBS.items() if v["status"] in ["finished", "failed"]]
+    for job_id in done[:max(0, len(done) - MAX_HISTORY)]:
+        del JOBS[job_id]
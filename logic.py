@@ -1,12 +1,121 @@
 import re
 import pandas
 import numpy
+import itertools
+import ruleCache
+
+#pyahocorasick is optional; without it each keyword is looked up with
+#a plain substring search
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+#version of the rule set, part of every cached result; bump it when
+#a rule changes meaning without its pattern changing
+RULESET_VERSION = 1
+
+#validity patterns are compiled once at import so every run reuses
+#them instead of building the same alternations again
+VALIDITY_PATTERNS = {
+                     "number_of_rooms":re.compile("kamer|slaapkamer"),
+                     "number_of_floors":re.compile("woonlaag|woonlage"),
+                     "backyard":re.compile("m²"),
+                     "floor_level":re.compile("woonlaag|Begane grond"),
+                     "number_of_bathrooms":re.compile("badkamer|toilet"),
+                     "construction_type":re.compile("bouw"),
+                     "housing_type":re.compile("appartement|woning|flat|Maisonnette|pand|verdieping|Penthouse"),
+                     "energy_label":re.compile("A|B|C|D|E|F|G|Niet verplicht|Niet beschikbaar"),
+                     "housing_status":re.compile("Beschikbaar|Verkocht onder voorbehoud|Onder bod|Onder optie"),
+                     "garage":re.compile("garage|Garage|carport|Carport|inpandig|Inpandig|Parkeer|parkeer|mogelijk|Souterrain"),
+                     "garden":re.compile("tuin|Tuin|terras|Patio|Plaats"),
+                     "ownership":re.compile("erfpacht|Erfpacht|eigendom|Eigendom|belast|Belast|mandelig|Mandelig|Lidmaatschapsrecht|bewoning")
+                    }
+
+#numerical lower bounds, strictly exclusive
+VALIDITY_BOUNDS = {
+                   "price":50000,
+                   "living_area_m2":20,
+                   "plot_area_m2":20,
+                   "volume_m3":50
+                  }
+
+#columns that are valid as long as they hold text
+VALIDITY_TEXT = ["address", "description"]
+
+#each validity rule owns one bit of FLAG_INVALID_FIELDS, in this order,
+#so rows failing several rules keep all of them; in SQL a rule is
+#tested with FLAG_INVALID_FIELDS & bit <> 0
+VALIDITY_FIELDS = list(VALIDITY_BOUNDS.keys()) + VALIDITY_TEXT + list(VALIDITY_PATTERNS.keys())
+VALIDITY_BITS = {column: 1 << i for i, column in enumerate(VALIDITY_FIELDS)}
+VALIDITY_MASK_DTYPE = numpy.int32
+
+#enumerated text columns, held as categoricals once validated
+ENUMERATED = ["housing_type", "housing_status", "construction_type", "energy_label", "garden", "garage", "ownership"]
+
+#compact dtypes of the columns the pipeline creates: flags are booleans,
+#dummies and indicators take one byte and counts two bytes
+FLAG_DTYPE = "bool"
+DUMMY_DTYPE = numpy.uint8
+FEATURE_DTYPES = {"flag":numpy.uint8, "level":numpy.int16, "number":"Int16", "decimal":numpy.float64}
+
+def isText(column):
+    """
+    Marks which entries of a column are strings. Columns with a
+    pandas string dtype, or categoricals of strings, are answered
+    without touching each value.
+
+    Input:
+
+    column: a column of the dataset -> pandas.Series
+
+    Output:
+
+    mask: True where the entry is a string -> pandas.Series
+    """
+
+    if isinstance(column.dtype, pandas.StringDtype):
+        return column.notna()
+
+    if isinstance(column.dtype, pandas.CategoricalDtype) and column.cat.categories.inferred_type in ["string", "empty"]:
+        return column.notna()
+
+    return column.map(lambda x: type(x)==str).astype(bool)
+
+def matchRule(column, pattern):
+    """
+    Vectorized equivalent of re.search over a column. Entries
+    that are not strings never match. The pattern is only run on
+    the distinct values of the column, and only on those the rule
+    cache does not know yet.
+
+    Input:
+
+    column: a column of the dataset -> pandas.Series
+    pattern: a compiled regular expression -> re.Pattern
+
+    Output:
+
+    mask: True where the pattern is found -> pandas.Series
+    """
+
+    text = isText(column)
+    mask = pandas.Series(False, index=column.index)
+    if text.any():
+        codes, uniques = pandas.factorize(column[text].astype(str))
+        found = ruleCache.lookup(RULESET_VERSION, ("match", pattern.pattern, pattern.flags), list(uniques),
+                                 lambda values: pandas.Series(values, dtype=object).str.contains(pattern, regex=True).tolist())
+        mask[text] = numpy.array(found, dtype=bool)[codes]
+
+    return mask
 
 def conditionsValidity(data):
     """
     Sets conditions and boundaries for each variable in the
     dataset to ensure its validity. These conditions are 
     based on previous data exploration and common sense.
+    All the conditions are boolean masks aligned to the
+    index of the dataset.
 
     Input:
 
@@ -17,35 +126,210 @@ def conditionsValidity(data):
     conditions: a dict-like object -> dict
     """
 
-    conditions = {
-                  "price":data["price"]>50000,
-                  "living_area_m2":data["living_area_m2"]>20,
-                  "plot_area_m2":data["plot_area_m2"]>20,
-                  "volume_m3":data["volume_m3"]>50,
-                  "address":pandas.Series([True if type(x)==str else False for x in data["address"]]),
-                  "description":pandas.Series([True if type(x)==str else False for x in data["description"]]),
-                  "number_of_rooms":pandas.Series([bool(re.search("kamer|slaapkamer", x)) if type(x)==str else False for x in data["number_of_rooms"]]),
-                  "number_of_floors":pandas.Series([bool(re.search("woonlaag|woonlage", x)) if type(x)==str else False for x in data["number_of_floors"]]),
-                  "backyard":pandas.Series([bool(re.search("m²", x)) if type(x)==str else False for x in data["backyard"]]),
-                  "floor_level":pandas.Series([bool(re.search("woonlaag|Begane grond", x)) if type(x)==str else False for x in data["floor_level"]]),
-                  "number_of_bathrooms":pandas.Series([bool(re.search("badkamer|toilet", x)) if type(x)==str else False for x in data["number_of_bathrooms"]]),
-                  "construction_type":pandas.Series([bool(re.search("bouw", x)) if type(x)==str else False for x in data["construction_type"]]),
-                  "housing_type":pandas.Series([bool(re.search("appartement|woning|flat|Maisonnette|pand|verdieping|Penthouse", x)) if type(x)==str else False for x in data["housing_type"]]),
-                  "energy_label":pandas.Series([bool(re.search("A|B|C|D|E|F|G|Niet verplicht|Niet beschikbaar", x)) if type(x)==str else False for x in data["energy_label"]]),
-                  "housing_status":pandas.Series([bool(re.search("Beschikbaar|Verkocht onder voorbehoud|Onder bod|Onder optie", x)) if type(x)==str else False for x in data["housing_status"]]),
-                  "garage":pandas.Series([bool(re.search("garage|Garage|carport|Carport|inpandig|Inpandig|Parkeer|parkeer|mogelijk|Souterrain", x)) if type(x)==str else False for x in data["garage"]]),
-                  "garden":pandas.Series([bool(re.search("tuin|Tuin|terras|Patio|Plaats", x)) if type(x)==str else False for x in data["garden"]]),
-                  "ownership":pandas.Series([bool(re.search("erfpacht|Erfpacht|eigendom|Eigendom|belast|Belast|mandelig|Mandelig|Lidmaatschapsrecht|bewoning", x)) if type(x)==str else False for x in data["ownership"]])
-                }
+    conditions = {}
+
+    for column, bound in VALIDITY_BOUNDS.items():
+        conditions[column] = (data[column]>bound).fillna(False).astype(bool)
+
+    for column in VALIDITY_TEXT:
+        conditions[column] = isText(data[column])
+
+    for column, pattern in VALIDITY_PATTERNS.items():
+        conditions[column] = matchRule(data[column], pattern)
     
     return conditions
 
+def decodeInvalidFields(mask):
+    """
+    Turns a FLAG_INVALID_FIELDS bitmask back into the names of the
+    fields that failed validity.
+
+    Input:
+
+    mask: the bitmask of a row -> int
+
+    Output:
+
+    fields: the invalid fields, in rule order -> list
+    """
+
+    fields = [column for column, bit in VALIDITY_BITS.items() if int(mask) & bit]
+
+    return fields
+
+#two addresses sharing their numbers are near-duplicates from this
+#similarity of their normalized keys on, compared with the neighbours
+#within this window once sorted
+ADDRESS_SIMILARITY = 0.9
+ADDRESS_WINDOW = 4
+
+def addressKey(addresses):
+    """
+    Normalizes addresses so that the same one scraped with different
+    spacing, casing or punctuation gets the same key: letters are
+    lowered, punctuation becomes a space and house-number suffixes and
+    postcode letters are joined to their number, so that
+    "Keizersgracht 12-A" and "keizersgracht 12 a" both become
+    "keizersgracht 12a".
+
+    Input:
+
+    addresses: the address column -> pandas.Series
+
+    Output:
+
+    keys: the normalized addresses -> pandas.Series
+    """
+
+    keys = addresses.astype(object).where(addresses.notna()).str.lower()
+    keys = keys.str.replace(r"[\W_]+", " ", regex=True)
+    keys = keys.str.replace(r"(?<=\d) (?=[^\W\d_]{1,2}\b)", "", regex=True)
+    keys = keys.str.strip()
+
+    return keys
+
+def addressBlock(keys):
+    """
+    Groups normalized addresses into blocks that near-duplicates never
+    cross: the street, i.e. the words before the last token holding a
+    digit, with its spaces removed, and the tokens holding a digit,
+    i.e. house number with suffix and postcode, which must all match
+    exactly. Only the rest, such as the city, may differ slightly, so
+    "markstraat 12 den haag" and "parkstraat 12 den haag" are never
+    compared. Addresses without any number only block with their own
+    key.
+
+    Input:
+
+    keys: the output of addressKey -> pandas.Series
+
+    Output:
+
+    blocks: the block of each address -> pandas.Series
+    """
+
+    numbers = keys.str.replace(r"(?:^|\s)[^\d\s]+(?=\s|$)", "", regex=True).str.strip()
+    street = keys.str.replace(r"\s*\S*\d[^\d]*$", "", regex=True)
+    street = street.str.replace(r"(?:^|\s)\S*\d\S*", "", regex=True).str.replace(" ", "", regex=False)
+    blocks = (street + " " + numbers).where(numbers!="", keys)
+
+    return blocks
+
+#keywords searched in the description to explain a missing value,
+#keyed by the column they explain
+DESCRIPTION_KEYWORDS = {
+                        "price":["prijs", "Prijs", "euro", "€"],
+                        "living_area_m2":["woonoppervlakte", "Woonoppervlakte", "gebruiksoppervlakte", "Gebruiksoppervlakte"],
+                        "volume_m3":["volume", "Volume"],
+                        "address":["straat", "weg", "kade", "kwartier", "adres", "Adres"],
+                        "number_of_rooms":["kamer", "Kamer", "slaapkamer", "Slaapkamer"],
+                        "number_of_floors":["woonlaag", "woonlage"],
+                        "backyard":["Begane grond"],
+                        "number_of_bathrooms":["badkamer", "Badkamer", "toilet", "Toilet"],
+                        "construction_type":["Nieuwbouw", "Bestaande bouw"],
+                        "housing_type":["appartement", "Appartement", "woning", "flat", "Maisonnette", "maisonnette", "Grachtenpand", "grachtenpand", "Tussenverdieping", "tussenverdieping", "Penthouse", "penthouse", "Herenhuis", "herenhuis", "Woonboerderij", "woonboerderij"],
+                        "energy_label":["energielabel", "Energielabel", "energie", "Energie"],
+                        "housing_status":["Beschikbaar", "Verkocht onder voorbehoud", "Onder bod", "Onder optie"],
+                        "garage":["garage", "Garage", "carport", "Carport", "inpandig", "Inpandig", "Parkeer", "parkeer", "Souterrain"],
+                        "garden":["tuin", "Tuin"],
+                        "ownership":["erfpacht", "Erfpacht", "eigendom", "Eigendom", "belast", "Belast"]
+                       }
+
+def buildScanner(keywords):
+    """
+    Combines several keyword lists into a single scanner, so a text
+    only has to be read once to know which lists it matches. Each
+    keyword maps to a bitmask of every list owning the keyword or a
+    substring of it; a keyword whose substrings already give all its
+    lists is left out, as finding it always finds them. With
+    pyahocorasick the scanner is an Aho-Corasick automaton, which
+    reports every keyword, overlapping ones included, in one pass.
+
+    Input:
+
+    keywords: lists of keywords keyed by rule name -> dict
+
+    Output:
+
+    scanner: the automaton, or None without pyahocorasick -> ahocorasick.Automaton
+    bits: the bitmask of rules hit by each keyword kept -> dict
+    """
+
+    rules = list(keywords.keys())
+    vocabulary = sorted(set(itertools.chain(*keywords.values())), key=len)
+
+    every = {}
+    for word in vocabulary:
+        every[word] = 0
+        for i, rule in enumerate(rules):
+            if any(k in word for k in keywords[rule]):
+                every[word] |= 1 << i
+
+    bits = {}
+    for word in vocabulary:
+        inner = 0
+        for other in vocabulary:
+            if other!=word and other in word:
+                inner |= every[other]
+        if every[word]!=inner:
+            bits[word] = every[word]
+
+    scanner = None
+    if ahocorasick is not None:
+        scanner = ahocorasick.Automaton()
+        for word, mask in bits.items():
+            scanner.add_word(word, mask)
+        scanner.make_automaton()
+
+    return scanner, bits
+
+DESCRIPTION_SCANNER, DESCRIPTION_BITS = buildScanner(DESCRIPTION_KEYWORDS)
+
+def scanText(column, scanner=DESCRIPTION_SCANNER, bits=DESCRIPTION_BITS, rules=list(DESCRIPTION_KEYWORDS.keys())):
+    """
+    Reads each text of a column once and reports, for every rule,
+    whether any of its keywords appears. Entries that are not 
+    strings never match.
+
+    Input:
+
+    column: a column of the dataset -> pandas.Series
+    scanner: the automaton made by buildScanner, or None -> ahocorasick.Automaton
+    bits: the keyword bitmasks made by buildScanner -> dict
+    rules: the rule names, in the order used by buildScanner -> list
+
+    Output:
+
+    matches: one boolean column per rule -> pandas.DataFrame
+    """
+
+    keywords = list(bits.items())
+
+    found = []
+    for value in column.to_numpy(dtype=object):
+        mask = 0
+        if type(value)==str:
+            if scanner is not None:
+                for _, bit in scanner.iter(value):
+                    mask |= bit
+            else:
+                for word, bit in keywords:
+                    if word in value:
+                        mask |= bit
+        found.append(mask)
+    found = numpy.array(found, dtype=numpy.int64)
+
+    matches = pandas.DataFrame({rule: (found >> i) & 1 == 1 for i, rule in enumerate(rules)}, index=column.index)
+
+    return matches
+
 def conditionsCompleteness(data):
     """
     Sets conditions to establish whether an entry is truly
     missing, not relevant to that specific row, or perhaps there
     has been an issue while scraping. These conditions are based
-    on previous data exploration and common sense.
+    on previous data exploration and common sense. The description
+    is scanned only once for all the keyword rules.
 
     Input:
 
@@ -56,35 +340,89 @@ def conditionsCompleteness(data):
     conditions: a dict-like object -> dict
     """
 
+    described = scanText(data["description"])
+    text = isText(data["description"])
+
     conditions = {
-                  "price":[pandas.Series([bool(re.search("prijs|Prijs|euro|€", x)) if type(x)==str else False for x in data["description"]]), "FLAG_PRICE_IN_DESCRIPTION"],
-                  "living_area_m2":[pandas.Series([bool(re.search("woonoppervlakte|Woonoppervlakte|gebruiksoppervlakte|Gebruiksoppervlakte", x)) if type(x)==str else False for x in data["description"]]), "FLAG_LIVING_AREA_IN_DESCRIPTION"],
-                  "plot_area_m2":[pandas.Series([bool(re.search("appartement|flat", x)) if type(x)==str else False for x in data["housing_type"]]), "FLAG_NO_PLOT_IS_APARTMENT"],
-                  "volume_m3":[pandas.Series([bool(re.search("volume|Volume", x)) if type(x)==str else False for x in data["description"]]), "FLAG_VOLUME_IN_DESCRIPTION"],
-                  "address":[pandas.Series([bool(re.search("straat|weg|kade|kwartier|adres|Adres", x)) if type(x)==str else False for x in data["description"]]), "FLAG_ADDRESS_MAYBE_IN_DESCRIPTION"],
-                  "description":[pandas.Series([False if type(x)==str else True for x in data["description"]]), "FLAG_DESCRIPTION_MISSING"],
-                  "number_of_rooms":[pandas.Series([bool(re.search("kamer|Kamer|slaapkamer|Slaapkamer", x)) if type(x)==str else False for x in data["description"]]), "FLAG_ROOMS_IN_DESCRIPTION"],
-                  "number_of_floors":[pandas.Series([bool(re.search("woonlaag|woonlage", x)) if type(x)==str else False for x in data["description"]]), "FLAG_FLOORS_IN_DESCRIPTION"],
-                  "backyard":[pandas.Series([bool(re.search("Begane grond", x))==False if type(x)==str else False for x in data["description"]]), "FLAG_ABOVE_GROUND_NO_YARD"],
-                  "floor_level":[pandas.Series([bool(re.search("appartement|flat|Penthouse|Maisonnette|Tussenverdieping", x))==False if type(x)==str else False for x in data["housing_type"]]), "FLAG_SINGLE_HOUSE_NO_SPECIFIC_FLOOR"],
-                  "number_of_bathrooms":[pandas.Series([bool(re.search("badkamer|Badkamer|toilet|Toilet", x)) if type(x)==str else False for x in data["description"]]), "FLAG_BATHROOM_IN_DESCRIPTION"],
-                  "construction_type":[pandas.Series([bool(re.search("Nieuwbouw|Bestaande bouw", x)) if type(x)==str else False for x in data["description"]]), "FLAG_CONSTRUCTION_IN_DESCRIPTION"],
-                  "housing_type":[pandas.Series([bool(re.search("appartement|Appartement|woning|flat|Maisonnette|maisonnette|Grachtenpand|grachtenpand|Tussenverdieping|tussenverdieping|Penthouse|penthouse|Herenhuis|herenhuis|Woonboerderij|woonboerderij", x)) if type(x)==str else False for x in data["description"]]), "FLAG_TYPE_IN_DESCRIPTION"],
-                  "energy_label":[pandas.Series([bool(re.search("energielabel|Energielabel|energie|Energie", x)) if type(x)==str else False for x in data["description"]]), "FLAG_ENERGY_IN_DESCRIPTION"],
-                  "housing_status":[pandas.Series([bool(re.search("Beschikbaar|Verkocht onder voorbehoud|Onder bod|Onder optie", x)) if type(x)==str else False for x in data["description"]]), "FLAG_STATUS_IN_DESCRIPTION"],
-                  "garage":[pandas.Series([bool(re.search("garage|Garage|carport|Carport|inpandig|Inpandig|Parkeer|parkeer|Souterrain", x)) if type(x)==str else False for x in data["description"]]), "FLAG_GARAGE_IN_DESCRIPTION"],
-                  "garden":[pandas.Series([bool(re.search("tuin|Tuin", x)) if type(x)==str else False for x in data["description"]]), "FLAG_GARDEN_IN_DESCRIPTION"],
-                  "ownership":[pandas.Series([bool(re.search("erfpacht|Erfpacht|eigendom|Eigendom|belast|Belast", x)) if type(x)==str else False for x in data["description"]]), "FLAG_OWNERSHIP_IN_DESC"]
+                  "price":[described["price"], "FLAG_PRICE_IN_DESCRIPTION"],
+                  "living_area_m2":[described["living_area_m2"], "FLAG_LIVING_AREA_IN_DESCRIPTION"],
+                  "plot_area_m2":[matchRule(data["housing_type"], re.compile("appartement|flat")), "FLAG_NO_PLOT_IS_APARTMENT"],
+                  "volume_m3":[described["volume_m3"], "FLAG_VOLUME_IN_DESCRIPTION"],
+                  "address":[described["address"], "FLAG_ADDRESS_MAYBE_IN_DESCRIPTION"],
+                  "description":[text==False, "FLAG_DESCRIPTION_MISSING"],
+                  "number_of_rooms":[described["number_of_rooms"], "FLAG_ROOMS_IN_DESCRIPTION"],
+                  "number_of_floors":[described["number_of_floors"], "FLAG_FLOORS_IN_DESCRIPTION"],
+                  "backyard":[text&(described["backyard"]==False), "FLAG_ABOVE_GROUND_NO_YARD"],
+                  "floor_level":[isText(data["housing_type"])&(matchRule(data["housing_type"], re.compile("appartement|flat|Penthouse|Maisonnette|Tussenverdieping"))==False), "FLAG_SINGLE_HOUSE_NO_SPECIFIC_FLOOR"],
+                  "number_of_bathrooms":[described["number_of_bathrooms"], "FLAG_BATHROOM_IN_DESCRIPTION"],
+                  "construction_type":[described["construction_type"], "FLAG_CONSTRUCTION_IN_DESCRIPTION"],
+                  "housing_type":[described["housing_type"], "FLAG_TYPE_IN_DESCRIPTION"],
+                  "energy_label":[described["energy_label"], "FLAG_ENERGY_IN_DESCRIPTION"],
+                  "housing_status":[described["housing_status"], "FLAG_STATUS_IN_DESCRIPTION"],
+                  "garage":[described["garage"], "FLAG_GARAGE_IN_DESCRIPTION"],
+                  "garden":[described["garden"], "FLAG_GARDEN_IN_DESCRIPTION"],
+                  "ownership":[described["ownership"], "FLAG_OWNERSHIP_IN_DESC"]
                  }
     
     return conditions
 
+#rules to mine features, keyed by the feature they produce; each
+#rule names its source column, a pattern with a group named after
+#the feature, and how to read the group: "number" keeps the whole
+#number found (NaN otherwise), "decimal" allows a fraction, "level"
+#defaults to 0 and "flag" is 1 whenever the group matched. A pattern starting with ^
+#must match at the start of the value, the rest may match anywhere
+FEATURE_RULES = {
+                 "totalRooms":["number_of_rooms", r"^(?P<totalRooms>\d+) kamer", "number"],
+                 "bedrooms":["number_of_rooms", r"\((?P<bedrooms>\d+) slaapkamer", "number"],
+                 "totalFloors":["number_of_floors", r"^(?P<totalFloors>\d+) woonla", "number"],
+                 "zolder":["number_of_floors", r"(?P<zolder>zolder)", "flag"],
+                 "kelder":["number_of_floors", r"(?P<kelder>kelder)", "flag"],
+                 "vliering":["number_of_floors", r"(?P<vliering>vliering)", "flag"],
+                 "backyardM2":["backyard", r"^(?P<backyardM2>\d+(?:\.\d+)?) m²", "decimal"],
+                 "whichFloor":["floor_level", r"^(?P<whichFloor>\d+)e woonlaag", "level"],
+                 "bathrooms":["number_of_bathrooms", r"^(?P<bathrooms>\d+) badkamer", "number"],
+                 "separateToilets":["number_of_bathrooms", r"(?P<separateToilets>\d) apart", "number"]
+                }
+
+def buildExtractors(rules):
+    """
+    Combines the feature rules of each source column into a single
+    pattern, so every feature of that column comes out of one
+    str.extract call. Each rule becomes an optional lookahead from 
+    the start of the value, which keeps the rules independent of
+    one another.
+
+    Input:
+
+    rules: feature rules keyed by feature name -> dict
+
+    Output:
+
+    extractors: one combined pattern per source column -> dict
+    """
+
+    parts = {}
+    for feature, (source, pattern, kind) in rules.items():
+        if pattern.startswith("^"):
+            parts.setdefault(source, []).append("(?=(?:" + pattern[1:] + ")?)")
+        else:
+            parts.setdefault(source, []).append("(?=(?:.*?" + pattern + ")?)")
+
+    extractors = {source: re.compile("^" + "".join(p), re.DOTALL) for source, p in parts.items()}
+
+    return extractors
+
+FEATURE_EXTRACTORS = buildExtractors(FEATURE_RULES)
+
 def conditionsFeatureMining(data):
     """
     Sets conditions and boundaries for each variable in the
     dataset to determine how to approach feature mining.
     These conditions are based on previous data exploration 
-    and common sense.
+    and common sense. Each distinct value of a source column is
+    read once, or not at all if the rule cache knows it, and
+    every feature is returned under its own name.
 
     Input:
 
@@ -95,17 +433,24 @@ def conditionsFeatureMining(data):
     conditions: a dict-like object -> dict
     """
 
-    conditions = {
-                  "number_of_rooms":[pandas.Series([int(x.split(" kamer")[0]) if type(x)==str else numpy.nan for x in data["number_of_rooms"]]), "totalRooms"],
-                  "number_of_rooms":[pandas.Series([int(x.split(" slaapkamer")[0].split("(")[1]) if (" slaapkamer" in x)&("(" in x) else numpy.nan for x in data["number_of_rooms"].fillna("no_info")]), "bedrooms"],
-                  "number_of_floors":[pandas.Series([int(x.split(" woonla")[0]) if (type(x)==str)&("woonla" in x) else numpy.nan for x in data["number_of_floors"]]), "totalFloors"],
-                  "number_of_floors":[pandas.Series([1 if (type(x)==str)&("zolder" in x) else 0 for x in data["number_of_floors"]]), "zolder"],
-                  "number_of_floors":[pandas.Series([1 if (type(x)==str)&("kelder" in x) else 0 for x in data["number_of_floors"]]), "kelder"],
-                  "number_of_floors":[pandas.Series([1 if (type(x)==str)&("vliering" in x) else 0 for x in data["number_of_floors"]]), "vliering"],
-                  "backyard":[pandas.Series([float(x.split(" m²")[0]) if " m²" in x else numpy.nan for x in data["backyard"].fillna("no info")]), "backyardM2"],
-                  "floor_level":[pandas.Series([int(x.split("e woonlaag")[0]) if "e woonlaag" in x else 0 for x in data["floor_level"].fillna("no info")]), "whichFloor"],
-                  "number_of_bathrooms":[pandas.Series([int(x.split(" badkamer")[0]) if " badkamer" in x else numpy.nan for x in data["number_of_bathrooms"].fillna("no info")]), "bathrooms"],
-                  "number_of_bathrooms":[pandas.Series([int(x.split(" apart")[0][-1]) if " apart" in x else numpy.nan for x in data["number_of_bathrooms"].fillna("no_info")]), "separateToilets"]
-                 }
+    extracted = {}
+    for source, extractor in FEATURE_EXTRACTORS.items():
+        text = isText(data[source])
+        codes, uniques = pandas.factorize(data[source][text].astype(str))
+        groups = list(extractor.groupindex.keys())
+        found = ruleCache.lookup(RULESET_VERSION, ("extract", extractor.pattern), list(uniques),
+                                 lambda values: list(pandas.Series(values, dtype=object).str.extract(extractor)[groups].itertuples(index=False, name=None)))
+        frame = pandas.DataFrame(found, columns=groups, dtype=object).reindex(range(len(uniques)))
+        extracted[source] = frame.iloc[codes].set_axis(data.index[text]).reindex(data.index)
+
+    conditions = {}
+    for feature, (source, pattern, kind) in FEATURE_RULES.items():
+        values = extracted[source][feature]
+        if kind=="flag":
+            conditions[feature] = values.notna().astype(FEATURE_DTYPES[kind])
+        elif kind=="level":
+            conditions[feature] = pandas.to_numeric(values).fillna(0).astype(FEATURE_DTYPES[kind])
+        else:
+            conditions[feature] = pandas.to_numeric(values).astype(FEATURE_DTYPES[kind])
     
-    return conditions
\ No newline at end of file
+    return conditions
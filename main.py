@@ -1,16 +1,37 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request as HTTPRequest
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import os
+import io
+from contextlib import asynccontextmanager
 from datetime import datetime
 import dataQuality
 import featureMining
 import dbTransactions
+import streaming
+import jobs
+import schemaRegistry
+import storage
+import metrics
+import parallel
+import uploads
+import ruleCache
+import queries
+import aggregates
 import shutil
 import pandas
-from sqlalchemy import create_engine, inspect, MetaData
 import utils
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    #the database engine and its pool are shared by every request
+    dbTransactions.get_engine()
+    yield
+    dbTransactions.dispose_engine()
+    parallel.shutdownPool()
+
+app = FastAPI(lifespan=lifespan)
 
 class Request(BaseModel):
     body: str
@@ -20,43 +41,184 @@ async def root():
     return {"message": os.listdir(os.getcwd())}
 
 @app.post("/start")
-async def start_pipeline(args: Request):
-    #writing raw data to bucket
-    body = args.body
+async def start_pipeline(args: Request, chunksize: int = 0):
+    #the pipeline runs on the job executor so the server stays responsive
+    job_id = jobs.submit("start", run_start, args.body, chunksize)
+    return {"job": job_id}
+
+@app.post("/insert")
+async def insert_pipeline(args: Request, on_duplicate: str = "skip"):
+    #listings already stored are either skipped or replaced
+    if on_duplicate not in ["skip", "upsert"]:
+        raise HTTPException(status_code=400, detail="on_duplicate must be skip or upsert.")
+
+    #the pipeline runs on the job executor so the server stays responsive
+    job_id = jobs.submit("insert", run_insert, args.body, on_duplicate)
+    return {"job": job_id}
+
+@app.post("/validate")
+async def validate_data(args: Request, sample: int = 0):
+    #a dry run of data quality: the counts come back at once and
+    #nothing is stored, logged, sent or written to the database
+    if sample<0:
+        raise HTTPException(status_code=400, detail="sample must be a number of rows, or 0 for all of them.")
+
+    try:
+        return await run_in_threadpool(run_validate, args.body, sample)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/upload/start")
+async def upload_start_pipeline(request: HTTPRequest, chunksize: int = 0):
+    #the CSV is written to the raw bucket as it arrives, then the
+    #pipeline runs on the job executor from that file
+    datapath = storage.bucketPath(os.path.join(os.getcwd(), "data/raw"), "raw_data", str(datetime.now()), format="csv")
+    await receive_upload(request, datapath)
+
+    job_id = jobs.submit("start", run_start, None, chunksize, datapath)
+    return {"job": job_id}
+
+@app.post("/upload/insert")
+async def upload_insert_pipeline(request: HTTPRequest, on_duplicate: str = "skip"):
+    #listings already stored are either skipped or replaced
+    if on_duplicate not in ["skip", "upsert"]:
+        raise HTTPException(status_code=400, detail="on_duplicate must be skip or upsert.")
+
+    datapath = storage.bucketPath(os.path.join(os.getcwd(), "data/raw/new_entries"), "raw_data", str(datetime.now()), format="csv")
+    await receive_upload(request, datapath)
+
+    job_id = jobs.submit("insert", run_insert, None, on_duplicate, datapath)
+    return {"job": job_id}
+
+async def receive_upload(request, datapath):
+    #a raw body or a multipart file, plain, gzip or zstd; a partial file
+    #is removed whatever stopped it, a client disconnecting included
+    try:
+        await uploads.receiveUpload(request, datapath)
+    except BaseException as e:
+        if os.path.exists(datapath):
+            os.remove(datapath)
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def stage_metrics():
+    #stage timings, row counts and memory in the Prometheus text format
+    return metrics.renderMetrics()
+
+@app.get("/query")
+async def query_listings(columns: str = None, where: list[str] = Query([]), after: str = None, limit: int = queries.PAGE_SIZE, format: str = "ndjson", snapshot: int = None):
+    #a page of clean listings; the X-Next-Cursor header, if any, is
+    #passed back as after to get the next one
+    try:
+        blocks, cursor = await run_in_threadpool(run_query, columns, where, after, limit, format, snapshot)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {} if cursor is None else {"X-Next-Cursor": cursor}
+    return StreamingResponse(iter(blocks), media_type=queries.FORMATS[format], headers=headers)
+
+@app.get("/aggregates")
+async def running_aggregates():
+    #data quality counts and column totals of every run so far
+    return aggregates.summary()
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job {}.".format(job_id))
+    return job
+
+def run_start(body, chunksize=0, upload=None):
+    #writing raw data to bucket, unless it was uploaded there already
     if os.path.exists("data/raw")==False:
         os.mkdir("data/raw")
-    datapath = os.path.join(os.getcwd(), "data/raw/raw_data_" + str(datetime.now()) + ".csv")
-    with open(datapath, "w") as fp:
-        fp.write(body)
+    run = str(datetime.now())
+    datapath = upload or storage.bucketPath(os.path.join(os.getcwd(), "data/raw"), "raw_data", run, format="csv")
 
     #preparing data quality folder
     if os.path.exists("data/data_quality")==False:
         os.mkdir("data/data_quality")
     dqpath = os.path.join(os.getcwd(), "data/data_quality/dq_log_" + str(datetime.now()) + ".txt")
 
-    #running data quality pipeline
-    complete = dataQuality.runDataQuality(datapath, dqpath)
-
     #preparing feature mining folder
     if os.path.exists("data/feature_mining")==False:
         os.mkdir("data/feature_mining")
     fmpath = os.path.join(os.getcwd(), "data/feature_mining/fm_log_" + str(datetime.now()) + ".txt")
 
+    #with a chunk size the raw data is streamed through every stage,
+    #so memory depends on the chunk size rather than on the file size
+    if chunksize>0:
+        if upload is None:
+            utils.writeText(body, datapath)
+        for folder in ["data/clean", "data/db"]:
+            if os.path.exists(folder)==False:
+                os.mkdir(folder)
+        dbpath = os.path.join(os.getcwd(), "data/db/db_log_" + str(datetime.now()) + ".txt")
+
+        engine = dbTransactions.get_engine()
+        run_id = dbTransactions.open_run(engine, "start")
+
+        jobs.progress("streaming")
+        with metrics.stage("streaming", bytesRead=os.path.getsize(datapath)) as m:
+            result = streaming.runStreamingPipeline(datapath, dqpath, fmpath, os.path.join(os.getcwd(), "data/clean"), engine, run_id, chunksize)
+            m["rows_out"] = result["rows"]
+        version = schemaRegistry.registerSchema(os.path.join(os.getcwd(), "data/schema.json"), result["table"], run_id, result["columns"], result["types"], result["vocabulary"])
+        dbTransactions.close_run(engine, run_id, rows_received=result["received"], rows_stored=result["rows"], schema_version=version)
+
+        #the totals of all chunks are added to the store as a single run,
+        #now that its rows are stored
+        aggregates.mergeQuality(result["stats"])
+        if len(result["totals"])>0:
+            aggregates.mergeColumns(result["totals"])
+
+        with open(dbpath, "w") as report:
+            report.write("Run {} appended to {} on {}.".format(run_id, result["table"].name, datetime.now()))
+
+        utils.sendWebhook(dbpath)
+
+        #the rule results of this run are kept for the next ones
+        ruleCache.save()
+        return
+
+    #the body is parsed once and only archived in the background
+    jobs.progress("parsing")
+    with metrics.stage("parsing", bytesRead=len(body) if upload is None else os.path.getsize(upload)) as m:
+        raw = pandas.read_csv(io.StringIO(body) if upload is None else upload)
+        m["rows_out"] = len(raw)
+    if upload is None:
+        storage.archiveRaw(body, raw, os.path.join(os.getcwd(), "data/raw"), "raw_data", run)
+
+    #running data quality pipeline, on several processes for large uploads
+    jobs.progress("data quality")
+    with metrics.stage("data_quality", len(raw)) as m:
+        complete, stats = parallel.runDataQuality(raw, dqpath)
+        m["rows_out"] = len(complete)
+
+    #the categories of the master table are registered with its schema
+    #so that every insert produces the same dummy columns
+    vocabulary = featureMining.buildVocabulary(complete)
+
     #running feature mining pipeline
-    mined = featureMining.runFeatureMining(complete, fmpath)
+    jobs.progress("feature mining")
+    with metrics.stage("feature_mining", len(complete)) as m:
+        mined, totals = parallel.runFeatureMining(complete, fmpath, vocabulary)
+        m["rows_out"] = len(mined)
 
     #now we remove the original columns except address, price, description, 
     #living_area_m2, plot_area_m2 and volume_m3
-    keep = ["address", "price", "description", "living_area_m2", "plot_area_m2", "volume_m3"]
-    columnNames = [x for x in list(pandas.read_csv(datapath)) if x not in keep]
+    columnNames = [x for x in list(raw) if x not in featureMining.KEEP_COLUMNS]
 
     clean = mined.drop(columnNames, axis=1)
 
     #writing clean data to bucket
-    if os.path.exists("data/clean")==False:
-        os.mkdir("data/clean")
-    datapath = os.path.join(os.getcwd(), "data/clean/clean_data_" + str(datetime.now()) + ".csv")
-    clean.to_csv(datapath, index=False)
+    storage.writeFrame(clean, os.path.join(os.getcwd(), "data/clean"), "clean_data", str(datetime.now()))
 
     #preparing DB folder
     if os.path.exists("data/db")==False:
@@ -65,60 +227,90 @@ async def start_pipeline(args: Request):
 
     #now is the time to send all this data to the database
     #first we specify the connection
-    engine = create_engine(os.environ["SQL_ACCESSKEY"])
-    inspector = inspect(engine)
-    last_table = inspector.get_table_names()[-1]
-    if '-' in last_table:
-        new_table = "openred_clean_0"
-    else:
-        new_table = "openred_clean_" + str(int(last_table.split("_")[-1]) + 1)
+    jobs.progress("database")
+    engine = dbTransactions.get_engine()
+
+    #every run is appended to the fact table under its own run_id,
+    #which also opens a new snapshot
+    run_id = dbTransactions.open_run(engine, "start")
+    clean.insert(0, "run_id", run_id)
 
     with engine.connect() as conn:
 
-        table = dbTransactions.generate_sql_table(clean, new_table, engine)
+        table = dbTransactions.fact_table(clean, engine)
 
-        dbTransactions.bulk_insert(clean, table, conn)
+        with metrics.stage("database", len(clean)) as m:
+            m["rows_out"] = dbTransactions.bulk_insert(clean, table, conn, progress=lambda n: jobs.record(rows_inserted=n), scope=dbTransactions.address_scope(table.name, run_id), run_id=run_id)
 
         conn.close()
 
+        #the snapshot is only offered to /insert once its rows are stored
+        version = schemaRegistry.registerSchema(os.path.join(os.getcwd(), "data/schema.json"), table, run_id, list(clean.columns), dict(raw.dtypes), vocabulary)
+
+        dbTransactions.close_run(engine, run_id, rows_received=len(raw), rows_stored=m["rows_out"], schema_version=version)
+
         with open(dbpath, "w") as report:
-            report.write("Table {} created on {}.".format(new_table, datetime.now()))
+            report.write("Run {} appended to {} on {}.".format(run_id, table.name, datetime.now()))
+
+    #the counts and totals of the run are only added to those of every
+    #run once its rows are stored
+    aggregates.mergeQuality(stats)
+    aggregates.mergeColumns(totals)
     
     #finally we send a final webhook to make sure the pipeline is finished
     utils.sendWebhook(dbpath)
 
-@app.post("/insert")
-async def insert_pipeline(args: Request):
+    #the rule results of this run are kept for the next ones
+    ruleCache.save()
+
+def run_insert(body, on_duplicate="skip", upload=None):
 
     #writing raw data to bucket
-    body = args.body
     if os.path.exists("data/raw/new_entries")==False:
         os.mkdir("data/raw/new_entries")
-    datapath = os.path.join(os.getcwd(), "data/raw/new_entries/raw_data_" + str(datetime.now()) + ".csv")
+    run = str(datetime.now())
     dqpath = os.path.join(os.getcwd(), "data/data_quality/dq_log_" + str(datetime.now()) + ".txt")
-    with open(datapath, "w") as fp:
-        fp.write(body)
 
-    #we first check if the schema is compatible by comparing the columns in the
-    #new entry with the columns in the master
+    #we first check if the schema is compatible by comparing the header of the
+    #new entry with the columns registered for the master, or with the latest
+    #raw file when the tables were all made before the registry
+    jobs.progress("schema check")
+    engine = dbTransactions.get_engine()
+    schemapath = os.path.join(os.getcwd(), "data/schema.json")
+    if os.path.exists(schemapath):
+        schema = schemaRegistry.latestSchema(schemapath)
+    else:
+        schema = schemaRegistry.legacySchema(os.path.join(os.getcwd(), "data/raw"), dbTransactions.latest_table(engine))
+    header = schemaRegistry.readHeader(body) if upload is None else schemaRegistry.readFileHeader(upload)
+    missing, unexpected = schemaRegistry.checkHeader(header, schema)
 
-    last_file = os.listdir("data/raw")[-1]
-    columnSchema = list(pandas.read_csv(os.path.join("data/raw", last_file)))
+    if len(missing)==0 and len(unexpected)==0:
 
-    if set(list(pandas.read_csv(datapath))) == set(columnSchema):
+        #the body is parsed only once it is known to fit
+        jobs.progress("parsing")
+        with metrics.stage("parsing", bytesRead=len(body) if upload is None else os.path.getsize(upload)) as m:
+            raw = pandas.read_csv(io.StringIO(body) if upload is None else upload)
+            m["rows_out"] = len(raw)
+        if upload is None:
+            storage.archiveRaw(body, raw, os.path.join(os.getcwd(), "data/raw/new_entries"), "raw_data", run)
 
         #running data quality
-        complete = dataQuality.runDataQuality(datapath, dqpath)
+        jobs.progress("data quality")
+        with metrics.stage("data_quality", len(raw)) as m:
+            complete, stats = parallel.runDataQuality(raw, dqpath)
+            m["rows_out"] = len(complete)
 
         fmpath = os.path.join(os.getcwd(), "data/feature_mining/fm_log_" + str(datetime.now()) + ".txt")
 
-        #running feature mining pipeline
-        mined = featureMining.runFeatureMining(complete, fmpath)
+        #running feature mining pipeline with the categories of the master table
+        jobs.progress("feature mining")
+        with metrics.stage("feature_mining", len(complete)) as m:
+            mined, totals = parallel.runFeatureMining(complete, fmpath, schema["vocabulary"])
+            m["rows_out"] = len(mined)
 
         #now we remove the original columns except address, price, description, 
         #living_area_m2, plot_area_m2 and volume_m3
-        keep = ["address", "price", "description", "living_area_m2", "plot_area_m2", "volume_m3"]
-        columnNames = [x for x in list(pandas.read_csv(datapath)) if x not in keep]
+        columnNames = [x for x in list(raw) if x not in featureMining.KEEP_COLUMNS]
 
         clean = mined.drop(columnNames, axis=1)
 
@@ -126,30 +318,77 @@ async def insert_pipeline(args: Request):
 
         #now is the time to send all this data to the database
         #first we specify the connection
-        engine = create_engine(os.environ["SQL_ACCESSKEY"])
-        inspector = inspect(engine)
-        last_table = inspector.get_table_names()[-1]
+        jobs.progress("database")
+        last_table = schema["table"]
+        table = dbTransactions.get_table(last_table, engine)
+
+        #without a registered schema the dummies may differ from those of
+        #the table, so only the columns it has are loaded
+        if schema.get("clean_columns") is None:
+            clean = clean[[c for c in clean.columns if c in table.c]]
+
+        #the rows join the snapshot of the latest /start as a run of
+        #their own; tables made before the fact table have no snapshot
+        snapshot = schema.get("run_id")
+        if snapshot is not None:
+            run_id = dbTransactions.open_run(engine, "insert", snapshot, schema.get("version"))
+            clean.insert(0, "run_id", run_id)
+
+            #columns the pipeline gained since the snapshot was started,
+            #such as FLAG_NEAR_DUPLICATE, are added to the fact table
+            table = dbTransactions.fact_table(clean, engine)
+
+        scope = dbTransactions.address_scope(table.name, snapshot)
+        try:
+            with metrics.stage("database", len(clean)) as m:
+
+                #listings already in the snapshot are checked through the address index
+                clean, stored = dbTransactions.deduplicate(clean, table, engine, on_duplicate, snapshot)
+                duplicates = len(stored)
+
+                if on_duplicate=="upsert":
+
+                    #the stored listings are deleted in the same transaction
+                    #as their replacements are inserted
+                    m["rows_out"] = dbTransactions.replace_rows(clean, stored, table, engine, snapshot, progress=lambda n: jobs.record(rows_inserted=n), scope=scope)
+
+                else:
 
-        metadata = MetaData()
-        metadata.reflect(engine)
-        table = metadata.tables[last_table]
+                    with engine.connect() as conn:
 
-        with engine.connect() as conn:
+                        m["rows_out"] = dbTransactions.bulk_insert(clean, table, conn, progress=lambda n: jobs.record(rows_inserted=n), scope=scope, run_id=run_id if snapshot is not None else None)
 
-            dbTransactions.bulk_insert(clean, table, conn)
+                        conn.close()
+        finally:
+            #cached query pages of the snapshot are stale now, even if
+            #the insert stopped halfway
+            queries.invalidate(scope)
 
-            conn.close()
+        if snapshot is not None:
+            dbTransactions.close_run(engine, run_id, rows_received=len(raw), rows_stored=m["rows_out"], schema_version=schema.get("version"))
 
-            with open(dbpath, "w") as report:
-                report.write("Insert made on {} on {}.".format(last_table, datetime.now()))
+        #the counts and totals of the run are only added to those of
+        #every run once its rows are stored
+        aggregates.mergeQuality(stats)
+        aggregates.mergeColumns(totals)
+
+        with open(dbpath, "w") as report:
+            report.write("Insert made on {} on {}.\n".format(last_table if snapshot is None else "snapshot {} of {}".format(snapshot, last_table), datetime.now()))
+            report.write("{} listings were already stored; they were {}.".format(duplicates, "skipped" if on_duplicate=="skip" else "replaced"))
 
         #finally we send a final webhook to make sure the pipeline is finished
         utils.sendWebhook(dbpath)
 
+        #the rule results of this run are kept for the next ones
+        ruleCache.save()
+
     else:
 
+        if upload is None:
+            storage.archiveRaw(body, None, os.path.join(os.getcwd(), "data/raw/new_entries"), "raw_data", run)
+
         with open(dqpath, "w") as report:
-            report.write("Mismatching data sent on {}.".format(datetime.now()))
+            report.write("Mismatching data sent on {}.\nMissing columns: {}.\nUnexpected columns: {}.".format(datetime.now(), missing, unexpected))
 
         utils.sendWebhook(dqpath)
 
@@ -157,6 +396,40 @@ async def insert_pipeline(args: Request):
 
 
 
+def run_validate(body, sample=0):
+    #large files can be checked on a random subset of their rows, which
+    #bounds the time taken by the checks. Rows are picked after parsing,
+    #as a quoted description may span several lines. The same seed keeps
+    #repeated checks of a file comparable, and duplicates are 
+    #undercounted as most of their copies are left out
+    raw = pandas.read_csv(io.StringIO(body))
+    if sample>0 and sample<len(raw):
+        raw = raw.sample(sample, random_state=0).reset_index(drop=True)
+
+    report = dataQuality.checkQuality(raw)
+    report["sample"] = sample
+
+    return report
+
+def run_query(columns, where, after, limit, format, snapshot=None):
+    #the latest snapshot is read unless another one is asked for
+    registry = schemaRegistry.readRegistry(os.path.join(os.getcwd(), "data/schema.json"))
+    name = registry["latest"] if snapshot is None else str(snapshot)
+    if name not in registry["tables"]:
+        raise KeyError("Unknown snapshot {}.".format(snapshot) if snapshot is not None else "No schema is registered yet, /start has to run first!")
+    schema = registry["tables"][name]
+
+    engine = dbTransactions.get_engine()
+    table = dbTransactions.get_table(schema["table"], engine)
+
+    #tables made before the fact table hold a single snapshot
+    snapshot = schema.get("run_id")
+    runs = None if snapshot is None else dbTransactions.snapshot_runs(engine, snapshot)
+    scope = dbTransactions.address_scope(table.name, snapshot)
+    columns = list(schema["clean_columns"]) if columns is None else [c for c in columns.split(",") if c!=""]
+
+    return queries.runQuery(table, engine, runs, scope, columns, where, after, limit, format)
+
 @app.get("/check")
 async def check_result():
     with open(os.path.join(os.getcwd(), "data/test.txt"), "r") as fp:
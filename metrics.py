@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+import jobs
+
+logger = logging.getLogger(__name__)
+
+#structured log of every stage run, one JSON object per line
+LOGPATH = os.environ.get("METRICS_LOG", "data/metrics/stages.jsonl")
+
+#upper bounds of the duration histogram, in seconds
+BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900]
+
+#totals per stage since the server started
+STAGES = {}
+LOCK = threading.Lock()
+
+#stages running at this moment, across all jobs
+ACTIVE = [0]
+
+def peakRss():
+    """
+    Returns the peak resident memory of the process, in bytes.
+    """
+
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def resetPeak():
+    """
+    Resets the peak resident memory of the process, so that the next
+    reading of peakRss belongs to the stage about to run. This only
+    works on Linux; elsewhere the peak keeps growing over the life of
+    the process.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+def readPeak():
+    """
+    Returns the peak resident memory since the last resetPeak, in
+    bytes, falling back to peakRss when /proc is not available.
+    """
+
+    try:
+        with open("/proc/self/status", "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return peakRss()
+
+@contextmanager
+def stage(name, rowsIn=None, bytesRead=None):
+    """
+    Measures a pipeline stage: wall time, rows in and out, bytes read
+    and peak memory. The stage sets rows_out, and bytes_read if it is
+    only known at the end, on the record it is given. Each run is
+    appended to the structured log and added to the totals served
+    by /metrics, also when the stage fails.
+
+    Input:
+
+    name: the name of the stage, e.g. "data_quality" -> str
+    rowsIn: the number of rows going in -> int
+    bytesRead: the number of bytes read -> int
+
+    Output:
+
+    record: the measurements of the run -> dict
+    """
+
+    record = {"stage":name, "job":getattr(jobs.CURRENT, "job_id", None), "started":str(datetime.now()),
+              "rows_in":rowsIn, "rows_out":None, "bytes_read":bytesRead, "status":"finished"}
+
+    #the peak is only reset when no other stage is running, as it is
+    #shared by the whole process
+    with LOCK:
+        if ACTIVE[0]==0:
+            resetPeak()
+        ACTIVE[0] += 1
+
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception:
+        record["status"] = "failed"
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        record["peak_rss_bytes"] = readPeak()
+        with LOCK:
+            ACTIVE[0] -= 1
+        observe(record)
+        writeLog(record)
+
+def observe(record):
+    """
+    Adds a stage run to the totals of its stage.
+
+    Input:
+
+    record: the measurements of the run -> dict
+    """
+
+    with LOCK:
+        totals = STAGES.setdefault(record["stage"], {"runs":0, "failures":0, "seconds":0.0, "rows_in":0, "rows_out":0,
+                                                     "bytes_read":0, "peak_rss_bytes":0, "buckets":[0] * len(BUCKETS)})
+        totals["runs"] += 1
+        totals["failures"] += record["status"]=="failed"
+        totals["seconds"] += record["seconds"]
+        totals["rows_in"] += record["rows_in"] or 0
+        totals["rows_out"] += record["rows_out"] or 0
+        totals["bytes_read"] += record["bytes_read"] or 0
+        totals["peak_rss_bytes"] = record["peak_rss_bytes"]
+        for i, bound in enumerate(BUCKETS):
+            if record["seconds"]<=bound:
+                totals["buckets"][i] += 1
+
+def writeLog(record):
+    """
+    Appends a stage run to the structured log. Failures are only
+    logged, as metrics must never break the pipeline.
+
+    Input:
+
+    record: the measurements of the run -> dict
+    """
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(LOGPATH)), exist_ok=True)
+        with LOCK:
+            with open(LOGPATH, "a") as fp:
+                fp.write(json.dumps(record) + "\n")
+    except Exception:
+        logger.exception("The metrics could not be logged")
+
+def renderMetrics():
+    """
+    Renders the totals of every stage in the Prometheus text format.
+
+    Output:
+
+    text: the metrics page -> str
+    """
+
+    counters = [("runs", "openred_stage_runs_total", "Stage runs."),
+                ("failures", "openred_stage_failures_total", "Stage runs that raised an error."),
+                ("rows_in", "openred_stage_rows_in_total", "Rows going into the stage."),
+                ("rows_out", "openred_stage_rows_out_total", "Rows coming out of the stage."),
+                ("bytes_read", "openred_stage_bytes_read_total", "Bytes read by the stage.")]
+
+    with LOCK:
+        stages = {k: dict(v, buckets=list(v["buckets"])) for k, v in STAGES.items()}
+
+    lines = []
+    for key, metric, description in counters:
+        lines += ["# HELP {} {}".format(metric, description), "# TYPE {} counter".format(metric)]
+        lines += ['{}{{stage="{}"}} {}'.format(metric, name, totals[key]) for name, totals in stages.items()]
+
+    lines += ["# HELP openred_stage_peak_rss_bytes Peak resident memory of the last run of the stage.",
+              "# TYPE openred_stage_peak_rss_bytes gauge"]
+    lines += ['openred_stage_peak_rss_bytes{{stage="{}"}} {}'.format(name, totals["peak_rss_bytes"]) for name, totals in stages.items()]
+
+    lines += ["# HELP openred_stage_seconds Wall time of the stage.", "# TYPE openred_stage_seconds histogram"]
+    for name, totals in stages.items():
+        lines += ['openred_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, bound, count) for bound, count in zip(BUCKETS, totals["buckets"])]
+        lines += ['openred_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(name, totals["runs"]),
+                  'openred_stage_seconds_sum{{stage="{}"}} {}'.format(name, round(totals["seconds"], 4)),
+                  'openred_stage_seconds_count{{stage="{}"}} {}'.format(name, totals["runs"])]
+
+    lines += ["# HELP openred_process_peak_rss_bytes Peak resident memory of the process.",
+              "# TYPE openred_process_peak_rss_bytes gauge",
+              "openred_process_peak_rss_bytes {}".format(peakRss())]
+
+    text = "\n".join(lines) + "\n"
+
+    return text
@@ -0,0 +1,211 @@
+import os
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import pandas
+import numpy
+import dataQuality
+import featureMining
+import logic
+import aggregates
+import utils
+
+#how many processes run data quality and feature mining; with a
+#single worker everything runs in the calling thread as before
+WORKERS = int(os.environ.get("PIPELINE_WORKERS", "1"))
+
+#below this many rows the cost of shipping partitions to other
+#processes is larger than what they save
+MIN_ROWS = int(os.environ.get("PARALLEL_MIN_ROWS", "50000"))
+
+POOL = None
+LOCK = threading.Lock()
+
+def getPool():
+    """
+    Returns the process pool shared by every run, starting it on first
+    use. Workers are spawned rather than forked, as the server process
+    holds threads and open connections that must not be copied.
+
+    Output:
+
+    pool: the process pool -> concurrent.futures.ProcessPoolExecutor
+    """
+
+    global POOL
+
+    with LOCK:
+        if POOL is None:
+            POOL = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+    return POOL
+
+def shutdownPool():
+    """
+    Stops the process pool, if it was started.
+    """
+
+    global POOL
+
+    with LOCK:
+        if POOL is not None:
+            POOL.shutdown()
+            POOL = None
+
+def useParallel(df):
+    """
+    Tells whether a dataset is worth partitioning.
+
+    Input:
+
+    df: the dataset -> pandas.DataFrame
+
+    Output:
+
+    parallel: True if it should run on the process pool -> bool
+    """
+
+    return WORKERS>1 and len(df)>=MIN_ROWS
+
+def partitionByAddress(df, partitions):
+    """
+    Splits a dataset by a hash of its address block. Rows sharing an
+    address, and so every duplicate row, end up in the same
+    partition, as do near-duplicate addresses, which keeps uniqueness
+    correct within each of them. Each partition keeps the order of
+    its rows in df.
+
+    Input:
+
+    df: the dataset -> pandas.DataFrame
+    partitions: the number of partitions -> int
+
+    Output:
+
+    parts: the non-empty partitions -> list
+    """
+
+    blocks = logic.addressBlock(logic.addressKey(df["address"]))
+    keys = pandas.util.hash_pandas_object(blocks, index=False).to_numpy() % numpy.uint64(partitions)
+    parts = [df[keys==i].reset_index(drop=True) for i in range(partitions)]
+
+    return [part for part in parts if len(part)>0]
+
+def qualityPartition(part):
+    """
+    Runs the data quality stages on one partition, in a worker.
+
+    Input:
+
+    part: a partition of the raw data -> pandas.DataFrame
+
+    Output:
+
+    complete: the partition after data quality -> pandas.DataFrame
+    stats: the counts of every stage -> dict
+    """
+
+    stats = {}
+    unique = dataQuality.uniqueness(part, None, stats)
+    valid = dataQuality.validity(unique, None, stats)
+    complete = dataQuality.completeness(valid, None, stats)
+
+    return complete, stats
+
+def miningPartition(part, fmpath, vocabulary):
+    """
+    Runs the feature mining stages on one partition, in a worker.
+
+    Input:
+
+    part: a partition after data quality -> pandas.DataFrame
+    fmpath: a path-like object, or None to skip the log -> str
+    vocabulary: the output of buildVocabulary -> dict
+
+    Output:
+
+    mined: the partition with its features -> pandas.DataFrame
+    """
+
+    numerics = featureMining.extractFeaturesNumerics(part, fmpath)
+    mined = featureMining.extractFeaturesCategorical(numerics, fmpath, vocabulary)
+
+    return mined
+
+def runDataQuality(raw, dqpath):
+    """
+    Drop-in replacement for dataQuality.runDataQuality that runs the
+    stages on address partitions in the process pool. The counts of
+    every partition are added up into a single log. Rows come back
+    grouped by partition rather than in their original order. Small
+    datasets, or a single worker, go through the serial pipeline.
+
+    Input:
+
+    raw: the parsed raw data -> pandas.DataFrame
+    dqpath: a path-like object -> str
+
+    Output:
+
+    complete: a pandas.DataFrame object -> pandas.DataFrame
+    stats: the counts of every stage -> dict
+    """
+
+    if useParallel(raw)==False:
+        return dataQuality.runDataQuality(raw, dqpath)
+
+    #collecting timestap for current run
+    current_time = str(datetime.now())
+
+    stats = {"duplicate_rows":0, "duplicate_keys":0, "address_variants":0, "near_duplicates":0, "invalid_rows":0, "invalid_fields":[], "invalid_counts":{}, "missing":0, "explained":0}
+    parts = []
+    for complete, counts in getPool().map(qualityPartition, partitionByAddress(raw, WORKERS)):
+        dataQuality.mergeStats(stats, counts)
+        parts.append(complete)
+
+    dataQuality.writeReport(stats, dqpath, current_time)
+    utils.sendWebhook(dqpath)
+
+    complete = pandas.concat(parts, ignore_index=True)
+
+    return complete, stats
+
+def runFeatureMining(df, fmpath, vocabulary=None):
+    """
+    Drop-in replacement for featureMining.runFeatureMining that runs
+    the stages on address partitions in the process pool. Every
+    partition uses the same vocabulary, so they all get the same
+    dummy columns. Small datasets, or a single worker, go through
+    the serial pipeline.
+
+    Input:
+
+    df: a dataset which has already passed Data Quality -> pandas.DataFrame
+    fmpath: a path-like object -> str
+    vocabulary: the output of buildVocabulary, optional -> dict
+
+    Output:
+
+    categorics: a pandas.DataFrame object -> pandas.DataFrame
+    totals: the totals of every column, made by aggregates.describe -> dict
+    """
+
+    if useParallel(df)==False:
+        return featureMining.runFeatureMining(df, fmpath, vocabulary)
+
+    if vocabulary is None:
+        vocabulary = featureMining.buildVocabulary(df)
+
+    #the feature mining log is the same for every partition,
+    #so only the first one writes it
+    parts = partitionByAddress(df, WORKERS)
+    logs = [fmpath] + [None] * (len(parts) - 1)
+    mined = list(getPool().map(miningPartition, parts, logs, [vocabulary] * len(parts)))
+
+    utils.sendWebhook(fmpath)
+
+    categorics = pandas.concat(mined, ignore_index=True)
+    totals = aggregates.describe(categorics)
+
+    return categorics, totals
@@ -0,0 +1,291 @@
+import os
+import io
+import json
+import base64
+import threading
+from collections import OrderedDict
+import pandas
+from sqlalchemy import select, and_, or_, Boolean
+
+#pyarrow is only needed for Arrow responses
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+#rows per page unless the client asks otherwise, and at most
+PAGE_SIZE = int(os.environ.get("QUERY_PAGE_SIZE", "1000"))
+MAX_PAGE_SIZE = int(os.environ.get("QUERY_MAX_PAGE_SIZE", "10000"))
+
+#rows per NDJSON block or Arrow record batch of a response
+BLOCK_ROWS = 1000
+
+#the most pages kept; the least recently used go first
+MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_SIZE", "256"))
+
+#media type of each response format
+FORMATS = {"ndjson":"application/x-ndjson", "arrow":"application/vnd.apache.arrow.stream"}
+
+#filter operators, written as column:operator:value
+OPERATORS = {"eq": lambda c, v: c==v,
+             "ne": lambda c, v: c!=v,
+             "lt": lambda c, v: c<v,
+             "le": lambda c, v: c<=v,
+             "gt": lambda c, v: c>v,
+             "ge": lambda c, v: c>=v,
+             "in": lambda c, v: c.in_(v)}
+
+#pages keyed by scope and query, and a generation per scope that
+#invalidate moves on so pages read before an insert are not kept
+CACHE = OrderedDict()
+GENERATIONS = {}
+LOCK = threading.Lock()
+
+def parseValue(column, value):
+    """
+    Converts a filter value from the query string to the type of
+    the column it is compared with.
+
+    Input:
+
+    column: a column of the table -> sqlalchemy.Column
+    value: the value as sent -> str
+
+    Output:
+
+    parsed: the value as the column holds it -> object
+    """
+
+    if isinstance(column.type, Boolean):
+        if value.lower() not in ["true", "false", "1", "0"]:
+            raise ValueError("{} only holds true or false.".format(column.name))
+        return value.lower() in ["true", "1"]
+
+    try:
+        return column.type.python_type(value)
+    except (ValueError, NotImplementedError):
+        raise ValueError("{} cannot be compared with {}.".format(column.name, value))
+
+def buildFilters(table, where):
+    """
+    Turns filters of the form column:operator:value into conditions
+    on a table. The in operator takes comma-separated values. A
+    categorical column that was one-hot encoded, such as energy_label,
+    can be filtered with eq or in on its categories, which matches the
+    rows having any of their dummies set.
+
+    Input:
+
+    table: the table queried -> sqlalchemy.Table
+    where: the filters -> list
+
+    Output:
+
+    conditions: one condition per filter -> list
+    """
+
+    conditions = []
+    for item in where:
+        parts = item.split(":", 2)
+        if len(parts)!=3 or parts[1] not in OPERATORS:
+            raise ValueError("Filters are written column:operator:value, with an operator among {}.".format(", ".join(OPERATORS)))
+        name, operator, value = parts
+        values = value.split(",") if operator=="in" else [value]
+
+        if name in table.c:
+            column = table.c[name]
+            parsed = [parseValue(column, v) for v in values]
+            conditions.append(OPERATORS[operator](column, parsed if operator=="in" else parsed[0]))
+            continue
+
+        dummies = [name + "_" + v for v in values]
+        if operator not in ["eq", "in"] or any(d not in table.c for d in dummies):
+            raise ValueError("Unknown column {}.".format(name))
+        conditions.append(or_(*[table.c[d]==1 for d in dummies]))
+
+    return conditions
+
+def keyColumns(table):
+    """
+    Returns the columns pages are ordered and resumed by. The fact
+    table has a listing_id primary key. Tables made before it are
+    resumed by run_id and address, unique within a snapshot and
+    indexed; as a missing address has no place in that order, readPage
+    leaves those rows out there.
+    """
+
+    if "listing_id" in table.c:
+        return [table.c.listing_id]
+
+    return [table.c[c] for c in ["run_id", "address"] if c in table.c]
+
+def encodeCursor(values):
+    """
+    Packs the key of the last row of a page into an opaque cursor.
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decodeCursor(cursor, keys):
+    """
+    Unpacks a cursor made by encodeCursor.
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("The cursor is not valid.")
+    if isinstance(values, list)==False or len(values)!=len(keys):
+        raise ValueError("The cursor is not valid.")
+
+    return values
+
+def afterCursor(keys, values):
+    """
+    Keeps the rows coming after a key, in the order of the keys.
+    """
+
+    conditions = []
+    for i in range(len(keys)):
+        conditions.append(and_(*[keys[j]==values[j] for j in range(i)], keys[i]>values[i]))
+
+    return or_(*conditions)
+
+def readPage(table, engine, runs, columns, where, after, limit):
+    """
+    Reads one page of a table. The rows are ordered by the key
+    columns and the page starts right after the cursor, so every page
+    is an index range scan, however deep into the table it is.
+
+    Input:
+
+    table: the table queried -> sqlalchemy.Table
+    engine: a SQLAlchemy engine -> sqlalchemy.Engine
+    runs: the runs of the snapshot, or None for a whole table -> list
+    columns: the columns to return -> list
+    where: filters of the form column:operator:value -> list
+    after: the cursor of the previous page, or None -> str
+    limit: the number of rows of the page -> int
+
+    Output:
+
+    page: the rows of the page -> pandas.DataFrame
+    cursor: the cursor of the next page, or None on the last -> str
+    """
+
+    keys = keyColumns(table)
+    unknown = [c for c in columns if c not in table.c]
+    if len(unknown)>0:
+        raise ValueError("Unknown columns {}.".format(", ".join(unknown)))
+
+    #the key columns are always returned, as the cursor is made of them
+    selected = [k for k in keys if k.name not in columns] + [table.c[c] for c in columns]
+    conditions = buildFilters(table, where)
+    if "listing_id" not in table.c and "address" in table.c:
+        conditions.append(table.c.address.isnot(None))
+    if runs is not None:
+        conditions.append(table.c.run_id.in_(runs))
+    if after is not None:
+        conditions.append(afterCursor(keys, decodeCursor(after, keys)))
+
+    query = select(*selected).where(*conditions).order_by(*keys).limit(limit)
+    with engine.connect() as conn:
+        page = pandas.read_sql(query, conn)
+
+    cursor = None
+    if len(page)==limit:
+        cursor = encodeCursor([page[k.name].iloc[-1:].tolist()[0] for k in keys])
+
+    return page, cursor
+
+def serialize(page, format):
+    """
+    Writes a page out in blocks of BLOCK_ROWS rows, to be streamed to
+    the client one after the other.
+
+    Input:
+
+    page: the rows of a page -> pandas.DataFrame
+    format: ndjson or arrow -> str
+
+    Output:
+
+    blocks: the response body -> list
+    """
+
+    if format=="ndjson":
+        return [page.iloc[i:i + BLOCK_ROWS].to_json(orient="records", lines=True).encode() for i in range(0, len(page), BLOCK_ROWS)]
+
+    table = pyarrow.Table.from_pandas(page, preserve_index=False)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=BLOCK_ROWS):
+            writer.write_batch(batch)
+
+    return [sink.getvalue()]
+
+def invalidate(scope):
+    """
+    Drops the cached pages of a table or snapshot, once rows were
+    added to it or replaced.
+
+    Input:
+
+    scope: the output of dbTransactions.address_scope -> str
+    """
+
+    with LOCK:
+        GENERATIONS[scope] = GENERATIONS.get(scope, 0) + 1
+        for key in [k for k in CACHE if k[0]==scope]:
+            del CACHE[key]
+
+def runQuery(table, engine, runs, scope, columns, where=None, after=None, limit=PAGE_SIZE, format="ndjson"):
+    """
+    Answers a query on the clean data with a page of rows, from the
+    cache when the same query was answered since the last insert.
+
+    Input:
+
+    table: the table queried -> sqlalchemy.Table
+    engine: a SQLAlchemy engine -> sqlalchemy.Engine
+    runs: the runs of the snapshot, or None for a whole table -> list
+    scope: the output of dbTransactions.address_scope -> str
+    columns: the columns to return -> list
+    where: filters of the form column:operator:value -> list
+    after: the cursor of the previous page, or None -> str
+    limit: the number of rows of the page -> int
+    format: ndjson or arrow -> str
+
+    Output:
+
+    blocks: the response body -> list
+    cursor: the cursor of the next page, or None on the last -> str
+    """
+
+    if format not in FORMATS:
+        raise ValueError("The format must be {}.".format(" or ".join(FORMATS)))
+    if format=="arrow" and pyarrow is None:
+        raise ValueError("Arrow responses need pyarrow to be installed.")
+    if limit<1 or limit>MAX_PAGE_SIZE:
+        raise ValueError("The limit must be between 1 and {}.".format(MAX_PAGE_SIZE))
+
+    where = where or []
+    key = (scope, tuple(columns), tuple(sorted(where)), after, limit, format)
+    with LOCK:
+        generation = GENERATIONS.get(scope, 0)
+        if key in CACHE:
+            CACHE.move_to_end(key)
+            return CACHE[key]
+
+    page, cursor = readPage(table, engine, runs, columns, where, after, limit)
+    result = (serialize(page, format), cursor)
+
+    #a page read while an insert ran may already be stale
+    with LOCK:
+        if GENERATIONS.get(scope, 0)==generation:
+            CACHE[key] = result
+            while len(CACHE)>MAX_ENTRIES:
+                CACHE.popitem(last=False)
+
+    return result
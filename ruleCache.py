@@ -0,0 +1,102 @@
+import os
+import pickle
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+#where the cache is kept between runs
+PATH = os.environ.get("RULE_CACHE_PATH", "data/rule_cache.pkl")
+
+#the most results kept; the least recently used go first
+MAX_ENTRIES = int(os.environ.get("RULE_CACHE_SIZE", "200000"))
+
+#results keyed by (rule-set version, rule, value)
+CACHE = OrderedDict()
+LOCK = threading.Lock()
+LOADED = [False]
+
+def load():
+    """
+    Reads the cache saved by a previous run, once per process. A
+    missing or unreadable file just means an empty cache. Must be
+    called holding LOCK.
+    """
+
+    if LOADED[0]:
+        return
+    LOADED[0] = True
+
+    if os.path.exists(PATH)==False:
+        return
+
+    try:
+        with open(PATH, "rb") as fp:
+            CACHE.update(pickle.load(fp))
+    except Exception:
+        logger.exception("The rule cache could not be read")
+
+    while len(CACHE)>MAX_ENTRIES:
+        CACHE.popitem(last=False)
+
+def save():
+    """
+    Writes the cache to disk, so the next run starts with the results
+    of this one. The file is replaced at once, never left half written.
+    """
+
+    with LOCK:
+        if LOADED[0]==False:
+            return
+        entries = OrderedDict(CACHE)
+
+    os.makedirs(os.path.dirname(os.path.abspath(PATH)), exist_ok=True)
+    with open(PATH + ".tmp", "wb") as fp:
+        pickle.dump(entries, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(PATH + ".tmp", PATH)
+
+def lookup(version, rule, values, compute):
+    """
+    Returns the result of a rule for each of a list of distinct
+    values. Results already known are read from the cache; the
+    others are computed together, in a single call, and stored.
+
+    Input:
+
+    version: the version of the rule set -> int
+    rule: a key naming the rule, e.g. its pattern -> tuple
+    values: distinct values -> list
+    compute: returns the results for a list of values -> callable
+
+    Output:
+
+    results: one result per value -> list
+    """
+
+    keys = [(version, rule, v) for v in values]
+    results = [None] * len(keys)
+    missing = []
+
+    with LOCK:
+        load()
+        for i, key in enumerate(keys):
+            if key in CACHE:
+                CACHE.move_to_end(key)
+                results[i] = CACHE[key]
+            else:
+                missing.append(i)
+
+    if len(missing)==0:
+        return results
+
+    computed = compute([values[i] for i in missing])
+
+    with LOCK:
+        for i, result in zip(missing, computed):
+            results[i] = result
+            CACHE[keys[i]] = result
+        while len(CACHE)>MAX_ENTRIES:
+            CACHE.popitem(last=False)
+
+    return results
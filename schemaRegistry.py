@@ -0,0 +1,208 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+from datetime import datetime
+
+#the registry is read, changed and written back by one job at a time
+LOCK = threading.Lock()
+
+def readRegistry(path):
+    """
+    Reads the schema registry, which is empty until the first run
+    of /start.
+
+    Input:
+
+    path: a path-like object -> str
+
+    Output:
+
+    registry: the latest table and the schema of every table -> dict
+    """
+
+    if os.path.exists(path)==False:
+        return {"latest":None, "tables":{}}
+
+    with open(path, "r") as fp:
+        registry = json.load(fp)
+
+    return registry
+
+def schemaVersion(cleanColumns):
+    """
+    Names a set of clean columns with their SQL types. Runs sharing
+    a version can be queried together column for column.
+
+    Input:
+
+    cleanColumns: the SQL type of each clean column -> dict
+
+    Output:
+
+    version: a short hash of the columns -> str
+    """
+
+    version = hashlib.sha1(json.dumps(cleanColumns, sort_keys=True).encode()).hexdigest()[:12]
+
+    return version
+
+def registerSchema(path, table, run_id, columns, rawTypes, vocabulary):
+    """
+    Records the schema of a snapshot opened by /start: the columns of
+    the raw data with their types, the clean columns it loaded into
+    the fact table with their SQL types and the dummy vocabulary. The
+    snapshot becomes the latest one, which /insert validates against
+    and appends to.
+
+    Input:
+
+    path: a path-like object -> str
+    table: the fact table -> sqlalchemy.Table
+    run_id: the run opening the snapshot -> int
+    columns: the clean columns of the run -> list
+    rawTypes: the type of each raw column -> dict
+    vocabulary: the output of featureMining.buildVocabulary -> dict
+
+    Output:
+
+    version: the schema version of the snapshot -> str
+    """
+
+    cleanColumns = {c: str(table.c[c].type) for c in columns}
+    version = schemaVersion(cleanColumns)
+
+    with LOCK:
+        registry = readRegistry(path)
+
+        registry["tables"][str(run_id)] = {"table":table.name,
+                                           "run_id":run_id,
+                                           "version":version,
+                                           "created":str(datetime.now()),
+                                           "raw_columns":{c: str(t) for c, t in rawTypes.items()},
+                                           "clean_columns":cleanColumns,
+                                           "vocabulary":vocabulary}
+        registry["latest"] = str(run_id)
+
+        #writing to a temporary file first so a crash never leaves half a registry
+        with open(path + ".tmp", "w") as fp:
+            json.dump(registry, fp)
+        os.replace(path + ".tmp", path)
+
+    return version
+
+def latestSchema(path):
+    """
+    Returns the schema of the latest snapshot. Schemas registered
+    before the fact table have no run_id and name their own table.
+
+    Input:
+
+    path: a path-like object -> str
+
+    Output:
+
+    schema: the entry of registerSchema for the latest table -> dict
+    """
+
+    registry = readRegistry(path)
+    if registry["latest"] is None:
+        raise KeyError("No schema is registered yet, /start has to run first!")
+
+    schema = registry["tables"][registry["latest"]]
+
+    return schema
+
+def legacySchema(rawFolder, table):
+    """
+    Returns a schema for deployments whose tables were all made
+    before the registry, the way /insert found one then: the header
+    of the latest raw file and the latest table. It has no run_id,
+    clean columns or vocabulary.
+
+    Input:
+
+    rawFolder: the raw bucket, e.g. data/raw -> str
+    table: the name of the latest table -> str
+
+    Output:
+
+    schema: an entry shaped like those of registerSchema -> dict
+    """
+
+    files = sorted(f for f in os.listdir(rawFolder) if f.endswith(".csv"))
+    if len(files)==0:
+        raise KeyError("No schema is registered yet, /start has to run first!")
+
+    header = readFileHeader(os.path.join(rawFolder, files[-1]))
+
+    schema = {"table":table,
+              "run_id":None,
+              "version":None,
+              "raw_columns":{c: "object" for c in header},
+              "clean_columns":None,
+              "vocabulary":None}
+
+    return schema
+
+def readHeader(body):
+    """
+    Parses only the header line of a CSV held in a string.
+
+    Input:
+
+    body: the CSV -> str
+
+    Output:
+
+    header: the column names -> list
+    """
+
+    end = body.find("\n")
+    line = body if end==-1 else body[:end]
+    header = next(csv.reader(io.StringIO(line)), [])
+
+    return header
+
+def readFileHeader(path):
+    """
+    Parses only the header line of a CSV file.
+
+    Input:
+
+    path: a path-like object -> str
+
+    Output:
+
+    header: the column names -> list
+    """
+
+    with open(path, "r", newline="") as fp:
+        header = next(csv.reader(fp), [])
+
+    return header
+
+def checkHeader(header, schema):
+    """
+    Compares column names with the raw columns of a schema.
+
+    Input:
+
+    header: the column names of an upload -> list
+    schema: the output of latestSchema -> dict
+
+    Output:
+
+    missing: expected columns absent from the header -> list
+    unexpected: columns of the header the schema does not have -> list
+    """
+
+    expected = set(schema["raw_columns"].keys())
+    found = set(header)
+
+    missing = sorted(expected - found)
+    unexpected = sorted(found - expected)
+
+    return missing, unexpected
@@ -0,0 +1,198 @@
+import os
+import numpy
+import pandas
+import utils
+
+#pyarrow is only needed for the columnar formats; it is listed among
+#the optional requirements
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None
+
+#"csv" keeps the original buckets; "parquet" writes zstd-compressed
+#Parquet and "arrow" writes uncompressed Arrow IPC, which can be 
+#memory-mapped without copying
+FORMAT = os.environ.get("STORAGE_FORMAT", "csv")
+
+EXTENSIONS = {"csv":".csv", "parquet":".parquet", "arrow":".arrow"}
+
+def checkFormat(format):
+    """
+    Makes sure a storage format is known and can be used.
+
+    Input:
+
+    format: csv, parquet or arrow -> str
+    """
+
+    if format not in EXTENSIONS:
+        raise ValueError("Unknown storage format {}.".format(format))
+    if format!="csv" and pyarrow is None:
+        raise ImportError("The {} storage format needs pyarrow to be installed.".format(format))
+
+def bucketPath(bucket, name, run, part=0, format=FORMAT):
+    """
+    Builds the path of a file in a bucket. CSV files keep the flat
+    layout of the buckets, one file per run. Columnar files are 
+    partitioned by run, with a directory per run holding one or 
+    more parts.
+
+    Input:
+
+    bucket: the bucket folder, e.g. data/clean -> str
+    name: the name of the file, e.g. clean_data -> str
+    run: the timestamp of the run -> str
+    part: the number of the part, for streamed runs -> int
+    format: csv, parquet or arrow -> str
+
+    Output:
+
+    path: a path-like object -> str
+    """
+
+    if format=="csv":
+        return os.path.join(bucket, name + "_" + run + EXTENSIONS[format])
+
+    return os.path.join(bucket, "run=" + run, "{}-{:05d}{}".format(name, part, EXTENSIONS[format]))
+
+def frameSchema(df):
+    """
+    Returns the Arrow schema the columnar parts of a run are written
+    with. It follows the pandas types rather than the values, so that
+    a part where a column is all missing, or an integer column turned
+    to floats by a missing value, keeps the types of the other parts.
+
+    Input:
+
+    df: a part of the dataset -> pandas.DataFrame
+
+    Output:
+
+    schema: one field per column -> pyarrow.Schema
+    """
+
+    checkFormat("parquet")
+
+    fields = []
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, pandas.CategoricalDtype):
+            type = pyarrow.dictionary(pyarrow.int32(), pyarrow.large_string())
+        elif pandas.api.types.is_bool_dtype(dtype):
+            type = pyarrow.bool_()
+        elif pandas.api.types.is_integer_dtype(dtype):
+            type = pyarrow.from_numpy_dtype(numpy.dtype(str(dtype).lower()))
+        elif pandas.api.types.is_float_dtype(dtype):
+            type = pyarrow.float64()
+        else:
+            type = pyarrow.large_string()
+        fields.append(pyarrow.field(column, type))
+
+    return pyarrow.schema(fields)
+
+def writeFrame(df, bucket, name, run, part=0, format=FORMAT, schema=None):
+    """
+    Writes a dataset to a bucket. For CSV, later parts of the same
+    run are appended to the first one; columnar parts are all written
+    with the schema given, made by frameSchema from the first part.
+
+    Input:
+
+    df: the dataset -> pandas.DataFrame
+    bucket: the bucket folder, e.g. data/clean -> str
+    name: the name of the file, e.g. clean_data -> str
+    run: the timestamp of the run -> str
+    part: the number of the part, for streamed runs -> int
+    format: csv, parquet or arrow -> str
+    schema: the Arrow schema of the run, or None -> pyarrow.Schema
+
+    Output:
+
+    path: where the data was written -> str
+    """
+
+    checkFormat(format)
+    path = bucketPath(bucket, name, run, part, format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if format=="csv":
+        if part==0:
+            df.to_csv(path, index=False)
+        else:
+            path = bucketPath(bucket, name, run, 0, format)
+            df.to_csv(path, mode="a", header=False, index=False)
+        return path
+
+    table = pyarrow.Table.from_pandas(df, schema=schema or frameSchema(df), preserve_index=False)
+    if format=="parquet":
+        pyarrow.parquet.write_table(table, path, compression="zstd")
+    else:
+        with pyarrow.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+
+    return path
+
+def readFrame(path, columns=None):
+    """
+    Reads a dataset written by writeFrame, loading only the columns
+    asked for. The format follows from the extension; a run directory
+    is read as a whole. Columnar files are memory-mapped.
+
+    Input:
+
+    path: a file or a run directory -> str
+    columns: the columns to load, or None for all -> list
+
+    Output:
+
+    df: the dataset -> pandas.DataFrame
+    """
+
+    if path.endswith(EXTENSIONS["csv"]):
+        return pandas.read_csv(path, usecols=columns)
+
+    checkFormat("parquet")
+
+    if os.path.isdir(path):
+        parts = sorted(os.listdir(path))
+        format = "ipc" if parts[0].endswith(EXTENSIONS["arrow"]) else "parquet"
+        table = pyarrow.dataset.dataset(path, format=format).to_table(columns=columns)
+    elif path.endswith(EXTENSIONS["parquet"]):
+        table = pyarrow.parquet.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(path, "r")).read_all()
+        if columns is not None:
+            table = table.select(columns)
+
+    df = table.to_pandas()
+
+    return df
+
+def archiveRaw(body, df, bucket, name, run, format=FORMAT):
+    """
+    Archives an upload to the raw bucket on a background thread. In
+    CSV mode, or when the upload could not be parsed, the body is 
+    written as it was sent; otherwise the parsed dataset is written
+    in the columnar format.
+
+    Input:
+
+    body: the upload as sent -> str
+    df: the parsed upload, or None -> pandas.DataFrame
+    bucket: the bucket folder, e.g. data/raw -> str
+    name: the name of the file, e.g. raw_data -> str
+    run: the timestamp of the run -> str
+    format: csv, parquet or arrow -> str
+
+    Output:
+
+    future: completes once the upload is written -> concurrent.futures.Future
+    """
+
+    if format=="csv" or df is None:
+        return utils.archive(body, bucketPath(bucket, name, run, format="csv"))
+
+    return utils.submitArchive(writeFrame, df, bucket, name, run, 0, format)
@@ -0,0 +1,134 @@
+import pandas
+from datetime import datetime
+import dataQuality
+import featureMining
+import dbTransactions
+import logic
+import utils
+import jobs
+import storage
+import metrics
+import aggregates
+
+def streamVocabulary(categories):
+    """
+    Builds the dummy vocabulary from the distinct categorical values
+    collected while scanning the file. Invalid values are left out,
+    as validity would set them to NaN. Values only found in rows 
+    dropped later on may still get a column, which is then all zeros.
+
+    Input:
+
+    categories: distinct values per categorical column -> dict
+
+    Output:
+
+    vocabulary: the categories of each column -> dict
+    """
+
+    frame = pandas.DataFrame({c: pandas.Series(sorted(v), dtype=object) for c, v in categories.items()})
+    for column in frame.columns:
+        frame[column] = frame[column].where(logic.matchRule(frame[column], logic.VALIDITY_PATTERNS[column]))
+
+    vocabulary = featureMining.buildVocabulary(frame)
+
+    return vocabulary
+
+def runStreamingPipeline(datapath, dqpath, fmpath, cleanbucket, engine, run_id, chunksize):
+    """
+    Runs the whole pipeline on the raw data chunk by chunk, so that
+    peak memory depends on the chunk size rather than the file size.
+    A first pass only keeps compact hashes to find duplicates across
+    the whole file; a second pass pushes each chunk through validity,
+    completeness, feature mining and the database insert. The data
+    quality log is written once at the end with the totals of all 
+    chunks.
+
+    Input:
+
+    datapath: a path-like object -> str
+    dqpath: a path-like object -> str
+    fmpath: a path-like object -> str
+    cleanbucket: the folder of the clean bucket -> str
+    engine: a SQLAlchemy engine -> sqlalchemy.Engine
+    run_id: the run the rows are appended under -> int
+    chunksize: the number of rows per chunk -> int
+
+    Output:
+
+    result: the dummy vocabulary, the fact table, its columns, the 
+    type of each raw column, the number of rows received and 
+    inserted, and the data quality counts and column totals of all
+    chunks -> dict
+    """
+
+    #collecting timestap for current run
+    current_time = str(datetime.now())
+
+    #first pass: duplicates, column types and categories
+    jobs.progress("scanning")
+    scan = dataQuality.scanDuplicates(datapath, chunksize)
+    vocabulary = streamVocabulary(scan["categories"])
+
+    stats = {"duplicate_rows":scan["duplicate_rows"], "duplicate_keys":scan["duplicate_keys"], "address_variants":scan["address_variants"],
+             "near_duplicates":scan["near_duplicates"], "invalid_rows":0, "invalid_fields":[], "invalid_counts":{}, "missing":0, "explained":0}
+
+    #the raw columns keep their inferred type, or are read as strings
+    header = pandas.read_csv(datapath, nrows=0).columns
+    types = {c: scan["types"].get(c, "str") for c in header}
+
+    #second pass: every stage on one chunk at a time
+    table = None
+    schema = None
+    rows = 0
+    received = 0
+    totals = {}
+    with engine.connect() as conn:
+
+        for i, chunk in enumerate(pandas.read_csv(datapath, dtype=str, chunksize=chunksize)):
+
+            jobs.record(chunk=i)
+            columnNames = [x for x in chunk.columns if x not in featureMining.KEEP_COLUMNS]
+            received += len(chunk)
+
+            with metrics.stage("data_quality", len(chunk)) as m:
+                unique = dataQuality.dropDuplicates(chunk, scan)
+                valid = dataQuality.validity(unique, None, stats)
+                complete = dataQuality.completeness(valid, None, stats)
+                m["rows_out"] = len(complete)
+
+            #the feature mining log is the same for every chunk, 
+            #so only the first one writes it
+            log = fmpath if table is None else None
+            with metrics.stage("feature_mining", len(complete)) as m:
+                numerics = featureMining.extractFeaturesNumerics(complete, log)
+                mined = featureMining.extractFeaturesCategorical(numerics, log, vocabulary)
+                m["rows_out"] = len(mined)
+
+            aggregates.combine(totals, aggregates.describe(mined))
+            clean = mined.drop(columnNames, axis=1)
+
+            #the columnar parts all take the types of the first one
+            if schema is None and storage.FORMAT!="csv":
+                schema = storage.frameSchema(clean)
+            storage.writeFrame(clean, cleanbucket, "clean_data", current_time, part=i, schema=schema)
+
+            clean.insert(0, "run_id", run_id)
+            if table is None:
+                table = dbTransactions.fact_table(clean, engine)
+
+            with metrics.stage("database", len(clean)) as m:
+                m["rows_out"] = dbTransactions.bulk_insert(clean, table, conn, scope=dbTransactions.address_scope(table.name, run_id), run_id=run_id)
+                rows += m["rows_out"]
+
+        conn.close()
+
+    dataQuality.writeReport(stats, dqpath, current_time)
+
+    utils.sendWebhook(dqpath)
+    utils.sendWebhook(fmpath)
+
+    result = {"vocabulary":vocabulary, "table":table, "columns":list(clean.columns), "types":types, "received":received, "rows":rows,
+              "stats":stats, "totals":totals}
+
+    return result
@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+#the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbTransactions
+from sqlalchemy import create_engine
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    A SQLite database of its own for each test, with the tables and
+    addresses cached by dbTransactions forgotten before and after.
+    """
+
+    dbTransactions.dispose_engine()
+    engine = create_engine("sqlite:///" + str(tmp_path / "test.db"))
+    yield engine
+    engine.dispose()
+    dbTransactions.dispose_engine()
@@ -0,0 +1,33 @@
+import logging
+import pandas
+import pytest
+import aggregates
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(aggregates, "PATH", str(tmp_path / "aggregates.json"))
+    monkeypatch.setattr(aggregates, "STORE", {})
+    monkeypatch.setattr(aggregates, "LOADED", [False])
+    return aggregates
+
+def test_totals_add_up_across_batches(store):
+    first = pandas.DataFrame({"price":[100.0, None], "label":pandas.Categorical(["A", "B"])})
+    second = pandas.DataFrame({"price":[300.0], "label":pandas.Categorical(["A"])})
+    store.mergeColumns(store.describe(first))
+    store.mergeColumns(store.describe(second))
+
+    summary = store.summary()
+    assert summary["rows"]==3
+    assert summary["columns"]["price"]["count"]==2
+    assert summary["columns"]["price"]["missing"]==1
+    assert summary["columns"]["price"]["mean"]==200.0
+    assert summary["categories"]["label"]=={"A":2, "B":1}
+
+def test_unreadable_store_is_logged_and_ignored(store, caplog):
+    with open(store.PATH, "w") as fp:
+        fp.write("{")
+
+    with caplog.at_level(logging.ERROR, logger="aggregates"):
+        assert store.summary()["runs"]==0
+
+    assert "The aggregates could not be read" in caplog.text
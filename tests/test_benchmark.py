@@ -0,0 +1,23 @@
+from collections import OrderedDict
+import benchmark
+import ruleCache
+
+def test_descriptions_have_no_placeholders_left():
+    listings = benchmark.generateListings(500)
+    descriptions = listings["description"].dropna()
+
+    assert descriptions.str.contains("{", regex=False).any()==False
+    assert descriptions.str.contains(r"het volume \d+ m3", regex=True).any()
+    assert descriptions.str.contains(r"waarvan \d+ slaapkamers", regex=True).any()
+
+def test_each_run_of_a_stage_starts_with_an_empty_rule_cache(monkeypatch):
+    monkeypatch.setattr(ruleCache, "CACHE", OrderedDict([("stale", True)]))
+    monkeypatch.setattr(ruleCache, "LOADED", [False])
+    sizes = []
+    def stage():
+        sizes.append(len(ruleCache.CACHE))
+        ruleCache.CACHE["seen"] = True
+
+    benchmark.measure(stage)
+    assert sizes==[0, 0]
+    assert ruleCache.LOADED[0]
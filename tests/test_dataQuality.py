@@ -0,0 +1,69 @@
+import pandas
+import pytest
+import benchmark
+import dataQuality
+import logic
+
+def listings(addresses):
+    return pandas.DataFrame({"address":addresses, "price":[100000.0 + i for i in range(len(addresses))]})
+
+@pytest.mark.parametrize("first, second", [("Markstraat 12, Den Haag", "Parkstraat 12, Den Haag"),
+                                           ("Berkweg 4, Rotterdam", "Bergweg 4, Rotterdam")])
+def test_close_streets_are_different_listings(first, second):
+    variants, canonical = dataQuality.nearDuplicates(pandas.Series([first, second]))
+
+    assert variants.tolist()==[False, False] and canonical.tolist()==[-1, -1]
+
+@pytest.mark.parametrize("first, second", [("Keizersgracht 12-A, 1015 AB Amsterdam", "keizersgracht 12 a, 1015ab amsterdam"),
+                                           ("Kerkstraat 7, Utrecht", "kerkstraat 7 utrecht")])
+def test_same_normalized_address_is_a_variant(first, second):
+    variants, canonical = dataQuality.nearDuplicates(pandas.Series([first, second]))
+
+    assert variants.tolist()==[False, True] and canonical.tolist()==[-1, -1]
+
+@pytest.mark.parametrize("first, second", [("Keizersgracht 12-A, Amsterdam", "Keizers gracht 12A, Amsterdam"),
+                                           ("Kerkstraat 7, Utrecht", "Kerkstraat 7, Utrect")])
+def test_close_addresses_are_near_duplicates(first, second):
+    variants, canonical = dataQuality.nearDuplicates(pandas.Series([first, second]))
+
+    assert variants.tolist()==[False, False] and canonical.tolist()==[-1, 0]
+
+def test_near_duplicates_point_to_the_first_of_their_group():
+    addresses = pandas.Series(["Dam 1, Amsterdm", "Kerkstraat 7, Utrect", "Dam 1, Amsterdam", "Kerkstraat 7, Utrecht", "Dam 1, Amsterdan"])
+    variants, canonical = dataQuality.nearDuplicates(addresses)
+
+    assert canonical.tolist()==[-1, -1, 0, 1, 0]
+
+def test_blocks_hold_street_and_numbers():
+    keys = logic.addressKey(pandas.Series(["Markstraat 12, 2511 AB Den Haag", "1e Jan Steenstraat 5, Utrecht", "Dam"]))
+
+    assert logic.addressBlock(keys).tolist()==["markstraat 12 2511ab", "jansteenstraat 1e 5", "dam"]
+
+def test_uniqueness_drops_variants_and_flags_near_duplicates():
+    raw = listings(["Markstraat 12, Den Haag", "Parkstraat 12, Den Haag", "Kerkstraat 7, Utrecht", "kerkstraat 7 utrecht", "Kerkstraat 7, Utrect"])
+    stats = {}
+    unique = dataQuality.uniqueness(raw, None, stats)
+
+    assert unique["address"].tolist()==["Markstraat 12, Den Haag", "Parkstraat 12, Den Haag", "Kerkstraat 7, Utrecht", "Kerkstraat 7, Utrect"]
+    assert unique["FLAG_NEAR_DUPLICATE"].tolist()==[False, False, False, True]
+    assert unique["NEAR_DUPLICATE_OF"].tolist()[3]=="Kerkstraat 7, Utrecht" and unique["NEAR_DUPLICATE_OF"].iloc[:3].isna().all()
+    assert stats["address_variants"]==1 and stats["near_duplicates"]==1
+
+def test_streaming_matches_uniqueness(tmp_path):
+    addresses = ["Markstraat 12, Den Haag", "Parkstraat 12, Den Haag", "Kerkstraat 7, Utrecht", "Berkweg 4, Rotterdam",
+                 "kerkstraat 7 utrecht", "Bergweg 4, Rotterdam", "Dam 1, Amsterdam", "Dam 1, Amsterdam", "Kerkstraat 7, Utrect"]
+    raw = benchmark.generateListings(len(addresses), duplicates=0, invalid=0)
+    raw["address"] = addresses
+    raw = pandas.concat([raw, raw.iloc[[0]]], ignore_index=True)
+    path = str(tmp_path / "raw_data.csv")
+    raw.to_csv(path, index=False)
+
+    expected = dataQuality.uniqueness(pandas.read_csv(path), None, {})
+
+    scan = dataQuality.scanDuplicates(path, 3)
+    chunks = [dataQuality.dropDuplicates(chunk, scan) for chunk in pandas.read_csv(path, dtype=str, chunksize=3)]
+    streamed = pandas.concat(chunks, ignore_index=True)
+
+    assert scan["duplicate_rows"]==2 and scan["duplicate_keys"]==4
+    assert scan["address_variants"]==1 and scan["near_duplicates"]==1
+    pandas.testing.assert_frame_equal(streamed, expected, check_dtype=False)
@@ -0,0 +1,127 @@
+import pandas
+import pytest
+from sqlalchemy import select, func
+import dbTransactions
+
+def count(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(table)).scalar()
+
+def test_conform_batch_turns_float_prices_back_into_integers(engine):
+    table = dbTransactions.generate_sql_table(pandas.DataFrame({"address":["a"], "price":[900000]}), "listings", engine)
+    batch = pandas.DataFrame({"address":["b", "c"], "price":[902000.0, float("nan")]})
+
+    conformed = dbTransactions.conform_batch(batch, table, 0, 2)
+
+    assert str(conformed["price"].dtype)=="Int64"
+    assert conformed.to_csv(header=False, index=False, na_rep="\\N")=="b,902000\nc,\\N\n"
+
+def test_bulk_insert_commits_each_batch(engine):
+    df = pandas.DataFrame({"address":["a", "b", "c"], "price":[1.0, 2.0, None]})
+    table = dbTransactions.generate_sql_table(df, "listings", engine)
+    committed = []
+
+    with engine.connect() as conn:
+        rows = dbTransactions.bulk_insert(df, table, conn, batch_size=2, progress=committed.append)
+
+    assert rows==3
+    assert committed==[2, 3]
+    assert count(engine, table)==3
+
+def test_bulk_insert_honours_the_callers_transaction(engine):
+    df = pandas.DataFrame({"address":["a", "b", "c"], "price":[1.0, 2.0, 3.0]})
+    table = dbTransactions.generate_sql_table(df, "listings", engine)
+
+    with engine.connect() as conn:
+        conn.begin()
+        dbTransactions.bulk_insert(df, table, conn, batch_size=2)
+        conn.rollback()
+
+    assert count(engine, table)==0
+
+def test_stopped_load_resumes_from_the_rows_stored(engine):
+    run_id = dbTransactions.open_run(engine, "start")
+    df = pandas.DataFrame({"run_id":run_id, "address":["a", "b", "c", "d", "e"], "price":[1.0, 2.0, 3.0, 4.0, None]})
+    table = dbTransactions.fact_table(df, engine)
+
+    def stop(done):
+        if done==2:
+            raise RuntimeError("connection lost")
+
+    with engine.connect() as conn:
+        with pytest.raises(RuntimeError):
+            dbTransactions.bulk_insert(df, table, conn, batch_size=2, progress=stop, run_id=run_id)
+    assert stored_runs(engine)=={run_id:2}
+
+    with engine.connect() as conn:
+        rows = dbTransactions.bulk_insert(df, table, conn, batch_size=2, start=stored_runs(engine)[run_id], run_id=run_id)
+
+    assert rows==5
+    assert stored_runs(engine)=={run_id:5}
+    with engine.connect() as conn:
+        assert sorted(conn.execute(select(table.c.address)).scalars())==["a", "b", "c", "d", "e"]
+
+def load_snapshot(engine, addresses):
+    """
+    Opens a /start run holding one listing per address and returns
+    the fact table and the run.
+    """
+
+    run_id = dbTransactions.open_run(engine, "start")
+    df = pandas.DataFrame({"run_id":run_id, "address":addresses, "price":[100000.0] * len(addresses)})
+    table = dbTransactions.fact_table(df, engine)
+    with engine.connect() as conn:
+        rows = dbTransactions.bulk_insert(df, table, conn, scope=dbTransactions.address_scope(table.name, run_id))
+    dbTransactions.close_run(engine, run_id, rows_stored=rows)
+
+    return table, run_id
+
+def stored_runs(engine):
+    catalog = dbTransactions.run_catalog(engine)
+    with engine.connect() as conn:
+        return dict(conn.execute(select(catalog.c.run_id, catalog.c.rows_stored)).all())
+
+def test_upsert_replaces_rows_and_updates_the_catalog(engine):
+    table, snapshot = load_snapshot(engine, ["a", "b", "c"])
+    run_id = dbTransactions.open_run(engine, "insert", snapshot)
+    batch = pandas.DataFrame({"run_id":run_id, "address":["b", "d"], "price":[200000.0, 300000.0]})
+
+    batch, stored = dbTransactions.deduplicate(batch, table, engine, "upsert", snapshot)
+    rows = dbTransactions.replace_rows(batch, stored, table, engine, snapshot)
+    dbTransactions.close_run(engine, run_id, rows_stored=rows)
+
+    assert stored==["b"]
+    with engine.connect() as conn:
+        prices = dict(conn.execute(select(table.c.address, table.c.price)).all())
+    assert prices=={"a":100000.0, "b":200000.0, "c":100000.0, "d":300000.0}
+    assert stored_runs(engine)=={snapshot:2, run_id:2}
+
+def test_failed_upsert_keeps_the_stored_rows(engine):
+    table, snapshot = load_snapshot(engine, ["a", "b"])
+    run_id = dbTransactions.open_run(engine, "insert", snapshot)
+    batch = pandas.DataFrame({"run_id":run_id, "address":["b"], "price":[200000.0], "unknown":[1]})
+
+    batch, stored = dbTransactions.deduplicate(batch, table, engine, "upsert", snapshot)
+    with pytest.raises(KeyError):
+        dbTransactions.replace_rows(batch, stored, table, engine, snapshot)
+
+    assert count(engine, table)==2
+    assert stored_runs(engine)[snapshot]==2
+
+def test_skip_drops_listings_of_the_snapshot_only(engine):
+    table, first = load_snapshot(engine, ["a", "b"])
+    table, second = load_snapshot(engine, ["c"])
+    batch = pandas.DataFrame({"run_id":second, "address":["a", "c"], "price":[1.0, 2.0]})
+
+    batch, stored = dbTransactions.deduplicate(batch, table, engine, "skip", second)
+
+    assert stored==["c"]
+    assert batch["address"].tolist()==["a"]
+
+def test_latest_table_has_the_highest_number(engine):
+    with pytest.raises(KeyError):
+        dbTransactions.latest_table(engine)
+
+    for name in ["openred_clean_9", "openred_clean_10", "other_table"]:
+        dbTransactions.generate_sql_table(pandas.DataFrame({"address":["a"]}), name, engine)
+    assert dbTransactions.latest_table(engine)=="openred_clean_10"
@@ -0,0 +1,44 @@
+import logging
+import threading
+import jobs
+
+def run_inline(function):
+    job_id = "test-{}".format(threading.get_ident())
+    with jobs.LOCK:
+        jobs.JOBS[job_id] = {"id":job_id, "kind":"test", "status":"queued", "stage":None, "stages":[],
+                             "submitted":None, "started":None, "finished":None, "error":None}
+    jobs.run(job_id, function)
+    return jobs.status(job_id)
+
+def test_record_sets_fields_without_adding_stages():
+    def pipeline():
+        jobs.progress("streaming")
+        for i in range(50):
+            jobs.record(chunk=i)
+
+    job = run_inline(pipeline)
+    assert job["status"]=="finished"
+    assert job["chunk"]==49
+    assert [s["name"] for s in job["stages"]]==["streaming"]
+
+def test_failed_job_keeps_the_error():
+    def pipeline():
+        raise KeyError("price")
+
+    job = run_inline(pipeline)
+    assert job["status"]=="failed"
+    assert job["error"].startswith("KeyError")
+
+def test_outside_a_job_nothing_is_recorded():
+    jobs.progress("nowhere")
+    jobs.record(chunk=1)
+
+def test_failed_job_is_logged(caplog):
+    def pipeline():
+        raise ValueError("no rows")
+
+    with caplog.at_level(logging.ERROR, logger="jobs"):
+        run_inline(pipeline)
+
+    assert "failed" in caplog.text
+    assert "ValueError: no rows" in caplog.text
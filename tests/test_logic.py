@@ -0,0 +1,20 @@
+import numpy
+import pandas
+import pytest
+import logic
+
+TEXTS = pandas.Series(["Belastingstraat 4, garage in eigendom", "Ruime Tuin en een Badkamer", "", None, numpy.nan, 12,
+                       "Nieuwbouw maisonnette, Energielabel A", "erfpachtvrij, Parkeerplaats"], index=range(10, 18))
+
+def naive(column):
+    return pandas.DataFrame({rule: [type(x)==str and any(k in x for k in words) for x in column]
+                             for rule, words in logic.DESCRIPTION_KEYWORDS.items()}, index=column.index)
+
+def test_scanner_finds_every_rule_of_overlapping_keywords():
+    pandas.testing.assert_frame_equal(logic.scanText(TEXTS), naive(TEXTS))
+
+def test_scanner_without_pyahocorasick_finds_the_same(monkeypatch):
+    monkeypatch.setattr(logic, "ahocorasick", None)
+    scanner, bits = logic.buildScanner(logic.DESCRIPTION_KEYWORDS)
+    assert scanner is None
+    pandas.testing.assert_frame_equal(logic.scanText(TEXTS, scanner=scanner, bits=bits), naive(TEXTS))
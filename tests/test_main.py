@@ -0,0 +1,40 @@
+import os
+import pytest
+import aggregates
+import benchmark
+import dbTransactions
+import utils
+import main
+
+def test_validate_samples_records_not_lines():
+    data = benchmark.generateListings(40)
+    data["description"] = ["Ruime woning\nmet tuin,\n\"dichtbij\" het centrum" if i%2 else x for i, x in enumerate(data["description"])]
+    body = data.to_csv(index=False)
+
+    report = main.run_validate(body, sample=15)
+    assert report["rows"]==15
+    assert report["sample"]==15
+
+    assert main.run_validate(body, sample=15)==report
+    assert main.run_validate(body, sample=100)["rows"]==40
+
+def test_aggregates_are_only_merged_once_the_rows_are_stored(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("data")
+    monkeypatch.setattr(dbTransactions, "get_engine", lambda: engine)
+    monkeypatch.setattr(utils, "sendWebhook", lambda path: None)
+    monkeypatch.setattr(aggregates, "PATH", str(tmp_path / "aggregates.json"))
+    monkeypatch.setattr(aggregates, "STORE", {})
+    monkeypatch.setattr(aggregates, "LOADED", [False])
+    body = benchmark.generateListings(20).to_csv(index=False)
+
+    def stop(*args, **kwargs):
+        raise RuntimeError("database down")
+    with monkeypatch.context() as m:
+        m.setattr(dbTransactions, "bulk_insert", stop)
+        with pytest.raises(RuntimeError):
+            main.run_start(body)
+    assert aggregates.summary()["runs"]==0 and aggregates.summary()["rows"]==0
+
+    main.run_start(body)
+    assert aggregates.summary()["runs"]==1 and aggregates.summary()["rows"]>0
@@ -0,0 +1,12 @@
+import logging
+import metrics
+
+def test_failed_log_write_is_logged(tmp_path, monkeypatch, caplog):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setattr(metrics, "LOGPATH", str(blocker / "stages.jsonl"))
+
+    with caplog.at_level(logging.ERROR, logger="metrics"):
+        metrics.writeLog({"stage":"validity"})
+
+    assert "The metrics could not be logged" in caplog.text
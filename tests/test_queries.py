@@ -0,0 +1,57 @@
+import pandas
+import pytest
+import dbTransactions
+import queries
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    queries.CACHE.clear()
+    queries.GENERATIONS.clear()
+
+def load(engine, name, rows):
+    df = pandas.DataFrame(rows, columns=["run_id", "address", "price"])
+    with engine.connect() as conn:
+        if name in dbTransactions.TABLES:
+            table = dbTransactions.TABLES[name]
+        else:
+            table = dbTransactions.generate_sql_table(df, name, engine)
+        dbTransactions.bulk_insert(df, table, conn)
+    return table
+
+def read_all(table, engine, runs, limit):
+    seen, after = [], None
+    while True:
+        page, after = queries.readPage(table, engine, runs, ["address", "price"], [], after, limit)
+        seen += page.to_dict("records")
+        if after is None:
+            return seen
+
+def test_pages_cover_rows_without_an_address(engine):
+    rows = [(1, None, 100.0), (1, "b", 200.0), (1, "a", 300.0), (2, None, 400.0), (2, "a", 500.0), (2, None, 600.0)]
+    table = load(engine, "listings", rows)
+
+    seen = read_all(table, engine, None, 2)
+    assert sorted(r["price"] for r in seen)==[100.0, 200.0, 300.0, 400.0, 500.0, 600.0]
+    assert len(set(r["listing_id"] for r in seen))==6
+
+    seen = read_all(table, engine, [2], 1)
+    assert [r["price"] for r in seen]==[400.0, 500.0, 600.0]
+
+def test_tables_without_a_listing_key_leave_missing_addresses_out(engine):
+    df = pandas.DataFrame({"address":[None, "b", "a", None], "price":[1.0, 2.0, 3.0, 4.0]})
+    table = dbTransactions.generate_sql_table(df, "openred_clean_0", engine)
+    with engine.connect() as conn:
+        dbTransactions.bulk_insert(df, table, conn)
+
+    page, after = queries.readPage(table, engine, None, ["price"], [], None, 1)
+    seen = page["address"].tolist()
+    while after is not None:
+        page, after = queries.readPage(table, engine, None, ["price"], [], after, 1)
+        seen += page["address"].tolist()
+    assert seen==["a", "b"]
+
+def test_cursor_must_match_the_keys(engine):
+    table = load(engine, "listings", [(1, "a", 1.0)])
+
+    with pytest.raises(ValueError):
+        queries.readPage(table, engine, None, ["price"], [], queries.encodeCursor([1, "a"]), 1)
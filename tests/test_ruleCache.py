@@ -0,0 +1,57 @@
+import logging
+from collections import OrderedDict
+import pytest
+import ruleCache
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ruleCache, "PATH", str(tmp_path / "rule_cache.pkl"))
+    monkeypatch.setattr(ruleCache, "CACHE", OrderedDict())
+    monkeypatch.setattr(ruleCache, "LOADED", [False])
+    return ruleCache
+
+def test_values_are_computed_once(cache):
+    calls = []
+    def compute(values):
+        calls.append(list(values))
+        return [len(v) for v in values]
+
+    assert cache.lookup(1, ("match", "x"), ["ab", "abc"], compute)==[2, 3]
+    assert cache.lookup(1, ("match", "x"), ["abc", "abcd"], compute)==[3, 4]
+    assert calls==[["ab", "abc"], ["abcd"]]
+
+def test_new_ruleset_version_is_computed_again(cache):
+    calls = []
+    def compute(values):
+        calls.append(list(values))
+        return [True for v in values]
+
+    cache.lookup(1, ("match", "x"), ["a"], compute)
+    cache.lookup(2, ("match", "x"), ["a"], compute)
+    assert calls==[["a"], ["a"]]
+
+def test_least_recently_used_go_first(cache, monkeypatch):
+    monkeypatch.setattr(ruleCache, "MAX_ENTRIES", 2)
+    compute = lambda values: [v.upper() for v in values]
+
+    cache.lookup(1, "r", ["a", "b"], compute)
+    cache.lookup(1, "r", ["a"], compute)
+    cache.lookup(1, "r", ["c"], compute)
+    assert list(cache.CACHE)==[(1, "r", "a"), (1, "r", "c")]
+
+def test_cache_is_kept_between_runs(cache, monkeypatch):
+    cache.lookup(1, "r", ["a"], lambda values: ["A"])
+    cache.save()
+
+    monkeypatch.setattr(ruleCache, "CACHE", OrderedDict())
+    monkeypatch.setattr(ruleCache, "LOADED", [False])
+    assert cache.lookup(1, "r", ["a"], lambda values: pytest.fail("computed again"))==["A"]
+
+def test_unreadable_cache_is_logged_and_ignored(cache, caplog):
+    with open(cache.PATH, "wb") as fp:
+        fp.write(b"not a pickle")
+
+    with caplog.at_level(logging.ERROR, logger="ruleCache"):
+        assert cache.lookup(1, "r", ["a"], lambda values: ["A"])==["A"]
+
+    assert "The rule cache could not be read" in caplog.text
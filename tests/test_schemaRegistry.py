@@ -0,0 +1,38 @@
+import threading
+import pytest
+from sqlalchemy import MetaData, Table, Column, Integer, String
+import schemaRegistry
+
+def test_concurrent_registrations_are_all_kept(tmp_path):
+    path = str(tmp_path / "schema.json")
+    table = Table("openred_listings", MetaData(), Column("run_id", Integer), Column("address", String))
+
+    def register(run_id):
+        for _ in range(20):
+            schemaRegistry.registerSchema(path, table, run_id, ["run_id", "address"], {"address":"str"}, None)
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(1, 9)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    registry = schemaRegistry.readRegistry(path)
+    assert sorted(registry["tables"], key=int)==[str(i) for i in range(1, 9)]
+    assert registry["tables"][registry["latest"]]["clean_columns"]=={"run_id":"INTEGER", "address":"VARCHAR"}
+
+def test_legacy_schema_reads_the_latest_raw_file(tmp_path):
+    raw = tmp_path / "raw"
+    (raw / "new_entries").mkdir(parents=True)
+    (raw / "raw_data_2024-01-01.csv").write_text("address,price\nA,1\n")
+    (raw / "raw_data_2024-02-01.csv").write_text("address,price,description\nA,1,x\n")
+
+    schema = schemaRegistry.legacySchema(str(raw), "openred_clean_3")
+    assert schema["table"]=="openred_clean_3"
+    assert schema["run_id"] is None and schema["vocabulary"] is None
+    assert schemaRegistry.checkHeader(["address", "price", "description"], schema)==([], [])
+    assert schemaRegistry.checkHeader(["address", "price"], schema)==(["description"], [])
+
+def test_legacy_schema_needs_a_raw_file(tmp_path):
+    with pytest.raises(KeyError):
+        schemaRegistry.legacySchema(str(tmp_path), "openred_clean_0")
@@ -0,0 +1,30 @@
+import numpy
+import pandas
+import pytest
+import storage
+
+pyarrow = pytest.importorskip("pyarrow")
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_streamed_parts_keep_one_schema(tmp_path, format):
+    first = pandas.DataFrame({"address":["a", "b"], "price":[1.0, 2.0], "rooms":pandas.array([3, 4], dtype="Int16"),
+                              "label":pandas.Categorical(["A", "B"]), "garden":numpy.array([1, 0], dtype=numpy.uint8)})
+    second = pandas.DataFrame({"address":["c"], "price":[numpy.nan], "rooms":pandas.array([None], dtype="Int16"),
+                               "label":pandas.Categorical([None]), "garden":numpy.array([1], dtype=numpy.uint8)})
+
+    schema = storage.frameSchema(first)
+    storage.writeFrame(first, str(tmp_path), "clean_data", "run", part=0, format=format, schema=schema)
+    path = storage.writeFrame(second, str(tmp_path), "clean_data", "run", part=1, format=format, schema=schema)
+
+    df = storage.readFrame(str(tmp_path / "run=run"))
+    assert df["address"].tolist()==["a", "b", "c"]
+    assert df["rooms"].isna().tolist()==[False, False, True]
+    assert df["label"].astype(str).tolist()[:2]==["A", "B"]
+    assert storage.readFrame(path)["garden"].dtype==numpy.uint8
+
+def test_schema_follows_types_not_values():
+    empty = pandas.DataFrame({"label":pandas.Categorical([None]), "address":pandas.Series([None], dtype="str")})
+    schema = storage.frameSchema(empty)
+
+    assert schema.field("label").type==pyarrow.dictionary(pyarrow.int32(), pyarrow.large_string())
+    assert schema.field("address").type==pyarrow.large_string()
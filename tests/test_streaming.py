@@ -0,0 +1,41 @@
+import pandas
+import benchmark
+import dataQuality
+
+def write(tmp_path, raw):
+    path = str(tmp_path / "raw_data.csv")
+    raw.to_csv(path, index=False)
+    return path
+
+def test_row_hashes_do_not_depend_on_the_chunk():
+    raw = benchmark.generateListings(20).astype(str)
+
+    whole = dataQuality.hashRows(raw)
+    parts = [dataQuality.hashRows(raw.iloc[i:i + 7].reset_index(drop=True)) for i in range(0, 20, 7)]
+
+    assert (whole[0]==pandas.concat([pandas.Series(p[0]) for p in parts]).to_numpy()).all()
+    assert (whole[1]==pandas.concat([pandas.Series(p[1]) for p in parts]).to_numpy()).all()
+
+def test_duplicates_across_chunks_are_all_dropped(tmp_path):
+    raw = benchmark.generateListings(12, duplicates=0, invalid=0)
+    raw = pandas.concat([raw, raw.iloc[[1]], raw.iloc[[2]].assign(price=1.0)], ignore_index=True)
+    path = write(tmp_path, raw)
+
+    scan = dataQuality.scanDuplicates(path, 5)
+    kept = pandas.concat([dataQuality.dropDuplicates(c, scan) for c in pandas.read_csv(path, dtype=str, chunksize=5)], ignore_index=True)
+
+    assert scan["duplicate_rows"]==2
+    assert scan["duplicate_keys"]==4
+    assert set(kept["address"])==set(raw["address"]) - {raw["address"][1], raw["address"][2]}
+    assert kept["address"].tolist()==dataQuality.uniqueness(pandas.read_csv(path), None, {})["address"].tolist()
+
+def test_columns_get_one_type_for_the_whole_file(tmp_path):
+    raw = benchmark.generateListings(10, duplicates=0, invalid=0)
+    raw.loc[7, "price"] = None
+    path = write(tmp_path, raw)
+
+    scan = dataQuality.scanDuplicates(path, 5)
+    types = {str(c.dtypes["price"]) for c in (dataQuality.dropDuplicates(c, scan) for c in pandas.read_csv(path, dtype=str, chunksize=5))}
+
+    assert scan["types"]["price"]=="float64"
+    assert types=={"float64"}
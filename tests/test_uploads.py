@@ -0,0 +1,70 @@
+import gzip
+import asyncio
+import pytest
+from starlette.requests import ClientDisconnect
+import uploads
+
+CSV = b"address,price\nKerkstraat 1,100000\nMolenweg 2,200000\n"
+BOUNDARY = "xYzBoundary"
+
+class FakeRequest:
+    def __init__(self, body, content_type, size=7, disconnect=False):
+        self.headers = {"content-type":content_type}
+        self.body = body
+        self.size = size
+        self.disconnect = disconnect
+
+    async def stream(self):
+        for i in range(0, len(self.body), self.size):
+            yield self.body[i:i + self.size]
+        if self.disconnect:
+            raise ClientDisconnect()
+
+def form(*parts):
+    body = b""
+    for name, filename, content in parts:
+        disposition = 'form-data; name="{}"'.format(name) + ('; filename="{}"'.format(filename) if filename else "")
+        body += "--{}\r\nContent-Disposition: {}\r\n\r\n".format(BOUNDARY, disposition).encode() + content + b"\r\n"
+    return body + "--{}--\r\n".format(BOUNDARY).encode()
+
+def receive(tmp_path, request):
+    path = str(tmp_path / "raw" / "raw_data.csv")
+    written = asyncio.run(uploads.receiveUpload(request, path))
+    with open(path, "rb") as fp:
+        return written, fp.read()
+
+def test_multipart_file_is_read_from_the_stream(tmp_path):
+    body = form(("note", None, b"first run"), ("file", "listings.csv", CSV), ("other", "other.csv", b"x,y\n"))
+    written, data = receive(tmp_path, FakeRequest(body, "multipart/form-data; boundary=" + BOUNDARY))
+
+    assert data==CSV
+    assert written==len(CSV)
+
+def test_multipart_gzip_with_several_members(tmp_path):
+    compressed = gzip.compress(CSV[:20]) + gzip.compress(CSV[20:])
+    body = form(("file", "listings.csv.gz", compressed))
+    written, data = receive(tmp_path, FakeRequest(body, "multipart/form-data; boundary=" + BOUNDARY, size=3))
+
+    assert data==CSV
+
+def test_raw_body_is_accepted(tmp_path):
+    written, data = receive(tmp_path, FakeRequest(gzip.compress(CSV), "application/gzip"))
+
+    assert data==CSV
+
+@pytest.mark.parametrize("body, message", [(form(("note", None, b"no file")), "holds no file"),
+                                           (form(("file", "listings.csv", CSV))[:-40], "truncated"),
+                                           (form(("file", "listings.csv.gz", gzip.compress(CSV)[:-8])), "truncated")])
+def test_broken_forms_are_refused(tmp_path, body, message):
+    with pytest.raises(ValueError, match=message):
+        receive(tmp_path, FakeRequest(body, "multipart/form-data; boundary=" + BOUNDARY))
+
+def test_partial_file_is_removed_when_the_client_disconnects(tmp_path):
+    import main
+
+    path = str(tmp_path / "raw" / "raw_data.csv")
+    request = FakeRequest(CSV, "text/csv", disconnect=True)
+
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(main.receive_upload(request, path))
+    assert (tmp_path / "raw" / "raw_data.csv").exists()==False
@@ -0,0 +1,33 @@
+import logging
+import utils
+
+def test_webhooks_are_not_posted_twice():
+    retry = utils.ADAPTER.max_retries
+    assert retry.read==0
+    assert retry.is_retry("POST", 429)
+    assert retry.is_retry("POST", 500)==False
+    assert retry.is_retry("POST", 503)==False
+
+def test_failed_webhook_is_logged(monkeypatch, caplog):
+    monkeypatch.setenv("WEBHOOK_URL", "http://127.0.0.1:9/hook")
+    monkeypatch.setattr(utils.ADAPTER, "max_retries", utils.ADAPTER.max_retries.new(total=0, connect=0))
+
+    with caplog.at_level(logging.ERROR, logger="utils"):
+        utils.postWebhook("report")
+
+    assert "The webhook could not be sent" in caplog.text
+
+def test_failed_archive_is_logged(tmp_path, caplog):
+    with caplog.at_level(logging.ERROR, logger="utils"):
+        future = utils.archive("address\n", str(tmp_path / "missing" / "raw_data.csv"))
+        assert isinstance(future.exception(), FileNotFoundError)
+        utils.ARCHIVER.submit(lambda: None).result()
+
+    assert "A raw upload could not be archived" in caplog.text
+
+def test_archive_writes_the_file(tmp_path):
+    path = str(tmp_path / "raw_data.csv")
+    utils.archive("address\n", path).result()
+
+    with open(path) as fp:
+        assert fp.read()=="address\n"
@@ -0,0 +1,279 @@
+import os
+import zlib
+from starlette.concurrency import run_in_threadpool
+
+#zstd support is optional, gzip and plain CSV always work
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#python-multipart is only needed for multipart uploads
+try:
+    import python_multipart
+except ImportError:
+    python_multipart = None
+
+#the first bytes of each compressed format
+MAGIC = {"gzip":b"\x1f\x8b", "zstd":b"\x28\xb5\x2f\xfd"}
+
+class FrameDecoder:
+    """
+    Decompresses a gzip or zstd stream incrementally, including
+    files made of several members or frames one after the other, as
+    parallel compressors write them.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.decoder = factory()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            if self.decoder.eof:
+                self.decoder = self.factory()
+            out.append(self.decoder.decompress(data))
+            data = self.decoder.unused_data if self.decoder.eof else b""
+        return b"".join(out)
+
+    def flush(self):
+        if not self.decoder.eof:
+            raise ValueError("The upload is truncated.")
+        return b""
+
+class PlainDecoder:
+    """
+    Passes an uncompressed stream through.
+    """
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+def sniffEncoding(head):
+    """
+    Tells how an upload is compressed from its first bytes, so that
+    clients need not set any header.
+
+    Input:
+
+    head: the first bytes of the upload -> bytes
+
+    Output:
+
+    encoding: gzip, zstd or plain -> str
+    """
+
+    for encoding, magic in MAGIC.items():
+        if head.startswith(magic):
+            return encoding
+
+    return "plain"
+
+def openDecoder(encoding):
+    """
+    Returns an incremental decoder for a compression format.
+
+    Input:
+
+    encoding: gzip, zstd or plain -> str
+
+    Output:
+
+    decoder: an object with decompress(bytes) and flush() -> object
+    """
+
+    if encoding=="gzip":
+        return FrameDecoder(lambda: zlib.decompressobj(wbits=16 + zlib.MAX_WBITS))
+
+    if encoding=="zstd":
+        if zstandard is None:
+            raise ValueError("zstd uploads need the zstandard package.")
+        return FrameDecoder(lambda: zstandard.ZstdDecompressor().decompressobj())
+
+    return PlainDecoder()
+
+class FilePart:
+    """
+    Collects the bytes of the first file of a multipart form as the
+    parser finds them, skipping every other field.
+    """
+
+    def __init__(self):
+        self.headers = {}
+        self.field = b""
+        self.value = b""
+        self.reading = False
+        self.found = False
+        self.done = False
+        self.data = []
+
+    def callbacks(self):
+        return {"on_part_begin":self.begin,
+                "on_header_field":lambda data, start, end: self.append("field", data[start:end]),
+                "on_header_value":lambda data, start, end: self.append("value", data[start:end]),
+                "on_header_end":self.headerEnd,
+                "on_headers_finished":self.headersFinished,
+                "on_part_data":self.partData,
+                "on_part_end":self.end}
+
+    def append(self, name, data):
+        setattr(self, name, getattr(self, name) + data)
+
+    def begin(self):
+        self.headers = {}
+
+    def headerEnd(self):
+        self.headers[self.field.lower()] = self.value
+        self.field = b""
+        self.value = b""
+
+    def headersFinished(self):
+        self.reading = self.found==False and b"filename=" in self.headers.get(b"content-disposition", b"")
+        self.found = self.found or self.reading
+
+    def partData(self, data, start, end):
+        if self.reading:
+            self.data.append(data[start:end])
+
+    def end(self):
+        if self.reading:
+            self.reading = False
+            self.done = True
+
+    def take(self):
+        data = b"".join(self.data)
+        self.data = []
+        return data
+
+async def multipartChunks(request):
+    """
+    Reads the first file of a multipart form from the request as it
+    arrives. The form is parsed incrementally, so neither the form
+    nor the file is spooled to memory or disk as a whole.
+
+    Input:
+
+    request: the incoming request -> starlette.requests.Request
+    """
+
+    if python_multipart is None:
+        raise ValueError("Multipart uploads need the python-multipart package.")
+
+    options = python_multipart.multipart.parse_options_header(request.headers["content-type"])[1]
+    if b"boundary" not in options:
+        raise ValueError("The multipart form has no boundary.")
+
+    part = FilePart()
+    parser = python_multipart.MultipartParser(options[b"boundary"], part.callbacks())
+
+    async for data in request.stream():
+        try:
+            parser.write(data)
+        except python_multipart.exceptions.MultipartParseError as e:
+            raise ValueError("The multipart form could not be parsed: {}".format(e))
+
+        data = part.take()
+        if data:
+            yield data
+
+        #whatever follows the file is not needed
+        if part.done:
+            return
+
+    if part.found==False:
+        raise ValueError("The form holds no file.")
+    raise ValueError("The upload is truncated.")
+
+def writeChunk(fp, decoder, data):
+    """
+    Decompresses a block of an upload and appends it to a file.
+
+    Input:
+
+    fp: the open file -> file
+    decoder: the output of openDecoder -> object
+    data: the block -> bytes
+
+    Output:
+
+    written: the number of decompressed bytes written -> int
+    """
+
+    try:
+        out = decoder.decompress(data)
+    except Exception as e:
+        raise ValueError("The upload could not be decompressed: {}".format(e))
+    fp.write(out)
+
+    return len(out)
+
+async def saveStream(chunks, path):
+    """
+    Writes an upload to disk block by block as it arrives,
+    decompressing it on the way, so it is never held in memory as
+    a whole. Decompressing and writing happen on the thread pool,
+    leaving the event loop free for other requests.
+
+    Input:
+
+    chunks: the blocks of the upload -> AsyncIterator[bytes]
+    path: a path-like object -> str
+
+    Output:
+
+    written: the size of the CSV written, in bytes -> int
+    """
+
+    decoder = None
+    head = b""
+    written = 0
+
+    with open(path, "wb") as fp:
+        async for data in chunks:
+            #the format is known once the first bytes are in
+            if decoder is None:
+                head += data
+                if len(head)<4:
+                    continue
+                decoder, data = openDecoder(sniffEncoding(head)), head
+            written += await run_in_threadpool(writeChunk, fp, decoder, data)
+
+        #uploads shorter than the magic bytes
+        if decoder is None:
+            decoder = openDecoder(sniffEncoding(head))
+            written += await run_in_threadpool(writeChunk, fp, decoder, head)
+
+        tail = decoder.flush()
+        fp.write(tail)
+        written += len(tail)
+
+    return written
+
+async def receiveUpload(request, path):
+    """
+    Saves the CSV sent with a request to disk. The CSV may be the
+    raw request body or the first file of a multipart form, either
+    plain or compressed with gzip or zstd.
+
+    Input:
+
+    request: the incoming request -> starlette.requests.Request
+    path: where to write the CSV -> str
+
+    Output:
+
+    written: the size of the CSV written, in bytes -> int
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        written = await saveStream(multipartChunks(request), path)
+    else:
+        written = await saveStream(request.stream(), path)
+
+    return written
@@ -4,21 +4,165 @@ import os
 import requests
 import numpy
 import itertools
+import logging
+import threading
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+#webhooks are posted by a single background thread over a persistent
+#session, so the pipeline never waits on the network. A POST is only
+#retried when it surely never reached Slack, a failed connection or a
+#429, since retrying after a read error or a 5xx could post a batch twice
+NOTIFIER = ThreadPoolExecutor(max_workers=1)
+SESSION = requests.Session()
+ADAPTER = requests.adapters.HTTPAdapter(max_retries=Retry(total=3, connect=3, read=0, status=3, other=0, backoff_factor=1, status_forcelist=[429], allowed_methods=["POST"]))
+SESSION.mount("https://", ADAPTER)
+SESSION.mount("http://", ADAPTER)
+
+#connect and read timeouts, in seconds
+WEBHOOK_TIMEOUT = (3.05, 10)
+
+#messages of the run currently open on each thread
+BATCH = threading.local()
+
+def postWebhook(text):
+    """
+    Posts a message to the Slack webhook, retrying with backoff on
+    connection errors and on 429 answers. Failures are only logged,
+    as a report must never break the pipeline.
+
+    Input:
+
+    text: the message to send -> str
+    """
+
+    try:
+        r = SESSION.post(os.environ["WEBHOOK_URL"], json={"text":text}, timeout=WEBHOOK_TIMEOUT)
+        r.raise_for_status()
+    except Exception:
+        logger.exception("The webhook could not be sent")
+
+def startBatch():
+    """
+    Opens a run on the current thread. Until flushBatch is called,
+    sendWebhook collects the reports instead of posting each one.
+    """
+
+    BATCH.messages = []
+
+def flushBatch():
+    """
+    Closes the run open on the current thread and posts all of its
+    reports as a single message, in the background.
+
+    Output:
+
+    future: completes once the message is posted, or None if there
+    was nothing to send -> concurrent.futures.Future
+    """
+
+    messages = getattr(BATCH, "messages", None)
+    BATCH.messages = None
+
+    if not messages:
+        return None
+
+    return NOTIFIER.submit(postWebhook, "\n\n".join(messages))
 
 def sendWebhook(logpath):
     """
     Sends a Slack webhook to report run results, using a 
-    previously filled-in text file.
+    previously filled-in text file. The file is read at once but
+    posted in the background; within a run opened by startBatch 
+    the report is held until flushBatch.
 
     Input:
 
     logpath: a path-like object -> str
+
+    Output:
+
+    future: completes once the message is posted, or None if it
+    was added to the open run -> concurrent.futures.Future
     """
 
     with open(logpath, "r") as report:
-        url = os.environ["WEBHOOK_URL"]
-        payload = {"text":report.read()}
-        r = requests.post(url, json=payload)
+        text = report.read()
+
+    messages = getattr(BATCH, "messages", None)
+    if messages is not None:
+        messages.append(text)
+        return None
+
+    return NOTIFIER.submit(postWebhook, text)
+
+#a single background thread archives raw uploads, so that writing
+#them never holds up the pipeline and they are written in order
+ARCHIVER = ThreadPoolExecutor(max_workers=1)
+
+def writeText(text, path):
+    """
+    Writes a string to a text file.
+
+    Input:
+
+    text: the content of the file -> str
+    path: a path-like object -> str
+    """
+
+    with open(path, "w") as fp:
+        fp.write(text)
+
+def logFailure(future):
+    """
+    Logs the error of a background write, as nobody waits on its
+    future to see it.
+
+    Input:
+
+    future: a future of the archiver -> concurrent.futures.Future
+    """
+
+    error = future.exception()
+    if error is not None:
+        logger.error("A raw upload could not be archived", exc_info=error)
+
+def submitArchive(function, *args):
+    """
+    Runs a write on the archiver thread, logging it if it fails.
+
+    Input:
+
+    function: the function writing the file -> callable
+    args: the arguments of the function
+
+    Output:
+
+    future: completes once the file is written -> concurrent.futures.Future
+    """
+
+    future = ARCHIVER.submit(function, *args)
+    future.add_done_callback(logFailure)
+
+    return future
+
+def archive(text, path):
+    """
+    Writes a string to a text file on a background thread.
+
+    Input:
+
+    text: the content of the file -> str
+    path: a path-like object -> str
+
+    Output:
+
+    future: completes once the file is written -> concurrent.futures.Future
+    """
+
+    return submitArchive(writeText, text, path)
 
 def separateDummies(values):
     """
@@ -37,10 +181,8 @@ def separateDummies(values):
 
     """
 
-    stage1 = [x.split(" en ") if type(x)==str else numpy.nan for x in values]
-    if numpy.nan in stage1:
-        stage1.remove(numpy.nan)
-    stage2 = [x.split(", ") if type(x)==str else numpy.nan for x in itertools.chain(*stage1)]
+    stage1 = [x.split(" en ") for x in values if type(x)==str]
+    stage2 = [x.split(", ") for x in itertools.chain(*stage1)]
     stage3 = [x[1:] for x in set(itertools.chain(*stage2))] #removing the first letter so the expression
     #matches both upper case and lower case
     unique_values = set(stage3)